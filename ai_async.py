@@ -0,0 +1,477 @@
+"""
+/ai/run 的 asyncio 流式实现。
+
+同步路径中每个 AI 流都会占住一个 Flask worker 直到生成结束；这里用 asyncio 直接读取上游 SSE，
+在单个事件循环上复用成千上万条并发流。部署方式：
+
+    uvicorn ai_async:asgi_app --port 32221
+
+并由反向代理将 POST /ai/run 转发到该进程，其余路由仍交给 gunicorn/Flask。若安装了 asgiref，
+asgi_app 会把其它路径转交给 Flask（WsgiToAsgi），也可以单进程运行。
+
+上游请求经 httpx.AsyncClient 发出：连接池按事件循环复用，与同步路径的 requests 一样遵循
+HTTP(S)_PROXY / NO_PROXY 并自动解压响应。
+"""
+import asyncio
+import functools
+import json
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from ai_budget import CLIENT_DISCONNECT, BudgetTracker, record_cancellation
+from ai_circuit import BreakerCall, FailoverPlan
+from ai_metrics import CANCELLED, CLIENT_ERROR, OK, UPSTREAM_ERROR, StreamTimer
+from ai_hedge import CHUNK, DELIVER, DONE, ERROR, FINISH, HEDGE, HedgeRace, hedging_enabled
+from ai_inflight import Flight, finish_flight, join_or_start, prompt_fingerprint
+from ai_service import (
+    AIServiceError,
+    AIUpstreamError,
+    _append_debug_log,
+    _build_headers,
+    _build_payload,
+    build_chat_url,
+    extract_delta_content,
+    is_upstream_failure_status,
+    parse_sse_line,
+)
+from metrics import record_cache
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # asgiref 为可选依赖
+    WsgiToAsgi = None
+
+# 每个事件循环一个 AsyncClient（连接池不能跨事件循环使用）
+_http = {'loop': None, 'client': None}
+
+
+def _get_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    if _http['loop'] is not loop:
+        # 不限制连接数：并发流的数量由反向代理与预算控制，连接池排队只会让首包更慢
+        _http['client'] = httpx.AsyncClient(limits=httpx.Limits(max_connections=None,
+                                                                max_keepalive_connections=100))
+        _http['loop'] = loop
+    return _http['client']
+
+
+async def _close_client() -> None:
+    client = _http['client']
+    _http['client'] = _http['loop'] = None
+    if client is not None:
+        await client.aclose()
+
+
+async def async_stream_chat_completion(provider: Dict, messages: List[Dict[str, str]], *,
+                                       temperature: float = 0.2, timeout: int = 15) -> AsyncIterator[str]:
+    """
+    stream_chat_completion 的异步版本，输出相同的文本分片并抛出相同的异常类型。
+
+    为避免在事件循环上做大量同步文件写入，调试日志只记录请求开始、HTTP 错误、完成与失败事件。
+    """
+    url = build_chat_url(provider['base_url'])
+    headers = _build_headers(provider['api_key'])
+    payload = _build_payload(provider['model'], messages, stream=True, temperature=temperature)
+    trace_id = str(uuid.uuid4())
+    _append_debug_log('request.start', {
+        'trace_id': trace_id,
+        'base_url': provider['base_url'],
+        'model': provider['model'],
+        'temperature': temperature,
+        'messages': messages,
+        'transport': 'asyncio'
+    })
+    aggregated_output: List[str] = []
+    timer = StreamTimer(provider)
+    try:
+        async with _get_client().stream('POST', url, headers=headers, json=payload, timeout=timeout) as resp:
+            timer.connected()
+            if resp.status_code >= 400:
+                body = (await resp.aread()).decode('utf-8', errors='replace')
+                upstream_failure = is_upstream_failure_status(resp.status_code)
+                _append_debug_log('response.http_error', {
+                    'trace_id': trace_id,
+                    'status': resp.status_code,
+                    'body': body[:500],
+                    'timing': timer.finish(UPSTREAM_ERROR if upstream_failure else CLIENT_ERROR)
+                })
+                message = f'AI 服务响应异常: HTTP {resp.status_code} {body[:200]}'
+                if upstream_failure:
+                    raise AIUpstreamError(message, status=resp.status_code)
+                raise AIServiceError(message)
+            async for raw_line in resp.aiter_lines():
+                data = parse_sse_line(raw_line)
+                if data is None:
+                    continue
+                chunk = extract_delta_content(data)
+                if chunk:
+                    aggregated_output.append(chunk)
+                    timer.chunk(chunk)
+                    yield chunk
+            final_text = ''.join(aggregated_output)
+            _append_debug_log('response.complete', {
+                'trace_id': trace_id,
+                'aggregated_text': final_text,
+                'frontend_text': final_text,
+                'timing': timer.finish(OK)
+            })
+    except httpx.LocalProtocolError as exc:
+        # 请求本身无法构造（如 API Key 含换行），错误信息会带出请求头原文，不能写进日志或返回给前端
+        _append_debug_log('response.error', {
+            'trace_id': trace_id,
+            'error': type(exc).__name__,
+            'timing': timer.finish(CLIENT_ERROR)
+        })
+        raise AIServiceError('AI 服务请求无效，请检查配置（如 API Key 中是否含有换行等字符）。') from exc
+    except (httpx.HTTPError, httpx.InvalidURL) as exc:
+        _append_debug_log('response.error', {
+            'trace_id': trace_id,
+            'error': str(exc) or repr(exc),
+            'aggregated_text': ''.join(aggregated_output),
+            'timing': timer.finish(UPSTREAM_ERROR)
+        })
+        raise AIUpstreamError(f'AI 服务调用失败: {exc or repr(exc)}') from exc
+    finally:
+        # 调用方提前关闭生成器（客户端断开等）时记为 cancelled
+        timer.finish(CANCELLED)
+
+
+async def async_guarded_stream(provider: Dict, messages: List[Dict[str, str]], *,
+                               temperature: float = 0.2) -> AsyncIterator[str]:
+    """ai_circuit.guarded_stream 的异步版本，共享同一组熔断器与 BreakerCall 记账。"""
+    call = BreakerCall(provider)
+    try:
+        async for chunk in async_stream_chat_completion(provider, messages, temperature=temperature):
+            call.chunk()
+            yield chunk
+    except BaseException as exc:
+        call.failed(exc)
+        raise
+    call.succeeded()
+
+
+async def async_failover_stream(providers: List[Dict], messages: List[Dict[str, str]], *,
+                                temperature: float = 0.2) -> AsyncIterator[str]:
+    plan = FailoverPlan(providers)
+    for index, provider in enumerate(providers):
+        produced = False
+        try:
+            async for chunk in async_guarded_stream(provider, messages, temperature=temperature):
+                produced = True
+                yield chunk
+            return
+        except AIUpstreamError as exc:
+            if not plan.should_retry(index, exc, produced):
+                raise
+    plan.exhausted()
+
+
+async def async_hedged_stream(providers: List[Dict], messages: List[Dict[str, str]], *,
+                              temperature: float = 0.2) -> AsyncIterator[str]:
+    """ai_hedge.hedged_stream 的异步版本（同一个 HedgeRace）：落败的一路直接取消任务，连接随之关闭。"""
+    events: asyncio.Queue = asyncio.Queue()
+    race = HedgeRace(providers)
+    tasks: Dict[int, asyncio.Future] = {}
+
+    async def attempt(index: int, candidates: List[Dict]) -> None:
+        try:
+            async for chunk in async_failover_stream(candidates, messages, temperature=temperature):
+                await events.put((index, CHUNK, chunk))
+            await events.put((index, DONE, None))
+        except AIServiceError as exc:
+            await events.put((index, ERROR, exc))
+        except Exception as exc:
+            await events.put((index, ERROR, AIServiceError(f'AI 服务调用失败: {exc}')))
+
+    def start(index: int, candidates: List[Dict]) -> None:
+        tasks[index] = asyncio.ensure_future(attempt(index, candidates))
+
+    start(0, [race.primary])
+    try:
+        while True:
+            timeout = race.wait_timeout()
+            if timeout == 0:
+                start(*race.fire('slow_first_chunk'))
+                continue
+            try:
+                index, kind, value = await asyncio.wait_for(events.get(), timeout)
+            except asyncio.TimeoutError:
+                continue
+            action = race.on_event(index, kind, value)
+            if race.winner is not None:
+                for other_index, task in tasks.items():
+                    if other_index != race.winner:
+                        task.cancel()
+            if action == DELIVER:
+                yield value
+            elif action == FINISH:
+                return
+            elif action == HEDGE:
+                start(*race.fire('primary_failed'))
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+async def async_budgeted_stream(source: AsyncIterator[str]) -> AsyncIterator[str]:
+    """ai_budget.budgeted_stream 的异步版本。"""
+    tracker = BudgetTracker()
+    try:
+        while True:
+            # 每次等待都以剩余预算为超时：上游停止输出时截止时间一到即结束
+            remaining = tracker.remaining()
+            try:
+                if remaining is None:
+                    chunk = await source.__anext__()
+                else:
+                    chunk = await asyncio.wait_for(source.__anext__(), remaining)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                tracker.expire()
+            tracker.check(chunk)
+            yield chunk
+    finally:
+        await source.aclose()
+
+
+def async_provider_stream(providers: List[Dict], messages: List[Dict[str, str]], *,
+                          temperature: float = 0.2) -> AsyncIterator[str]:
+    if hedging_enabled(providers):
+        return async_budgeted_stream(async_hedged_stream(providers, messages, temperature=temperature))
+    return async_budgeted_stream(async_failover_stream(providers, messages, temperature=temperature))
+
+
+_background_tasks = set()
+
+
+async def _drive(flight: Flight, providers: List[Dict], messages: List[Dict[str, str]],
+                 temperature: float) -> None:
+    """ai_inflight._drive 的事件循环版本：驱动同一个注册表中的 Flight。"""
+    error = None
+    stream = async_provider_stream(providers, messages, temperature=temperature)
+    try:
+        async for chunk in stream:
+            flight.publish(chunk)
+    except AIServiceError as exc:
+        error = exc
+    except asyncio.CancelledError:
+        if flight.abandoned():
+            # 订阅者全部断开时由 on_abandoned 取消本任务，属于正常结束
+            error = AIServiceError('客户端已断开，已停止生成。')
+            return
+        error = AIServiceError('生成已取消。')
+        raise
+    except Exception as exc:
+        error = AIServiceError(f'AI 服务调用失败: {exc}')
+    finally:
+        await stream.aclose()
+        finish_flight(flight, error)
+
+
+async def _follow(flight: Flight) -> AsyncIterator[str]:
+    """
+    在事件循环中订阅 Flight，无论它由任务还是线程（如预取）驱动：发布方经 call_soon_threadsafe 唤醒本协程，
+    等待期间不占用任何线程。
+    """
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def wake() -> None:
+        try:
+            loop.call_soon_threadsafe(changed.set)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+    flight.add_listener(wake)
+    flight.attach()
+    index = 0
+    try:
+        while True:
+            changed.clear()
+            pending, finished, error = flight.read(index)
+            index += len(pending)
+            for chunk in pending:
+                yield chunk
+            if finished:
+                if error is not None:
+                    raise error
+                return
+            if not pending:
+                await changed.wait()
+    finally:
+        flight.remove_listener(wake)
+        flight.detach()
+
+
+def async_coalesced_stream(provider: Dict, messages: List[Dict[str, str]], *, temperature: float = 0.2,
+                           fallbacks: Sequence[Dict] = ()) -> AsyncIterator[str]:
+    """ai_inflight.coalesced_stream 的异步版本，与线程驱动的 Flight（含预取）共用注册表。"""
+    def start(flight: Flight) -> None:
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(_drive(flight, [provider, *fallbacks], messages, temperature))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+        def abandon() -> None:
+            _append_debug_log('coalesce.abandoned', {'fingerprint': flight.key, 'transport': 'asyncio'})
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:  # 事件循环已关闭
+                pass
+
+        flight.on_abandoned(abandon)
+
+    flight, leader = join_or_start(prompt_fingerprint(provider, messages, temperature), 0, start)
+    record_cache('ai_coalesce', not leader)
+    if not leader:
+        _append_debug_log('coalesce.join', {'fingerprint': flight.key, 'model': provider.get('model'),
+                                            'transport': 'asyncio'})
+    return _follow(flight)
+
+
+################################
+# ASGI Application
+################################
+
+@functools.lru_cache(maxsize=1)
+def _get_flask_app():
+    from app import app as flask_app
+    return flask_app
+
+
+def _prepare_run_sync(flask_app, scope, body: bytes) -> Tuple[Optional[Dict], Optional[Tuple[str, int]]]:
+    """
+    在 Flask 的请求上下文中处理原请求（同样的请求头、Cookie 与正文）：登录校验走应用自己的会话接口，
+    与同步路由的 login_required 一致，再调用 prepare_ai_run 组装上游调用参数。
+    """
+    from flask import request
+
+    from blueprints.ai import prepare_ai_run
+    from blueprints.auth import get_user_id, is_logged_in
+
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope.get('headers', [])]
+    host = next((value for name, value in headers if name.lower() == 'host'), 'localhost')
+    root_path = scope.get('root_path', '')
+    client = scope.get('client') or ('127.0.0.1', 0)
+    with flask_app.test_request_context(
+            scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path'],
+            base_url=f"{scope.get('scheme', 'http')}://{host}{root_path}",
+            method=scope['method'],
+            headers=headers,
+            query_string=scope.get('query_string', b''),
+            data=body,
+            environ_base={'REMOTE_ADDR': client[0]}):
+        if not is_logged_in():
+            return None, ('请先登录后再访问该页面', 401)
+        payload = request.get_json(silent=True)
+        return prepare_ai_run(get_user_id(), payload if isinstance(payload, dict) else {})
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return body
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def _send_json(send, payload: Dict, status: int) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _wait_for_disconnect(receive) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def run_ai_async(scope, receive, send) -> None:
+    flask_app = _get_flask_app()
+    body = await _read_body(receive)
+    loop = asyncio.get_running_loop()
+    prepared, error = await loop.run_in_executor(
+        None, functools.partial(_prepare_run_sync, flask_app, scope, body)
+    )
+    if error:
+        message, status = error
+        await _send_json(send, {'error': message}, status)
+        return
+    if prepared['pregenerated']:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8')]
+        })
+        await send({'type': 'http.response.body', 'body': prepared['pregenerated'].encode('utf-8')})
+        return
+
+    if flask_app.config.get('AI_COALESCE_ENABLED', True):
+        source = async_coalesced_stream(prepared['provider'], prepared['messages'],
+                                        temperature=prepared['temperature'], fallbacks=prepared['fallbacks'])
+    else:
+        source = async_provider_stream([prepared['provider'], *prepared['fallbacks']], prepared['messages'],
+                                       temperature=prepared['temperature'])
+
+    async def pump():
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8')]
+        })
+        try:
+            async for chunk in source:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        except AIServiceError as exc:
+            await send({'type': 'http.response.body', 'body': f"\n\n[ERROR] {exc}".encode('utf-8'),
+                        'more_body': True})
+        finally:
+            await source.aclose()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    pump_task = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+    done, _ = await asyncio.wait({pump_task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    if pump_task in done:
+        watcher.cancel()
+        pump_task.result()
+    else:
+        record_cancellation(CLIENT_DISCONNECT)
+        pump_task.cancel()
+        try:
+            await pump_task
+        except asyncio.CancelledError:
+            pass
+
+
+async def asgi_app(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await _close_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    if scope['path'] == '/ai/run' and scope['method'] == 'POST':
+        await run_ai_async(scope, receive, send)
+        return
+    if WsgiToAsgi is not None:
+        await WsgiToAsgi(_get_flask_app())(scope, receive, send)
+        return
+    await _send_json(send, {'error': '该路径由 Flask 主进程提供。'}, 404)
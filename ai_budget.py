@@ -0,0 +1,173 @@
+"""
+单次 AI 生成的时间与输出预算，以及取消原因统计。
+
+/ai/run 的上游分片来源都经过 budgeted_stream：超过 AI_RUN_TIME_BUDGET 秒或输出超过 AI_RUN_MAX_CHARS 个字符时
+立即关闭上游迭代器（连接随之断开、调试日志停止写入），并抛出 StreamBudgetExceeded，由调用方按普通错误输出。
+时间预算不依赖分片到达：上游卡住不再输出时，截止时间一到同样结束。同步路径把截止时间登记到所有生成共用的
+一个计时线程，到期时经 UpstreamCancel 直接断开上游连接，读取方（请求线程或 Flight 驱动线程）随即返回；
+异步路径对每次读取设置剩余时间的超时。
+客户端断开、预算耗尽导致的提前结束都通过 record_cancellation 计数，在 /ai/metrics 中展示。
+"""
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from ai_service import AIServiceError, UpstreamCancel, _append_debug_log
+
+CLIENT_DISCONNECT = 'client_disconnect'
+TIME_BUDGET = 'time_budget'
+OUTPUT_BUDGET = 'output_budget'
+
+_settings = {
+    'time_budget': 120.0,
+    'max_chars': 8000,
+}
+_cancellations: Dict[str, int] = {}
+_cancellations_lock = threading.Lock()
+
+
+class StreamBudgetExceeded(AIServiceError):
+    """Raised when a generation runs past its time or output budget."""
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def configure_stream_budget(config) -> None:
+    """从 Flask 配置读取单次生成的时间与输出预算（在 app.py 中调用一次，0 表示不限制）。"""
+    _settings['time_budget'] = float(config.get('AI_RUN_TIME_BUDGET', _settings['time_budget']))
+    _settings['max_chars'] = int(config.get('AI_RUN_MAX_CHARS', _settings['max_chars']))
+
+
+def stream_budget() -> Dict:
+    return dict(_settings)
+
+
+def record_cancellation(reason: str) -> None:
+    with _cancellations_lock:
+        _cancellations[reason] = _cancellations.get(reason, 0) + 1
+
+
+def cancellation_counts() -> Dict[str, int]:
+    with _cancellations_lock:
+        return dict(_cancellations)
+
+
+class BudgetTracker:
+    """按分片累计耗时与字符数，同步与异步两条路径共用。"""
+
+    def __init__(self):
+        time_budget = _settings['time_budget']
+        self.deadline = time.monotonic() + time_budget if time_budget > 0 else None
+        self.max_chars = _settings['max_chars']
+        self.chars = 0
+        self._time_error: Optional[StreamBudgetExceeded] = None
+        self._lock = threading.Lock()
+
+    def remaining(self) -> Optional[float]:
+        """距截止时间的秒数（不小于 0），未设时间预算时返回 None。"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def check(self, chunk: str) -> None:
+        self.chars += len(chunk)
+        if self.max_chars > 0 and self.chars > self.max_chars:
+            raise self._exceeded(OUTPUT_BUDGET, f'输出已超过 {self.max_chars} 字的单次上限，已停止生成。')
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.expire()
+
+    def expire(self) -> None:
+        """截止时间已到（等待下一个分片超时）。"""
+        raise self.time_exceeded()
+
+    def time_exceeded(self) -> StreamBudgetExceeded:
+        """超时错误；计时线程与读取方都可能发现超时，只记录一次。"""
+        with self._lock:
+            if self._time_error is None:
+                self._time_error = self._exceeded(
+                    TIME_BUDGET, f'生成时间超过 {_settings["time_budget"]:.0f} 秒的单次上限，已停止生成。'
+                )
+            return self._time_error
+
+    def _exceeded(self, reason: str, message: str) -> StreamBudgetExceeded:
+        record_cancellation(reason)
+        _append_debug_log('budget.exceeded', {'reason': reason, 'chars': self.chars})
+        return StreamBudgetExceeded(message, reason)
+
+
+def _close(iterator) -> None:
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+class _Deadlines:
+    """按截止时间依次调用回调的计时线程，所有同步生成共用一个，首次登记时启动。"""
+
+    def __init__(self):
+        self._heap: List[list] = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def call_at(self, deadline: float, callback: Callable[[], None]) -> list:
+        """在 time.monotonic() 到达 deadline 时调用 callback()，返回可交给 cancel() 的句柄。"""
+        entry = [deadline, next(self._sequence), callback]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ai-budget-deadlines', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    def cancel(self, entry: list) -> None:
+        with self._cond:
+            entry[2] = None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                # 已取消的条目留在堆中，到达堆顶时丢弃
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                callback = heapq.heappop(self._heap)[2]
+            try:
+                callback()
+            except Exception as exc:  # 计时线程不能因单个回调失败而退出
+                _append_debug_log('budget.deadline_error', {'error': str(exc)})
+
+
+_deadlines = _Deadlines()
+
+
+def budgeted_stream(source: Iterable[str], cancel: UpstreamCancel) -> Iterator[str]:
+    """
+    包装上游分片迭代器，超出预算时关闭上游并抛出 StreamBudgetExceeded。
+
+    cancel 须是 source 读取上游时使用的 UpstreamCancel：截止时间一到由计时线程取消它，阻塞中的读取随即抛出超时错误。
+    """
+    tracker = BudgetTracker()
+    iterator = iter(source)
+    timer = None
+    if tracker.deadline is not None:
+        timer = _deadlines.call_at(tracker.deadline, lambda: cancel.cancel(tracker.time_exceeded()))
+    try:
+        for chunk in iterator:
+            tracker.check(chunk)
+            yield chunk
+    finally:
+        if timer is not None:
+            _deadlines.cancel(timer)
+        _close(iterator)
@@ -0,0 +1,264 @@
+"""
+AI 供应商熔断与故障转移。
+
+每个供应商配置（base_url + model + API 密钥）维护一个 closed/open/half-open 状态机：连续的上游错误或首包过慢会让
+熔断器打开，打开期间请求立即失败（毫秒级），等待时间按带抖动的指数退避增长；到期后只放行一个探测
+请求（half-open），成功则恢复，失败则再次打开。熔断器按密钥区分，某个用户的密钥被限流或额度耗尽
+不会让同一端点上其他用户的请求也被拒绝。failover_stream 按顺序尝试用户的可用配置。
+
+熔断判断（BreakerCall）与故障转移决策（FailoverPlan）不涉及 I/O，同步包装（本模块）与 ai_async 的异步包装
+调用同一份逻辑，只在读取上游的方式上不同。
+"""
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ai_metrics import provider_key
+from ai_service import (
+    AIServiceError,
+    AIUpstreamError,
+    UpstreamCancel,
+    _append_debug_log,
+    api_key_digest,
+    stream_chat_completion,
+)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_settings = {
+    'failure_threshold': 3,
+    'base_backoff': 5.0,
+    'max_backoff': 300.0,
+    'slow_first_chunk_seconds': 12.0,
+}
+
+
+class ProviderUnavailableError(AIUpstreamError):
+    """Raised without contacting the provider while its circuit is open."""
+
+
+def configure_breakers(config) -> None:
+    """从 Flask 配置读取熔断参数（在 app.py 中调用一次）。"""
+    _settings['failure_threshold'] = int(config.get('AI_BREAKER_FAILURE_THRESHOLD', _settings['failure_threshold']))
+    _settings['base_backoff'] = float(config.get('AI_BREAKER_BASE_BACKOFF', _settings['base_backoff']))
+    _settings['max_backoff'] = float(config.get('AI_BREAKER_MAX_BACKOFF', _settings['max_backoff']))
+    _settings['slow_first_chunk_seconds'] = float(
+        config.get('AI_BREAKER_SLOW_SECONDS', _settings['slow_first_chunk_seconds'])
+    )
+
+
+def breaker_settings() -> Dict:
+    return dict(_settings)
+
+
+class CircuitBreaker:
+    """单个供应商配置的健康状态机，线程安全。key 为 breaker_key()，含密钥摘要，不对外展示。"""
+
+    def __init__(self, key: Tuple[str, str, str], provider_id: Optional[int] = None):
+        self.key = key
+        self.provider_id = provider_id
+        self.state = CLOSED
+        self.failures = 0
+        self.open_count = 0
+        self.open_until = 0.0
+        self.last_error: Optional[str] = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= self.open_until:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.open_count = 0
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self, reason: str) -> None:
+        with self._lock:
+            self.last_error = reason
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or self.failures >= _settings['failure_threshold']:
+                self._open()
+
+    def _open(self) -> None:
+        self.open_count += 1
+        ceiling = min(_settings['max_backoff'], _settings['base_backoff'] * (2 ** (self.open_count - 1)))
+        # 等抖动：退避区间取 [ceiling/2, ceiling]，避免大量 worker 同时探测
+        backoff = ceiling / 2 + random.uniform(0, ceiling / 2)
+        self.state = OPEN
+        self.open_until = time.monotonic() + backoff
+        _append_debug_log('breaker.open', {
+            'base_url': self.key[0],
+            'model': self.key[1],
+            'provider_id': self.provider_id,
+            'backoff_seconds': round(backoff, 2),
+            'open_count': self.open_count,
+            'error': self.last_error
+        })
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'open_count': self.open_count,
+                'retry_after': round(self.retry_after(), 1) if self.state == OPEN else 0,
+                'last_error': self.last_error
+            }
+
+
+_breakers: Dict[Tuple[str, str, str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_key(provider: Dict) -> Tuple[str, str, str]:
+    """熔断器的键：端点、模型与 API 密钥的摘要。"""
+    return (*provider_key(provider), api_key_digest(provider.get('api_key')))
+
+
+def get_breaker(provider: Dict) -> CircuitBreaker:
+    key = breaker_key(provider)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(key, provider.get('id'))
+            _breakers[key] = breaker
+        elif breaker.provider_id is None:
+            breaker.provider_id = provider.get('id')
+        return breaker
+
+
+class BreakerCall:
+    """
+    一次受熔断保护的上游调用的记账：构造时检查熔断器（打开时抛出 ProviderUnavailableError），
+    读取方在每个分片、失败与正常结束时通知它。
+    """
+
+    def __init__(self, provider: Dict):
+        self.breaker = get_breaker(provider)
+        if not self.breaker.allow_request():
+            raise ProviderUnavailableError(
+                f'AI 服务暂时不可用（{self.breaker.retry_after():.0f} 秒后重试）: '
+                f'{self.breaker.last_error or "连续调用失败"}'
+            )
+        self.started = time.monotonic()
+        self.first_chunk_at: Optional[float] = None
+
+    def chunk(self) -> None:
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.monotonic()
+
+    def failed(self, exc: BaseException) -> None:
+        if isinstance(exc, AIUpstreamError):
+            self.breaker.record_failure(str(exc)[:200])
+        else:
+            # 客户端断开或鉴权类错误不代表供应商故障，只需释放半开探测名额
+            self.breaker.release_probe()
+
+    def succeeded(self) -> None:
+        first_chunk_latency = (self.first_chunk_at or time.monotonic()) - self.started
+        if first_chunk_latency > _settings['slow_first_chunk_seconds']:
+            self.breaker.record_failure(f'首包耗时 {first_chunk_latency:.1f}s')
+        else:
+            self.breaker.record_success()
+
+
+class FailoverPlan:
+    """
+    按顺序尝试 providers 的决策：某个供应商失败后是否改用下一个。
+
+    已经产出分片后再失败不会切换供应商（否则前端会看到重复内容），错误原样抛出。
+    """
+
+    def __init__(self, providers: List[Dict]):
+        self.providers = providers
+        self.last_error: Optional[AIServiceError] = None
+
+    def should_retry(self, index: int, exc: AIUpstreamError, produced: bool) -> bool:
+        if produced:
+            return False
+        self.last_error = exc
+        if index + 1 < len(self.providers):
+            _append_debug_log('breaker.failover', {
+                'from': provider_key(self.providers[index]),
+                'to': provider_key(self.providers[index + 1]),
+                'error': str(exc)[:200]
+            })
+        return True
+
+    def exhausted(self) -> None:
+        """全部供应商都失败时抛出最后一个错误。"""
+        if self.last_error is not None:
+            raise self.last_error
+
+
+def guarded_stream(provider: Dict, messages: List[Dict[str, str]], *, temperature: float = 0.2,
+                   cancel: Optional[UpstreamCancel] = None) -> Iterable[str]:
+    """带熔断保护的 stream_chat_completion：熔断打开时立即抛出 ProviderUnavailableError。"""
+    call = BreakerCall(provider)
+    try:
+        for chunk in stream_chat_completion(provider, messages, temperature=temperature, cancel=cancel):
+            call.chunk()
+            yield chunk
+    except BaseException as exc:
+        call.failed(exc)
+        raise
+    call.succeeded()
+
+
+def failover_stream(providers: List[Dict], messages: List[Dict[str, str]], *,
+                    temperature: float = 0.2, cancel: Optional[UpstreamCancel] = None) -> Iterable[str]:
+    """依次尝试 providers，直到某个供应商开始输出（见 FailoverPlan）。"""
+    plan = FailoverPlan(providers)
+    for index, provider in enumerate(providers):
+        produced = False
+        try:
+            for chunk in guarded_stream(provider, messages, temperature=temperature, cancel=cancel):
+                produced = True
+                yield chunk
+            return
+        except AIUpstreamError as exc:
+            if not plan.should_retry(index, exc, produced):
+                raise
+    plan.exhausted()
+
+
+def breaker_states() -> Dict[str, Dict]:
+    """
+    各熔断器的状态，以 base_url#model#配置 ID 标识（缺少 ID 时用序号区分同一端点的不同密钥），
+    输出中不含密钥及其摘要。
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    states: Dict[str, Dict] = {}
+    for breaker in breakers:
+        label = f'{breaker.key[0]}#{breaker.key[1]}'
+        suffix = breaker.provider_id if breaker.provider_id is not None else 'key'
+        name, ordinal = f'{label}#{suffix}', 1
+        while name in states:
+            ordinal += 1
+            name = f'{label}#{suffix}-{ordinal}'
+        states[name] = breaker.snapshot()
+    return states
@@ -0,0 +1,187 @@
+"""
+AI 供应商后台健康检查。
+
+保存配置时不再在表单请求中同步验证：路由只把配置标记为待验证并调用 request_check，真正的连通性
+测试在线程池中并发执行，结果写回 ai_providers 的 is_valid / last_error / last_latency_ms。
+调度线程按 AI_HEALTHCHECK_INTERVAL 周期刷新所有配置，最近已验证过的配置会被跳过。
+
+每个 worker 进程都会运行调度线程；探测前先用条件 UPDATE 占用配置（check_started_at），占用成功的进程才发请求，
+其余进程跳过，因此同一配置同一时间只被探测一次，不会用用户的密钥重复请求。占用在写回结果时释放，
+进程中途退出时超过占用时限（至少 60 秒）后由下一轮调度接手。结果只在配置的地址、模型与密钥未被修改时写回。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from ai_circuit import get_breaker
+from ai_service import AIServiceError, decrypt_provider_key, validate_provider_connection
+from database import get_db
+
+_state = {
+    'secret': None,
+    'interval': 600,
+    'timeout': 15,
+    'executor': None,
+    'scheduler': None,
+}
+_pending_ids = set()
+_pending_lock = threading.Lock()
+_stop_event = threading.Event()
+
+
+def init_health_checker(app) -> None:
+    """读取配置并启动线程池与周期调度线程（在 app.py 中调用一次）。"""
+    _state['secret'] = app.config.get('SECRET_KEY')
+    _state['interval'] = int(app.config.get('AI_HEALTHCHECK_INTERVAL', 600))
+    _state['timeout'] = int(app.config.get('AI_HEALTHCHECK_TIMEOUT', 15))
+    if _state['executor'] is None:
+        _state['executor'] = ThreadPoolExecutor(
+            max_workers=int(app.config.get('AI_HEALTHCHECK_WORKERS', 8)),
+            thread_name_prefix='ai-health'
+        )
+    if _state['interval'] > 0 and _state['scheduler'] is None:
+        scheduler = threading.Thread(target=_schedule_loop, name='ai-health-scheduler', daemon=True)
+        _state['scheduler'] = scheduler
+        scheduler.start()
+
+
+def _load_provider(provider_id: int) -> Optional[Dict]:
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT id, base_url, model, api_key_encrypted, updated_at FROM ai_providers WHERE id=?',
+              (provider_id,))
+    row = c.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def _claim_seconds() -> int:
+    # 覆盖一次探测（含超时）的时长，超过后视为占用进程已退出
+    return max(60, _state['timeout'] * 2)
+
+
+def _claim_check(provider_id: int) -> bool:
+    """占用配置的本轮探测；其他进程正在探测时返回 False。"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        UPDATE ai_providers SET check_started_at=CURRENT_TIMESTAMP
+        WHERE id=? AND (check_started_at IS NULL OR check_started_at < datetime('now', ?))
+    ''', (provider_id, f'-{_claim_seconds()} seconds'))
+    claimed = c.rowcount == 1
+    conn.commit()
+    conn.close()
+    return claimed
+
+
+def _release_claim(provider_id: int) -> None:
+    conn = get_db()
+    conn.execute('UPDATE ai_providers SET check_started_at=NULL WHERE id=?', (provider_id,))
+    conn.commit()
+    conn.close()
+
+
+def _record_result(provider: Dict, is_valid: bool, message: str, latency_ms: Optional[int]) -> None:
+    conn = get_db()
+    c = conn.cursor()
+    # 只在探测所用的地址、模型与密钥未被修改时写回；修改后会有新的检查覆盖
+    # （不比较 updated_at：它只精确到秒，且激活等不改变配置内容的操作也不应丢弃结果）
+    c.execute('''
+        UPDATE ai_providers
+        SET is_valid=?,
+            last_verified_at=CURRENT_TIMESTAMP,
+            last_error=?,
+            last_latency_ms=?,
+            check_pending=0,
+            check_started_at=NULL
+        WHERE id=? AND base_url IS ? AND model IS ? AND api_key_encrypted IS ?
+    ''', (1 if is_valid else 0, None if is_valid else message[:500], latency_ms,
+          provider['id'], provider['base_url'], provider['model'], provider['api_key_encrypted']))
+    conn.commit()
+    conn.close()
+
+
+def check_provider(provider: Dict) -> bool:
+    """验证单个配置并写回结果，返回是否可用。"""
+    try:
+        api_key = decrypt_provider_key(provider, secret=_state['secret'])
+    except AIServiceError as exc:
+        _record_result(provider, False, str(exc), None)
+        return False
+
+    payload = {
+        'id': provider['id'],
+        'base_url': provider['base_url'],
+        'model': provider['model'],
+        'api_key': api_key
+    }
+    started = time.monotonic()
+    is_valid, message = validate_provider_connection(payload, timeout=_state['timeout'])
+    latency_ms = int((time.monotonic() - started) * 1000)
+    if is_valid:
+        get_breaker(payload).record_success()
+    _record_result(provider, is_valid, message, latency_ms)
+    return is_valid
+
+
+def _run_check(provider_id: int) -> None:
+    # 开始执行即移出队列：探测期间配置被修改时，新的 request_check 会再排一次，探测新配置
+    with _pending_lock:
+        _pending_ids.discard(provider_id)
+    try:
+        if not _claim_check(provider_id):
+            return
+        try:
+            provider = _load_provider(provider_id)
+            if provider:
+                check_provider(provider)
+        except Exception:
+            _release_claim(provider_id)
+            raise
+    except Exception as exc:
+        print(f"AI health check failed for provider {provider_id}: {exc}")
+
+
+def request_check(provider_id: int) -> bool:
+    """
+    将配置加入后台验证队列；同一配置已在队列中时不重复提交。
+
+    Returns:
+        bool: 是否成功提交（未调用 init_health_checker 时返回 False）
+    """
+    executor = _state['executor']
+    if executor is None:
+        return False
+    with _pending_lock:
+        if provider_id in _pending_ids:
+            return True
+        _pending_ids.add(provider_id)
+    executor.submit(_run_check, provider_id)
+    return True
+
+
+def run_health_checks(max_age_seconds: Optional[int] = None) -> int:
+    """提交一轮全量检查，跳过 max_age_seconds 内已验证过的配置，返回提交数量。"""
+    if max_age_seconds is None:
+        max_age_seconds = _state['interval'] // 2
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT id FROM ai_providers
+        WHERE check_pending=1
+           OR last_verified_at IS NULL
+           OR last_verified_at < datetime('now', ?)
+    ''', (f'-{int(max_age_seconds)} seconds',))
+    provider_ids = [row['id'] for row in c.fetchall()]
+    conn.close()
+    return sum(1 for provider_id in provider_ids if request_check(provider_id))
+
+
+def _schedule_loop() -> None:
+    while not _stop_event.is_set():
+        try:
+            run_health_checks()
+        except Exception as exc:
+            print(f"AI health check sweep failed: {exc}")
+        _stop_event.wait(_state['interval'])
@@ -0,0 +1,198 @@
+"""
+AI 对冲请求（hedged requests）。
+
+开启 AI_HEDGE_ENABLED 且用户有多个可用配置时，先向首选供应商发起请求；若它在对冲延迟内仍未产出首个分片，
+再向下一个可用供应商发起第二个请求，谁先输出就采用谁，另一个立即取消（同步路径直接断开它的上游连接）。对冲延迟取首选供应商首包耗时的 p95
+（由 ai_metrics 统计，限制在 AI_HEDGE_MIN_DELAY ~ AI_HEDGE_DELAY 之间）；p95 已超过 AI_HEDGE_DELAY 时
+说明它大概率赶不上，直接同时发起两个请求。快速路径上只有一个上游请求，不会成倍增加调用成本。
+
+何时发起第二路、谁胜出、何时结束由 HedgeRace 决定，它不涉及线程或事件循环：hedged_stream 用线程与队列、
+ai_async 用任务与 asyncio.Queue 驱动同一个状态机。
+"""
+import queue
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ai_budget import budgeted_stream
+from ai_circuit import failover_stream
+from ai_metrics import ttft_percentile
+from ai_service import AIServiceError, UpstreamCancel, _append_debug_log
+
+_settings = {
+    'enabled': False,
+    'max_delay': 2.0,
+    'min_delay': 0.3,
+    'min_samples': 20,
+}
+
+# 各路请求交给 HedgeRace 的事件类型
+CHUNK = 'chunk'
+DONE = 'done'
+ERROR = 'error'
+
+# HedgeRace.on_event 返回给驱动方的动作
+DELIVER = 'deliver'
+SKIP = 'skip'
+FINISH = 'finish'
+HEDGE = 'hedge'
+
+
+def configure_hedging(config) -> None:
+    """从 Flask 配置读取对冲参数（在 app.py 中调用一次）。"""
+    _settings['enabled'] = bool(config.get('AI_HEDGE_ENABLED', _settings['enabled']))
+    _settings['max_delay'] = float(config.get('AI_HEDGE_DELAY', _settings['max_delay']))
+    _settings['min_delay'] = float(config.get('AI_HEDGE_MIN_DELAY', _settings['min_delay']))
+    _settings['min_samples'] = int(config.get('AI_HEDGE_MIN_SAMPLES', _settings['min_samples']))
+
+
+def hedging_enabled(providers: List[Dict]) -> bool:
+    return _settings['enabled'] and len(providers) > 1
+
+
+def hedge_delay(provider: Dict) -> float:
+    """首选供应商的对冲延迟（秒），0 表示立即同时发起对冲请求。"""
+    p95_ms = ttft_percentile(provider, 0.95, min_samples=_settings['min_samples'])
+    if p95_ms is None:
+        return _settings['max_delay']
+    p95 = p95_ms / 1000
+    if p95 > _settings['max_delay']:
+        return 0.0
+    return max(_settings['min_delay'], p95)
+
+
+class HedgeRace:
+    """
+    对冲请求的状态机。驱动方发起首路请求，在 wait_timeout() 内等待各路事件并交给 on_event()；
+    超时或 on_event 返回 HEDGE 时调用 fire() 发起第二路。一旦有胜出者（winner 非空），其余各路应立即取消。
+    """
+
+    def __init__(self, providers: List[Dict]):
+        self.primary, self.others = providers[0], providers[1:]
+        self.deadline = time.monotonic() + hedge_delay(self.primary)
+        self.started = 1
+        self.winner: Optional[int] = None
+        self.failed = set()
+
+    def wait_timeout(self) -> Optional[float]:
+        """等待下一个事件的最长秒数；0 表示应立即发起对冲，None 表示无限等待。"""
+        if self.started > 1 or self.winner is not None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def fire(self, reason: str) -> Tuple[int, List[Dict]]:
+        """记录发起第二路请求，返回它的序号与要依次尝试的供应商。"""
+        self.started = 2
+        _append_debug_log('hedge.fire', {'model': self.primary.get('model'), 'to': self.others[0].get('model'),
+                                         'reason': reason})
+        return 1, self.others
+
+    def on_event(self, index: int, kind: str, value) -> str:
+        """处理第 index 路的事件，返回 DELIVER / SKIP / FINISH / HEDGE；无法恢复的错误直接抛出。"""
+        if self.winner is None and kind == CHUNK:
+            self.winner = index
+            if self.started > 1:
+                winner = self.primary if index == 0 else self.others[0]
+                _append_debug_log('hedge.win', {'winner': winner.get('model')})
+        if self.winner is not None and index != self.winner:
+            return SKIP
+        if kind == CHUNK:
+            return DELIVER
+        if kind == DONE:
+            # 胜出者正常结束；没有任何输出就结束的一路同样视为胜出
+            return FINISH
+        if self.winner is not None:
+            raise value
+        self.failed.add(index)
+        if self.started == 1:
+            return HEDGE
+        if len(self.failed) == self.started:
+            raise value
+        return SKIP
+
+
+class _Attempt:
+    """在线程中驱动一路 failover_stream，把分片放入共享队列；cancel() 立即断开这一路的上游连接，线程随之退出。"""
+
+    def __init__(self, index: int, providers: List[Dict], messages: List[Dict[str, str]], temperature: float,
+                 events: queue.Queue, scope: UpstreamCancel):
+        self.index = index
+        self.providers = providers
+        self.scope = scope
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(messages, temperature, events),
+            name=f'ai-hedge-{index}',
+            daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, messages: List[Dict[str, str]], temperature: float, events: queue.Queue) -> None:
+        stream = failover_stream(self.providers, messages, temperature=temperature, cancel=self.scope)
+        try:
+            for chunk in stream:
+                events.put((self.index, CHUNK, chunk))
+            events.put((self.index, DONE, None))
+        except AIServiceError as exc:
+            events.put((self.index, ERROR, exc))
+        except Exception as exc:  # 与 ai_inflight 一致：线程异常必须通知等待方
+            events.put((self.index, ERROR, AIServiceError(f'AI 服务调用失败: {exc}')))
+        finally:
+            stream.close()
+
+    def cancel(self) -> None:
+        self.scope.cancel(AIServiceError('对冲请求已取消。'))
+
+
+def hedged_stream(providers: List[Dict], messages: List[Dict[str, str]], *,
+                  temperature: float = 0.2, cancel: Optional[UpstreamCancel] = None) -> Iterable[str]:
+    """
+    与 failover_stream 输出相同的分片迭代器：首选供应商超过对冲延迟仍无输出时，
+    向其余供应商（按 failover 顺序）发起第二路请求，先输出者胜出。cancel 被取消时各路一并断开。
+    """
+    cancel = cancel or UpstreamCancel()
+    events: queue.Queue = queue.Queue()
+    race = HedgeRace(providers)
+    attempts = [_Attempt(0, [race.primary], messages, temperature, events, cancel.child())]
+
+    def fire(reason: str) -> None:
+        index, candidates = race.fire(reason)
+        attempts.append(_Attempt(index, candidates, messages, temperature, events, cancel.child()))
+
+    try:
+        while True:
+            timeout = race.wait_timeout()
+            if timeout == 0:
+                fire('slow_first_chunk')
+                continue
+            try:
+                index, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            cancel.check()
+            action = race.on_event(index, kind, value)
+            if race.winner is not None:
+                for attempt in attempts:
+                    if attempt.index != race.winner:
+                        attempt.cancel()
+            if action == DELIVER:
+                yield value
+            elif action == FINISH:
+                return
+            elif action == HEDGE:
+                fire('primary_failed')
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+
+def provider_stream(providers: List[Dict], messages: List[Dict[str, str]], *,
+                    temperature: float = 0.2, cancel: Optional[UpstreamCancel] = None) -> Iterable[str]:
+    """
+    /ai/run 使用的上游分片来源：开启对冲且有备选供应商时对冲，否则按顺序故障转移；均受单次生成预算约束。
+    cancel 供调用方在其他线程中提前结束生成（如 Flight 的订阅者全部断开）。
+    """
+    cancel = cancel or UpstreamCancel()
+    if hedging_enabled(providers):
+        return budgeted_stream(hedged_stream(providers, messages, temperature=temperature, cancel=cancel), cancel)
+    return budgeted_stream(failover_stream(providers, messages, temperature=temperature, cancel=cancel), cancel)
@@ -0,0 +1,273 @@
+"""
+AI 请求合流（single-flight）。
+
+同一提示词指纹的并发请求只会打开一个上游流：首个请求创建 Flight 并由后台线程驱动
+上游流式调用（经 ai_circuit 熔断与故障转移），后续相同请求订阅同一个扇出缓冲区，先回放已收到的分片，再跟随新分片。
+最后一个订阅者断开时驱动方立即断开上游连接，不再等下一个分片到达。
+指纹包含 API 密钥摘要，只有使用同一密钥的请求才会合流：生成始终计入各自的密钥，密钥失效或额度耗尽的用户
+也借不到别人的输出。
+带 linger 的 Flight（如预取）成功结束后会在注册表中保留一段时间，期间的相同请求直接回放完整结果。
+ai_async 使用同一个注册表（由事件循环中的任务驱动），同步与异步请求、预取之间都能互相合流。
+"""
+import hashlib
+import json
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from ai_hedge import provider_stream
+from ai_service import AIServiceError, UpstreamCancel, _append_debug_log, api_key_digest
+from metrics import record_cache
+
+# 订阅者等待新分片时的轮询上限，防止驱动线程异常退出导致永久阻塞
+_WAIT_SLICE_SECONDS = 1.0
+
+
+def prompt_fingerprint(provider: Dict, messages: List[Dict[str, str]], temperature: float) -> str:
+    """根据供应商、模型、API 密钥摘要、温度与消息内容计算请求指纹。"""
+    material = json.dumps({
+        'base_url': (provider.get('base_url') or '').rstrip('/'),
+        'model': provider.get('model'),
+        'api_key': api_key_digest(provider.get('api_key')),
+        'temperature': temperature,
+        'messages': messages
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class Flight:
+    """
+    一次上游流式生成的扇出缓冲区，线程安全。
+
+    驱动方可以是线程（同步路径、预取）也可以是事件循环中的任务（ai_async）；订阅方同样两种都可以：
+    同步订阅者在条件变量上等待，异步订阅者注册监听函数，由发布方经 call_soon_threadsafe 唤醒。
+    """
+
+    def __init__(self, key: str, linger: float = 0):
+        self.key = key
+        self.linger = linger
+        self.expires_at: Optional[float] = None
+        self._chunks: List[str] = []
+        self._done = False
+        self._error: Optional[AIServiceError] = None
+        self._callbacks: List[Callable[['Flight'], None]] = []
+        self._listeners: List[Callable[[], None]] = []
+        self._on_abandoned: Optional[Callable[[], None]] = None
+        self._cond = threading.Condition()
+        self.subscribers = 0
+        self._ever_subscribed = False
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def abandoned(self) -> bool:
+        """所有订阅者都已断开且无需保留结果（非预取）时，继续读取上游只会浪费 worker 与 token。"""
+        with self._cond:
+            return self._is_abandoned()
+
+    def _is_abandoned(self) -> bool:
+        return self.linger <= 0 and self._ever_subscribed and self.subscribers == 0 and not self._done
+
+    def on_abandoned(self, handler: Callable[[], None]) -> None:
+        """驱动方登记：最后一个订阅者断开、Flight 被放弃时调用 handler()（在断开方的线程中，不能阻塞）。"""
+        with self._cond:
+            self._on_abandoned = handler
+
+    def expired(self, now: float) -> bool:
+        return self._done and (self.expires_at is None or now >= self.expires_at)
+
+    def add_done_callback(self, callback: Callable[['Flight'], None]) -> None:
+        """上游结束（成功或失败）后调用 callback(flight)；已结束时立即调用。"""
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """每次有新分片或上游结束时调用 listener()（在发布方的线程中，不能阻塞）。"""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[], None]) -> None:
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _notify(self) -> List[Callable[[], None]]:
+        # 调用方持有 _cond；返回的监听函数由调用方在锁外调用
+        self._cond.notify_all()
+        return list(self._listeners)
+
+    def publish(self, chunk: str) -> None:
+        with self._cond:
+            self._chunks.append(chunk)
+            listeners = self._notify()
+        for listener in listeners:
+            listener()
+
+    def finish(self, error: Optional[AIServiceError] = None) -> None:
+        with self._cond:
+            self._done = True
+            self._error = error
+            callbacks, self._callbacks = self._callbacks, []
+            listeners = self._notify()
+        for listener in listeners:
+            listener()
+        for callback in callbacks:
+            callback(self)
+
+    def attach(self) -> None:
+        with self._cond:
+            self.subscribers += 1
+            self._ever_subscribed = True
+
+    def detach(self) -> None:
+        with self._cond:
+            self.subscribers -= 1
+            handler = self._on_abandoned if self._is_abandoned() else None
+        if handler is not None:
+            handler()
+
+    def read(self, index: int) -> Tuple[List[str], bool, Optional[AIServiceError]]:
+        """
+        Returns:
+            tuple: (从 index 起已缓冲的分片, 读完这些分片后是否已结束, 上游错误)
+        """
+        with self._cond:
+            pending = self._chunks[index:]
+            return pending, self._done and index + len(pending) >= len(self._chunks), self._error
+
+    def subscribe(self) -> Iterator[str]:
+        """回放已缓冲的分片后持续跟随，直到上游结束；上游失败时抛出同样的 AIServiceError。"""
+        self.attach()
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self._chunks) and not self._done:
+                        self._cond.wait(_WAIT_SLICE_SECONDS)
+                pending, finished, error = self.read(index)
+                index += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if finished:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self.detach()
+
+
+_flights: Dict[str, Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def finish_flight(flight: Flight, error: Optional[AIServiceError]) -> None:
+    """驱动方结束时调用：成功且带 linger 的 Flight 留在注册表中供回放，其余移出，然后通知订阅者。"""
+    with _flights_lock:
+        if _flights.get(flight.key) is flight:
+            if error is None and flight.linger > 0:
+                flight.expires_at = time.monotonic() + flight.linger
+            else:
+                del _flights[flight.key]
+    flight.finish(error)
+
+
+def _drive(flight: Flight, providers: List[Dict], messages: List[Dict[str, str]], temperature: float,
+           cancel: UpstreamCancel) -> None:
+    error = None
+    stream = provider_stream(providers, messages, temperature=temperature, cancel=cancel)
+    try:
+        for chunk in stream:
+            flight.publish(chunk)
+    except AIServiceError as exc:
+        error = exc
+    except Exception as exc:  # 驱动线程不能悄悄死掉，否则订阅者会一直等待
+        error = AIServiceError(f'AI 服务调用失败: {exc}')
+    finally:
+        stream.close()
+        finish_flight(flight, error)
+
+
+def _evict_expired(now: float) -> None:
+    """清理已过保留期的 Flight，调用方需持有 _flights_lock。"""
+    for key in [key for key, flight in _flights.items() if flight.expired(now)]:
+        del _flights[key]
+
+
+def join_or_start(key: str, linger: float, start: Callable[[Flight], None]) -> Tuple[Flight, bool]:
+    """
+    加入指纹为 key 的进行中（或保留期内）的 Flight；没有时新建并调用 start(flight) 启动驱动方。
+
+    Returns:
+        tuple: (flight, 是否为新建的 leader)
+    """
+    with _flights_lock:
+        now = time.monotonic()
+        flight = _flights.get(key)
+        if flight is not None and flight.expired(now):
+            del _flights[key]
+            flight = None
+        leader = flight is None
+        if leader:
+            _evict_expired(now)
+            flight = Flight(key, linger)
+            _flights[key] = flight
+        else:
+            flight.linger = max(flight.linger, linger)
+    if leader:
+        start(flight)
+    return flight, leader
+
+
+def _thread_starter(providers: List[Dict], messages: List[Dict[str, str]],
+                    temperature: float) -> Callable[[Flight], None]:
+    def start(flight: Flight) -> None:
+        cancel = UpstreamCancel()
+
+        def abandon() -> None:
+            _append_debug_log('coalesce.abandoned', {'fingerprint': flight.key})
+            cancel.cancel(AIServiceError('客户端已断开，已停止生成。'))
+
+        # 在订阅者加入之前登记，避免驱动线程启动前就已断开的订阅者被漏掉
+        flight.on_abandoned(abandon)
+        threading.Thread(
+            target=_drive,
+            args=(flight, providers, messages, temperature, cancel),
+            name=f'ai-flight-{flight.key[:8]}',
+            daemon=True
+        ).start()
+    return start
+
+
+def prefetch(provider: Dict, messages: List[Dict[str, str]], *, temperature: float = 0.2,
+             fallbacks: Sequence[Dict] = (), linger: float = 600) -> Optional[Flight]:
+    """
+    在后台预先生成，不订阅结果；成功后保留 linger 秒供后续相同请求直接回放。
+
+    Returns:
+        新启动的 Flight；已有相同指纹的 Flight 时返回 None（仅延长其保留期）。
+    """
+    key = prompt_fingerprint(provider, messages, temperature)
+    flight, leader = join_or_start(key, linger, _thread_starter([provider, *fallbacks], messages, temperature))
+    return flight if leader else None
+
+
+def coalesced_stream(provider: Dict, messages: List[Dict[str, str]], *, temperature: float = 0.2,
+                     fallbacks: Sequence[Dict] = ()) -> Iterator[str]:
+    """
+    返回与 stream_chat_completion 输出格式一致的分片迭代器；相同指纹的并发请求共享一次上游调用。
+    指纹只取首选供应商，fallbacks 仅在首选供应商不可用时由驱动线程依次尝试。
+    """
+    key = prompt_fingerprint(provider, messages, temperature)
+    flight, leader = join_or_start(key, 0, _thread_starter([provider, *fallbacks], messages, temperature))
+    record_cache('ai_coalesce', not leader)
+    if not leader:
+        _append_debug_log('coalesce.join', {
+            'fingerprint': flight.key,
+            'model': provider.get('model'),
+            'subscribers': flight.subscribers + 1
+        })
+    return flight.subscribe()
@@ -0,0 +1,247 @@
+"""
+AI 流式调用的延迟与吞吐指标。
+
+每次上游调用由 StreamTimer 记录建连耗时、首包耗时（TTFT）、分片间隔、总耗时、分片/字符数与结果，
+结束时汇总到按供应商（base_url + model）划分的进程内直方图。分位数由直方图桶线性插值估算，
+供管理页展示、超时设置与对冲请求（hedging）决策使用。每个分片近似一个 token，吞吐以分片/秒计。
+"""
+import bisect
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+OK = 'ok'
+UPSTREAM_ERROR = 'upstream_error'
+CLIENT_ERROR = 'client_error'
+CANCELLED = 'cancelled'
+
+# 直方图桶上界（毫秒 / 分片每秒），超出最后一个上界的样本落入溢出桶
+LATENCY_BUCKETS_MS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000,
+                      30000, 60000)
+GAP_BUCKETS_MS = (5, 10, 25, 50, 100, 200, 400, 800, 1600, 3200, 6400)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+
+def provider_key(provider: Dict) -> Tuple[str, str]:
+    return (provider.get('base_url') or '').rstrip('/'), provider.get('model') or ''
+
+
+class Histogram:
+    """固定桶直方图，由 ProviderStats 加锁访问。"""
+
+    def __init__(self, bounds: Iterable[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> Optional[float]:
+        """按桶内线性插值估算分位数；溢出桶按最后一个上界计。"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if not bucket_count:
+                continue
+            if cumulative + bucket_count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * max(0.0, rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return float(self.bounds[-1])
+
+    def copy(self) -> 'Histogram':
+        clone = Histogram(self.bounds)
+        clone.counts = list(self.counts)
+        clone.count = self.count
+        clone.sum = self.sum
+        return clone
+
+    def snapshot(self) -> Dict:
+        return {
+            'count': self.count,
+            'avg': round(self.sum / self.count, 1) if self.count else None,
+            'p50': _rounded(self.percentile(0.5)),
+            'p95': _rounded(self.percentile(0.95)),
+            'p99': _rounded(self.percentile(0.99)),
+            'buckets': list(zip(list(self.bounds) + ['+Inf'], self.counts))
+        }
+
+
+def _rounded(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 1)
+
+
+class ProviderStats:
+    """单个供应商的累计指标，线程安全。"""
+
+    def __init__(self, key: Tuple[str, str]):
+        self.key = key
+        self.outcomes: Dict[str, int] = {}
+        self.connect_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.ttft_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.total_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.gap_ms = Histogram(GAP_BUCKETS_MS)
+        self.chunks_per_second = Histogram(RATE_BUCKETS)
+        self.chunks = 0
+        self.chars = 0
+        self._lock = threading.Lock()
+
+    def record(self, sample: Dict, gaps_ms: List[float]) -> None:
+        with self._lock:
+            self.outcomes[sample['outcome']] = self.outcomes.get(sample['outcome'], 0) + 1
+            if sample['connect_ms'] is not None:
+                self.connect_ms.observe(sample['connect_ms'])
+            if sample['ttft_ms'] is not None:
+                self.ttft_ms.observe(sample['ttft_ms'])
+            if sample['outcome'] == OK:
+                self.total_ms.observe(sample['total_ms'])
+                if sample['chunks_per_second'] is not None:
+                    self.chunks_per_second.observe(sample['chunks_per_second'])
+            for gap in gaps_ms:
+                self.gap_ms.observe(gap)
+            self.chunks += sample['chunks']
+            self.chars += sample['chars']
+
+    def ttft_percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            return self.ttft_ms.percentile(q)
+
+    def export(self) -> Dict:
+        """结果计数与首包/总耗时直方图的副本，供 Prometheus 导出。"""
+        with self._lock:
+            return {
+                'outcomes': dict(self.outcomes),
+                'ttft_ms': self.ttft_ms.copy(),
+                'total_ms': self.total_ms.copy()
+            }
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            requests = sum(self.outcomes.values())
+            return {
+                'requests': requests,
+                'outcomes': dict(self.outcomes),
+                'success_rate': round(self.outcomes.get(OK, 0) / requests, 3) if requests else None,
+                'chunks': self.chunks,
+                'chars': self.chars,
+                'connect_ms': self.connect_ms.snapshot(),
+                'ttft_ms': self.ttft_ms.snapshot(),
+                'total_ms': self.total_ms.snapshot(),
+                'gap_ms': self.gap_ms.snapshot(),
+                'chunks_per_second': self.chunks_per_second.snapshot()
+            }
+
+
+_stats: Dict[Tuple[str, str], ProviderStats] = {}
+_stats_lock = threading.Lock()
+
+
+def get_stats(provider: Dict) -> ProviderStats:
+    key = provider_key(provider)
+    with _stats_lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = ProviderStats(key)
+            _stats[key] = stats
+        return stats
+
+
+class StreamTimer:
+    """
+    单次上游调用的计时器：依次调用 connected()、chunk()，最后 finish(outcome)。
+
+    finish 只生效一次，可以放在 finally 中兜底（未显式结束的流记为 cancelled）。
+    """
+
+    def __init__(self, provider: Dict):
+        self.stats = get_stats(provider)
+        self.started = time.perf_counter()
+        self.connected_at: Optional[float] = None
+        self.first_chunk_at: Optional[float] = None
+        self.last_chunk_at: Optional[float] = None
+        self.chunks = 0
+        self.chars = 0
+        self.gaps_ms: List[float] = []
+        self.finished = False
+
+    def connected(self) -> None:
+        if self.connected_at is None:
+            self.connected_at = time.perf_counter()
+
+    def chunk(self, text: str) -> None:
+        now = time.perf_counter()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+        else:
+            self.gaps_ms.append((now - self.last_chunk_at) * 1000)
+        self.last_chunk_at = now
+        self.chunks += 1
+        self.chars += len(text)
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def finish(self, outcome: str) -> Optional[Dict]:
+        """汇总本次调用并返回计时字段（毫秒）；重复调用返回 None。"""
+        if self.finished:
+            return None
+        self.finished = True
+        ended = time.perf_counter()
+        streaming_seconds = (self.last_chunk_at - self.first_chunk_at) if self.chunks > 1 else 0
+        sample = {
+            'outcome': outcome,
+            'connect_ms': _elapsed_ms(self.started, self.connected_at),
+            'ttft_ms': _elapsed_ms(self.started, self.first_chunk_at),
+            'total_ms': _elapsed_ms(self.started, ended),
+            'max_gap_ms': round(max(self.gaps_ms), 1) if self.gaps_ms else None,
+            'chunks': self.chunks,
+            'chars': self.chars,
+            'chunks_per_second': round((self.chunks - 1) / streaming_seconds, 1) if streaming_seconds > 0 else None
+        }
+        self.stats.record(sample, self.gaps_ms)
+        return sample
+
+
+def _elapsed_ms(start: float, end: Optional[float]) -> Optional[float]:
+    return None if end is None else round((end - start) * 1000, 1)
+
+
+def ttft_percentile(provider: Dict, q: float, min_samples: int = 1) -> Optional[float]:
+    """供应商的首包耗时分位数（毫秒）；样本不足时返回 None。"""
+    key = provider_key(provider)
+    with _stats_lock:
+        stats = _stats.get(key)
+    if stats is None or stats.ttft_ms.count < min_samples:
+        return None
+    return stats.ttft_percentile(q)
+
+
+def provider_metrics(provider: Dict) -> Optional[Dict]:
+    key = provider_key(provider)
+    with _stats_lock:
+        stats = _stats.get(key)
+    return stats.snapshot() if stats else None
+
+
+def metrics_snapshot() -> Dict[str, Dict]:
+    with _stats_lock:
+        all_stats = list(_stats.values())
+    return {f'{s.key[0]}#{s.key[1]}': s.snapshot() for s in all_stats}
+
+
+def provider_exports() -> Dict[Tuple[str, str], Dict]:
+    with _stats_lock:
+        all_stats = list(_stats.values())
+    return {s.key: s.export() for s in all_stats}
+
+
+def reset_metrics() -> None:
+    with _stats_lock:
+        _stats.clear()
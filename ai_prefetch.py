@@ -0,0 +1,75 @@
+"""
+答错后的 AI 解析预取。
+
+学生答错后通常会紧接着点击“AI解析”。开启 AI_PREFETCH_ENABLED 后，判题请求会在后台提前发起同样的
+解析生成（ai_inflight.prefetch），结果在 Flight 中保留 AI_PREFETCH_TTL 秒；随后的 /ai/run 命中相同指纹时
+直接回放或跟随这次生成。为控制成本，同时进行的预取数受 AI_PREFETCH_MAX_INFLIGHT 限制，
+每个用户每天的预取次数受 AI_PREFETCH_DAILY_BUDGET 限制，超出时静默跳过（点击时仍按需生成）。
+"""
+import threading
+from datetime import date
+from typing import Dict, Tuple
+
+from ai_inflight import prefetch
+from ai_service import _append_debug_log
+
+_settings = {
+    'max_inflight': 4,
+    'daily_budget': 50,
+    'ttl': 600,
+}
+_lock = threading.Lock()
+_inflight = 0
+_spent: Dict[int, Tuple[date, int]] = {}
+
+
+def configure_prefetch(config) -> None:
+    """从 Flask 配置读取预取的并发、预算与保留时间（在 app.py 中调用一次）。"""
+    _settings['max_inflight'] = int(config.get('AI_PREFETCH_MAX_INFLIGHT', _settings['max_inflight']))
+    _settings['daily_budget'] = int(config.get('AI_PREFETCH_DAILY_BUDGET', _settings['daily_budget']))
+    _settings['ttl'] = int(config.get('AI_PREFETCH_TTL', _settings['ttl']))
+
+
+def _spent_today(user_id: int) -> int:
+    day, count = _spent.get(user_id, (None, 0))
+    return count if day == date.today() else 0
+
+
+def has_budget(user_id: int) -> bool:
+    """在组装提示词之前做的廉价检查：并发名额与当日预算是否还有剩余。"""
+    with _lock:
+        return _inflight < _settings['max_inflight'] and _spent_today(user_id) < _settings['daily_budget']
+
+
+def _release(_flight) -> None:
+    global _inflight
+    with _lock:
+        _inflight -= 1
+
+
+def try_prefetch(user_id: int, prepared: Dict) -> bool:
+    """
+    按 prepare_ai_run 的结果发起预取。
+
+    Returns:
+        bool: 是否真正启动了新的上游生成（已有相同请求在进行或预算不足时为 False）
+    """
+    global _inflight
+    with _lock:
+        if _inflight >= _settings['max_inflight'] or _spent_today(user_id) >= _settings['daily_budget']:
+            return False
+        _inflight += 1
+    flight = prefetch(prepared['provider'], prepared['messages'], temperature=prepared['temperature'],
+                      fallbacks=prepared['fallbacks'], linger=_settings['ttl'])
+    with _lock:
+        if flight is None:
+            _inflight -= 1
+            return False
+        _spent[user_id] = (date.today(), _spent_today(user_id) + 1)
+    flight.add_done_callback(_release)
+    _append_debug_log('prefetch.start', {
+        'fingerprint': flight.key,
+        'model': prepared['provider'].get('model'),
+        'user_id': user_id
+    })
+    return True
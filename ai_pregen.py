@@ -0,0 +1,350 @@
+"""
+题库级 AI 解析/提示离线预生成。
+
+教师可以对整个题库发起一次预生成任务：逐题组装与 /ai/run 完全相同的消息，经有界线程池并发调用
+上游（按供应商令牌桶限速，走 ai_circuit 的熔断与故障转移），结果写入 ai_generated 表。学生点击
+AI 按钮时若命中相同的提示词指纹，直接返回已存内容，无需等待生成。
+
+已存的结果本身就是断点：任务中断或重新发起时会跳过已有指纹，只补齐缺失部分。解析只为可穷举的作答
+生成（单选题的每个选项、判断题的两种判断、多选题的正确答案），填空题的自由作答无法预测，按需生成。
+"""
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from ai_circuit import failover_stream, get_breaker, provider_key
+from ai_service import AIServiceError, AIUpstreamError, build_mode_messages
+from database import (
+    fetch_question,
+    get_ai_generated_fingerprints,
+    get_ai_pregen_job,
+    get_db,
+    save_ai_generated,
+)
+
+PREGEN_MODES = ('hint', 'analysis')
+
+# 上游不可用时单个生成目标的重试次数与最长等待秒数
+_MAX_ATTEMPTS = 3
+_MAX_RETRY_WAIT_SECONDS = 60.0
+# 进度写回间隔（题数 / 秒），避免每题一次写事务
+_FLUSH_EVERY = 20
+_FLUSH_SECONDS = 2.0
+# 状态为进行中但超过该秒数没有写回进度的任务视为已中断（进程重启等）
+_STALE_SECONDS = 300
+
+_settings = {
+    'workers': 4,
+    'rate_per_minute': 60,
+}
+_state = {
+    'executor': None,
+}
+_state_lock = threading.Lock()
+_cancel_events: Dict[int, threading.Event] = {}
+_jobs_lock = threading.Lock()
+
+
+def configure_pregen(config) -> None:
+    """从 Flask 配置读取并发数与限速（在 app.py 中调用一次）。"""
+    _settings['workers'] = max(1, int(config.get('AI_PREGEN_WORKERS', _settings['workers'])))
+    _settings['rate_per_minute'] = max(1, int(config.get('AI_PREGEN_RATE_PER_MINUTE', _settings['rate_per_minute'])))
+
+
+def generation_fingerprint(messages: List[Dict[str, str]], temperature: float) -> str:
+    """
+    预生成内容的查找键：只取消息与温度，不含供应商与模型，
+    切换或新增供应商后已生成的内容仍可复用。
+    """
+    material = json.dumps({'temperature': temperature, 'messages': messages},
+                          ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def candidate_answers(question: Dict) -> List[str]:
+    """返回可穷举的作答（与 serialize_user_answer 的结果格式一致）。"""
+    question_type = question.get('question_type') or question.get('type')
+    if question_type == '单选题':
+        return sorted((question.get('options') or {}).keys())
+    if question_type == '判断题':
+        return ['正确', '错误']
+    if question_type == '多选题' and question.get('answer'):
+        return [''.join(sorted(question['answer']))]
+    return []
+
+
+def pregen_targets(question: Dict, modes: Sequence[str]) -> List[Tuple[str, List[Dict[str, str]], float]]:
+    """列出一道题需要生成的 (mode, messages, temperature)。"""
+    targets = []
+    if 'hint' in modes:
+        messages, temperature = build_mode_messages(question, 'hint')
+        targets.append(('hint', messages, temperature))
+    if 'analysis' in modes:
+        for answer in candidate_answers(question):
+            messages, temperature = build_mode_messages(question, 'analysis', answer)
+            targets.append(('analysis', messages, temperature))
+    return targets
+
+
+class _TokenBucket:
+    """每分钟 rate 个令牌的令牌桶，线程安全；桶容量为一秒的配额（至少 1）。"""
+
+    def __init__(self, rate_per_minute: int):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel: Optional[threading.Event] = None) -> bool:
+        """取得一个令牌；等待期间任务被取消则返回 False。"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = (1 - self.tokens) / self.rate
+            if cancel is not None:
+                if cancel.wait(delay):
+                    return False
+            else:
+                time.sleep(delay)
+
+
+_buckets: Dict[Tuple[str, str], _TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def _bucket_for(provider: Dict) -> _TokenBucket:
+    key = provider_key(provider)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _TokenBucket(_settings['rate_per_minute'])
+            _buckets[key] = bucket
+        return bucket
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    with _state_lock:
+        if _state['executor'] is None:
+            _state['executor'] = ThreadPoolExecutor(max_workers=_settings['workers'], thread_name_prefix='ai-pregen')
+        return _state['executor']
+
+
+def _update_job(job_id: int, **fields) -> None:
+    assignments = ', '.join(f'{name}=?' for name in fields)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(f'UPDATE ai_pregen_jobs SET {assignments}, updated_at=CURRENT_TIMESTAMP WHERE id=?',
+              (*fields.values(), job_id))
+    conn.commit()
+    conn.close()
+
+
+def _bank_question_ids(question_bank_id: int) -> List[str]:
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT id FROM questions WHERE question_bank_id=? ORDER BY CAST(id AS INTEGER), id',
+              (question_bank_id,))
+    rows = c.fetchall()
+    conn.close()
+    return [row['id'] for row in rows]
+
+
+def create_job(user_id: int, question_bank_id: int, modes: Sequence[str]) -> int:
+    """登记一个待执行的预生成任务，返回任务编号。"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('INSERT INTO ai_pregen_jobs (user_id, question_bank_id, modes) VALUES (?,?,?)',
+              (user_id, question_bank_id, ','.join(modes)))
+    job_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def is_job_running(job_id: int) -> bool:
+    with _jobs_lock:
+        return job_id in _cancel_events
+
+
+def describe_job(job: Dict) -> Dict:
+    """返回带有效状态的任务副本：本进程外已停止写回进度的进行中任务标记为 interrupted。"""
+    job = dict(job)
+    job['running'] = is_job_running(job['id'])
+    if job['status'] in ('pending', 'running') and not job['running']:
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("SELECT updated_at < datetime('now', ?) AS stale FROM ai_pregen_jobs WHERE id=?",
+                  (f'-{_STALE_SECONDS} seconds', job['id']))
+        row = c.fetchone()
+        conn.close()
+        if row and row['stale']:
+            job['status'] = 'interrupted'
+    return job
+
+
+def cancel_job(job_id: int) -> bool:
+    """请求停止任务；已生成的内容保留，重新发起时从断点继续。"""
+    with _jobs_lock:
+        event = _cancel_events.get(job_id)
+    if event is None:
+        return False
+    event.set()
+    return True
+
+
+def _generate_target(providers: List[Dict], messages: List[Dict[str, str]], temperature: float,
+                     cancel: threading.Event) -> Optional[str]:
+    """生成单个目标的完整文本；任务取消时返回 None，重试耗尽时抛出最后一次的错误。"""
+    bucket = _bucket_for(providers[0])
+    for attempt in range(_MAX_ATTEMPTS):
+        if not bucket.acquire(cancel):
+            return None
+        try:
+            return ''.join(failover_stream(providers, messages, temperature=temperature))
+        except AIUpstreamError:
+            if attempt + 1 >= _MAX_ATTEMPTS:
+                raise
+            # 熔断打开时等到可以探测为止，而不是把整个题库快速标记为失败
+            delay = min(_MAX_RETRY_WAIT_SECONDS, max(1.0, get_breaker(providers[0]).retry_after()))
+            if cancel.wait(delay):
+                return None
+    return None
+
+
+def _process_question(question_bank_id: int, question_id: str, modes: Sequence[str], providers: List[Dict],
+                      cancel: threading.Event) -> Tuple[int, int, Optional[str]]:
+    """补齐一道题缺失的生成内容，返回 (新生成数, 失败数, 最后一次错误)。"""
+    question = fetch_question(question_id, question_bank_id)
+    if not question:
+        return 0, 0, None
+    existing = get_ai_generated_fingerprints(question_bank_id, question_id)
+    generated = failed = 0
+    last_error = None
+    for mode, messages, temperature in pregen_targets(question, modes):
+        if cancel.is_set():
+            break
+        fingerprint = generation_fingerprint(messages, temperature)
+        if fingerprint in existing:
+            continue
+        try:
+            content = _generate_target(providers, messages, temperature, cancel)
+        except AIServiceError as exc:
+            failed += 1
+            last_error = f'题目 {question_id}: {exc}'
+            continue
+        if content and content.strip():
+            save_ai_generated(question_bank_id, question_id, fingerprint, mode, content, providers[0].get('model'))
+            generated += 1
+    return generated, failed, last_error
+
+
+def _claim_job(job_id: int) -> Tuple[Dict, threading.Event]:
+    job = get_ai_pregen_job(job_id)
+    if not job:
+        raise AIServiceError('预生成任务不存在。')
+    with _jobs_lock:
+        if job_id in _cancel_events:
+            raise AIServiceError('该任务已在运行中。')
+        cancel = threading.Event()
+        _cancel_events[job_id] = cancel
+    return job, cancel
+
+
+def run_job(job_id: int, providers: List[Dict], progress=None) -> Dict:
+    """
+    同步执行预生成任务（CLI 使用；页面发起的任务经 start_job 在后台线程执行）。
+
+    Args:
+        job_id: ai_pregen_jobs 中的任务编号
+        providers: 已解密密钥的供应商列表，首个为首选，其余用于故障转移
+        progress: 可选回调，每次写回进度时以任务计数字典调用
+
+    Returns:
+        dict: 最终的任务计数与状态
+    """
+    job, cancel = _claim_job(job_id)
+    return _execute(job, cancel, providers, progress)
+
+
+def _execute(job: Dict, cancel: threading.Event, providers: List[Dict], progress=None) -> Dict:
+    job_id = job['id']
+    question_bank_id = job['question_bank_id']
+    modes = [mode for mode in job['modes'].split(',') if mode in PREGEN_MODES]
+    counters = {'total': 0, 'completed': 0, 'generated': 0, 'failed': 0, 'last_error': None}
+    counters_lock = threading.Lock()
+    last_flush = [time.monotonic()]
+
+    def flush(force=False):
+        with counters_lock:
+            due = force or counters['completed'] % _FLUSH_EVERY == 0 \
+                or time.monotonic() - last_flush[0] >= _FLUSH_SECONDS
+            if not due:
+                return
+            last_flush[0] = time.monotonic()
+            snapshot = dict(counters)
+        _update_job(job_id, completed=snapshot['completed'], generated=snapshot['generated'],
+                    failed=snapshot['failed'], last_error=snapshot['last_error'])
+        if progress is not None:
+            progress(snapshot)
+
+    def work(question_id):
+        if cancel.is_set():
+            return
+        try:
+            generated, failed, error = _process_question(question_bank_id, question_id, modes, providers, cancel)
+        except Exception as exc:  # 单题异常不能中断整个任务
+            generated, failed, error = 0, 1, f'题目 {question_id}: {exc}'
+        with counters_lock:
+            counters['completed'] += 1
+            counters['generated'] += generated
+            counters['failed'] += failed
+            if error:
+                counters['last_error'] = error[:500]
+        flush()
+
+    status = 'failed'
+    try:
+        question_ids = _bank_question_ids(question_bank_id)
+        counters['total'] = len(question_ids)
+        _update_job(job_id, status='running', total=len(question_ids), completed=0, generated=0, failed=0,
+                    last_error=None)
+        executor = _get_executor()
+        wait([executor.submit(work, question_id) for question_id in question_ids])
+        if cancel.is_set():
+            status = 'cancelled'
+        elif counters['failed'] and not counters['generated']:
+            status = 'failed'
+        else:
+            status = 'done'
+    except Exception as exc:
+        counters['last_error'] = str(exc)[:500]
+        raise
+    finally:
+        flush(force=True)
+        _update_job(job_id, status=status)
+        with _jobs_lock:
+            _cancel_events.pop(job_id, None)
+    counters['status'] = status
+    return counters
+
+
+def start_job(job_id: int, providers: List[Dict]) -> None:
+    """在后台线程中执行任务并立即返回；任务已在运行时抛出 AIServiceError。"""
+    job, cancel = _claim_job(job_id)
+
+    def target():
+        try:
+            _execute(job, cancel, providers)
+        except Exception as exc:
+            print(f"AI pregen job {job_id} failed: {exc}")
+
+    threading.Thread(target=target, name=f'ai-pregen-job-{job_id}', daemon=True).start()
@@ -1,53 +1,140 @@
 import base64
 import hashlib
 import json
+import socket
+import threading
 import time
 import uuid
+from collections import OrderedDict
 from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import requests
 from cryptography.fernet import Fernet, InvalidToken
 from flask import current_app
 
+from ai_metrics import CANCELLED, CLIENT_ERROR, OK, UPSTREAM_ERROR, StreamTimer
+from metrics import record_cache
+
 
 class AIServiceError(Exception):
     """Raised when downstream AI services fail or are misconfigured."""
 
 
+class AIUpstreamError(AIServiceError):
+    """Raised when the provider is unreachable or fails server-side (network error, 5xx, 429)."""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+def is_upstream_failure_status(status: int) -> bool:
+    return status >= 500 or status == 429
+
+
 _BASE_DIR = Path(__file__).resolve().parent
 _PROMPT_DIR = _BASE_DIR / 'prompt'
 _DEBUG_DIR = _BASE_DIR / 'debug'
 _DEBUG_LOG_PATH = _DEBUG_DIR / 'ai_stream.log'
 
 
-def _get_cipher() -> Fernet:
-    secret = current_app.config.get('SECRET_KEY')
-    if not secret:
-        raise AIServiceError('SECRET_KEY 未配置，无法完成 API 密钥的加解密。')
+@lru_cache(maxsize=4)
+def _cipher_for_secret(secret: str) -> Fernet:
     digest = hashlib.sha256(secret.encode('utf-8')).digest()
     key = base64.urlsafe_b64encode(digest)
     return Fernet(key)
 
 
-def encrypt_api_key(raw: str) -> str:
+def _get_cipher(secret: Optional[str] = None) -> Fernet:
+    if secret is None:
+        secret = current_app.config.get('SECRET_KEY')
+    if not secret:
+        raise AIServiceError('SECRET_KEY 未配置，无法完成 API 密钥的加解密。')
+    return _cipher_for_secret(secret)
+
+
+def encrypt_api_key(raw: str, secret: Optional[str] = None) -> str:
     if not raw:
         raise ValueError('API 密钥不能为空')
-    cipher = _get_cipher()
+    cipher = _get_cipher(secret)
     return cipher.encrypt(raw.encode('utf-8')).decode('utf-8')
 
 
-def decrypt_api_key(token: str) -> str:
+def decrypt_api_key(token: str, secret: Optional[str] = None) -> str:
     if not token:
         raise AIServiceError('未配置 API 密钥')
-    cipher = _get_cipher()
+    cipher = _get_cipher(secret)
     try:
         return cipher.decrypt(token.encode('utf-8')).decode('utf-8')
     except InvalidToken as exc:
         raise AIServiceError('无法解密 API 密钥，请重新保存配置。') from exc
 
 
+def api_key_digest(api_key: Optional[str]) -> str:
+    """API 密钥的 SHA-256 摘要，用于按密钥区分进程内状态（合流、熔断），不保留明文。"""
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()
+
+
+# 已解密密钥的进程内缓存：(provider id, updated_at) -> (密文, 明文, 过期时间)
+# 只存在内存中，不落盘；密文一并比对，保证配置变更后不会返回旧密钥
+_key_cache: "OrderedDict[Tuple[int, str], Tuple[str, str, float]]" = OrderedDict()
+_key_cache_lock = threading.Lock()
+_KEY_CACHE_TTL = 300
+_KEY_CACHE_SIZE = 256
+
+
+def decrypt_provider_key(provider: Dict, secret: Optional[str] = None) -> str:
+    """
+    解密 ai_providers 行中的 API 密钥，命中缓存时跳过 Fernet 解密。
+
+    Args:
+        provider (dict): 至少包含 id、updated_at、api_key_encrypted 的配置行
+        secret (str): 可选，覆盖 current_app 的 SECRET_KEY（后台线程无应用上下文时使用）
+    """
+    token = provider['api_key_encrypted']
+    cache_key = (provider['id'], provider.get('updated_at') or '')
+    if secret is None:
+        ttl = current_app.config.get('AI_KEY_CACHE_TTL', _KEY_CACHE_TTL)
+        size = current_app.config.get('AI_KEY_CACHE_SIZE', _KEY_CACHE_SIZE)
+    else:
+        ttl, size = _KEY_CACHE_TTL, _KEY_CACHE_SIZE
+    now = time.monotonic()
+    with _key_cache_lock:
+        entry = _key_cache.get(cache_key)
+        if entry and entry[0] == token and entry[2] > now:
+            _key_cache.move_to_end(cache_key)
+            record_cache('ai_key', True)
+            return entry[1]
+    record_cache('ai_key', False)
+    plaintext = decrypt_api_key(token, secret)
+    if ttl > 0 and size > 0:
+        with _key_cache_lock:
+            _key_cache[cache_key] = (token, plaintext, now + ttl)
+            _key_cache.move_to_end(cache_key)
+            while len(_key_cache) > size:
+                _key_cache.popitem(last=False)
+    return plaintext
+
+
+def invalidate_provider_key(provider_id: int) -> None:
+    """配置更新或删除后丢弃该供应商的所有缓存明文。"""
+    with _key_cache_lock:
+        for cache_key in [k for k in _key_cache if k[0] == provider_id]:
+            del _key_cache[cache_key]
+
+
+def clear_key_cache() -> None:
+    with _key_cache_lock:
+        _key_cache.clear()
+
+
+def reencrypt_api_key(token: str, old_secret: str, new_secret: str) -> str:
+    """用旧 SECRET_KEY 解密并以新 SECRET_KEY 重新加密，用于密钥轮换。"""
+    return encrypt_api_key(decrypt_api_key(token, old_secret), new_secret)
+
+
 @lru_cache(maxsize=8)
 def load_prompt(name: str) -> str:
     path = _PROMPT_DIR / f'{name}.md'
@@ -113,6 +200,23 @@ def build_hint_messages(question: Dict) -> List[Dict[str, str]]:
     return [system_msg, {'role': 'user', 'content': '\n'.join(user_lines)}]
 
 
+# 各模式的采样温度，按需调用与离线预生成共用，保证两者的提示词指纹一致
+MODE_TEMPERATURES = {'analysis': 0.2, 'hint': 0.5}
+
+
+def build_mode_messages(question: Dict, mode: str, user_answer: str = '') -> Tuple[List[Dict[str, str]], float]:
+    """按 AI 模式组装消息，返回 (messages, temperature)。"""
+    if mode == 'analysis':
+        return build_analysis_messages(question, user_answer), MODE_TEMPERATURES['analysis']
+    if mode == 'hint':
+        return build_hint_messages(question), MODE_TEMPERATURES['hint']
+    raise AIServiceError('未知的 AI 模式。')
+
+
+def build_chat_url(base_url: str) -> str:
+    return base_url.rstrip('/') + '/v1/chat/completions'
+
+
 def _build_headers(api_key: str) -> Dict[str, str]:
     return {
         'Authorization': f'Bearer {api_key}',
@@ -129,12 +233,107 @@ def _build_payload(model: str, messages: List[Dict[str, str]], *, stream: bool =
     }
 
 
+def parse_sse_line(raw_line: Optional[str]) -> Optional[Dict]:
+    """解析一行 SSE 数据，返回 JSON 负载；空行、[DONE] 或无法解析的行返回 None。"""
+    if not raw_line:
+        return None
+    line = raw_line.strip()
+    if line.startswith('data:'):
+        line = line[5:].strip()
+    if not line or line == '[DONE]':
+        return None
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        return None
+
+
+def extract_delta_content(data: Dict) -> Optional[str]:
+    choices = data.get('choices') or []
+    if not choices:
+        return None
+    delta = choices[0].get('delta') or {}
+    return delta.get('content')
+
+
+def _abort_response(resp: requests.Response) -> None:
+    # resp.close() 不会打断另一个线程中阻塞的读取；关闭套接字后读取立即出错返回，由读取方的 with 块释放连接
+    sock = getattr(getattr(resp.raw, 'connection', None), 'sock', None)
+    if sock is None:
+        resp.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class UpstreamCancel:
+    """
+    从其他线程取消进行中的上游请求，线程安全。
+
+    cancel() 由取消方（预算到期、对冲落败、订阅者全部断开）调用，立即断开已登记的连接：阻塞在读取上的线程
+    马上返回并抛出取消原因，而不是等到下一个分片或读超时。child() 创建随本对象一起取消、也可单独取消的子范围。
+    """
+
+    def __init__(self):
+        self.reason: Optional[AIServiceError] = None
+        self._responses: List[requests.Response] = []
+        self._children: List['UpstreamCancel'] = []
+        self._lock = threading.Lock()
+
+    def child(self) -> 'UpstreamCancel':
+        scope = UpstreamCancel()
+        with self._lock:
+            if self.reason is None:
+                self._children.append(scope)
+                return scope
+        scope.cancel(self.reason)
+        return scope
+
+    def attach(self, resp: requests.Response) -> None:
+        with self._lock:
+            if self.reason is None:
+                self._responses.append(resp)
+                return
+        _abort_response(resp)
+
+    def detach(self, resp: requests.Response) -> None:
+        with self._lock:
+            if resp in self._responses:
+                self._responses.remove(resp)
+
+    def cancel(self, reason: AIServiceError) -> None:
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            responses, self._responses = self._responses, []
+            children, self._children = self._children, []
+        for resp in responses:
+            _abort_response(resp)
+        for scope in children:
+            scope.cancel(reason)
+
+    def check(self) -> None:
+        """已取消时抛出取消原因。"""
+        if self.reason is not None:
+            raise self.reason
+
+
 def stream_chat_completion(provider: Dict, messages: List[Dict[str, str]], *, temperature: float = 0.2,
-                           timeout: int = 15, retry_delay: int = 5) -> Iterable[str]:
-    url = provider['base_url'].rstrip('/') + '/v1/chat/completions'
+                           timeout: int = 15, cancel: Optional[UpstreamCancel] = None) -> Iterable[str]:
+    """
+    调用 Chat Completions 流式接口并逐段产出文本。
+
+    不在请求线程内睡眠重试：供应商不可用时直接抛出 AIUpstreamError，由 ai_circuit 的熔断与故障转移处理。
+    cancel 被取消时断开连接并抛出其取消原因。
+    """
+    if cancel is not None:
+        cancel.check()
+    url = build_chat_url(provider['base_url'])
     headers = _build_headers(provider['api_key'])
     payload = _build_payload(provider['model'], messages, stream=True, temperature=temperature)
-    last_error = None
     trace_id = str(uuid.uuid4())
     _append_debug_log('request.start', {
         'trace_id': trace_id,
@@ -143,78 +342,80 @@ def stream_chat_completion(provider: Dict, messages: List[Dict[str, str]], *, te
         'temperature': temperature,
         'messages': messages
     })
-    for attempt in range(2):
-        aggregated_output: List[str] = []
-        try:
-            with requests.post(url, headers=headers, json=payload, timeout=timeout, stream=True) as resp:
-                if resp.status_code >= 400:
-                    _append_debug_log('response.http_error', {
-                        'trace_id': trace_id,
-                        'status': resp.status_code,
-                        'body': resp.text[:500]
-                    })
-                    raise AIServiceError(f'AI 服务响应异常: HTTP {resp.status_code} {resp.text[:200]}')
-                for raw_line in resp.iter_lines(decode_unicode=True):
-                    _append_debug_log('response.raw_line', {
-                        'trace_id': trace_id,
-                        'line': raw_line
-                    })
-                    if not raw_line:
-                        continue
-                    line = raw_line.strip()
-                    if line.startswith('data:'):
-                        line = line[5:].strip()
-                    if not line or line == '[DONE]':
-                        continue
-                    try:
-                        data = json.loads(line)
-                        _append_debug_log('response.parsed', {
-                            'trace_id': trace_id,
-                            'data': data
-                        })
-                    except json.JSONDecodeError:
-                        continue
-                    choices = data.get('choices') or []
-                    if not choices:
-                        continue
-                    delta = choices[0].get('delta') or {}
-                    chunk = delta.get('content')
-                    if chunk:
-                        _append_debug_log('response.chunk', {
-                            'trace_id': trace_id,
-                            'chunk': chunk
-                        })
-                        aggregated_output.append(chunk)
-                        yield chunk
-                final_text = ''.join(aggregated_output)
-                _append_debug_log('response.complete', {
+    aggregated_output: List[str] = []
+    timer = StreamTimer(provider)
+    resp = None
+    try:
+        with requests.post(url, headers=headers, json=payload, timeout=timeout, stream=True) as resp:
+            if cancel is not None:
+                cancel.attach(resp)
+            timer.connected()
+            if resp.status_code >= 400:
+                upstream_failure = is_upstream_failure_status(resp.status_code)
+                _append_debug_log('response.http_error', {
                     'trace_id': trace_id,
-                    'aggregated_text': final_text,
-                    'frontend_text': final_text
+                    'status': resp.status_code,
+                    'body': resp.text[:500],
+                    'timing': timer.finish(UPSTREAM_ERROR if upstream_failure else CLIENT_ERROR)
                 })
-                return
-        except requests.RequestException as exc:
-            last_error = exc
-            if attempt == 0:
-                time.sleep(retry_delay)
-                continue
-            _append_debug_log('response.error', {
+                message = f'AI 服务响应异常: HTTP {resp.status_code} {resp.text[:200]}'
+                if upstream_failure:
+                    raise AIUpstreamError(message, status=resp.status_code)
+                raise AIServiceError(message)
+            for raw_line in resp.iter_lines(decode_unicode=True):
+                _append_debug_log('response.raw_line', {
+                    'trace_id': trace_id,
+                    'line': raw_line
+                })
+                data = parse_sse_line(raw_line)
+                if data is None:
+                    continue
+                _append_debug_log('response.parsed', {
+                    'trace_id': trace_id,
+                    'data': data
+                })
+                chunk = extract_delta_content(data)
+                if chunk:
+                    _append_debug_log('response.chunk', {
+                        'trace_id': trace_id,
+                        'chunk': chunk,
+                        'elapsed_ms': timer.elapsed_ms()
+                    })
+                    aggregated_output.append(chunk)
+                    timer.chunk(chunk)
+                    yield chunk
+            final_text = ''.join(aggregated_output)
+            _append_debug_log('response.complete', {
                 'trace_id': trace_id,
-                'error': str(exc),
-                'aggregated_text': ''.join(aggregated_output)
+                'aggregated_text': final_text,
+                'frontend_text': final_text,
+                'timing': timer.finish(OK)
             })
-            raise AIServiceError(f'AI 服务调用失败: {exc}') from exc
-
-    if last_error:
+    except requests.RequestException as exc:
+        if cancel is not None and cancel.reason is not None:
+            _append_debug_log('response.cancelled', {
+                'trace_id': trace_id,
+                'reason': str(cancel.reason),
+                'aggregated_text': ''.join(aggregated_output),
+                'timing': timer.finish(CANCELLED)
+            })
+            raise cancel.reason from exc
         _append_debug_log('response.error', {
             'trace_id': trace_id,
-            'error': str(last_error)
+            'error': str(exc),
+            'aggregated_text': ''.join(aggregated_output),
+            'timing': timer.finish(UPSTREAM_ERROR)
         })
-        raise AIServiceError(f'AI 服务调用失败: {last_error}')
+        raise AIUpstreamError(f'AI 服务调用失败: {exc}') from exc
+    finally:
+        if cancel is not None and resp is not None:
+            cancel.detach(resp)
+        # 调用方提前关闭生成器（客户端断开等）时记为 cancelled
+        timer.finish(CANCELLED)
 
 
 def validate_provider_connection(provider: Dict, timeout: int = 15) -> Tuple[bool, str]:
-    url = provider['base_url'].rstrip('/') + '/v1/chat/completions'
+    url = build_chat_url(provider['base_url'])
     headers = _build_headers(provider['api_key'])
     payload = {
         'model': provider['model'],
@@ -16,6 +16,19 @@ License: MIT
 from flask import Flask
 from config import Config
 from database import init_db
+from ai_budget import configure_stream_budget
+from ai_circuit import configure_breakers
+from ai_healthcheck import init_health_checker
+from ai_hedge import configure_hedging
+from ai_prefetch import configure_prefetch
+from ai_pregen import configure_pregen
+from metrics import init_metrics
+from query_log import init_query_log
+from page_cache import configure_page_cache
+from assets import init_assets
+from compression import init_compression
+from archive import configure_archive
+from autosave import configure_autosave
 
 # 导入各个功能蓝图
 from blueprints.main import bp as main_bp
@@ -25,6 +38,7 @@ from blueprints.user import bp as user_bp
 from blueprints.load_data import bp as load_data_bp
 from blueprints.question_bank import bp as question_bank_bp
 from blueprints.ai import bp as ai_bp
+from blueprints.api import bp as api_bp
 
 # 初始化 Flask 应用
 app = Flask(__name__)
@@ -40,9 +54,44 @@ app.config.from_object(Config)
 app.config.from_object(Config)
 
 # 初始化数据库
-# 创建必要的表并加载初始 CSV 数据（如果表为空）
-# 注意：在应用启动前执行一次即可
-init_db()
+# 结构已是最新时只读取一次 PRAGMA user_version；否则加文件锁执行待执行的迁移（新库同时导入 CSV）
+# 关闭 DB_AUTO_MIGRATE 时需在部署前运行 python migrate.py
+init_db(migrate=app.config.get('DB_AUTO_MIGRATE', True))
+
+# 根据配置初始化 AI 供应商熔断、单次生成预算、对冲请求、题库预生成与答错预取参数
+configure_breakers(app.config)
+configure_stream_budget(app.config)
+configure_hedging(app.config)
+configure_pregen(app.config)
+configure_prefetch(app.config)
+
+# 答题历史归档库位置与保留天数（归档由 python archive.py 定期执行）
+configure_archive(app.config)
+
+# 考试作答自动保存：写入先进缓冲，后台线程按间隔批量落库
+configure_autosave(app.config)
+
+# 页面 ETag / 304 与按题库版本缓存的渲染片段
+configure_page_cache(app.config)
+
+# 带内容指纹的预压缩静态资源（python assets.py 构建），模板中通过 asset_url() 引用
+init_assets(app)
+
+# HTML/JSON 响应的 gzip 压缩（流式响应逐块压缩，AI 文本流不压缩）
+if app.config.get('COMPRESSION_ENABLED', True):
+    init_compression(app)
+
+# 启动 AI 供应商后台健康检查（保存配置时立即检查，并按周期刷新）
+if app.config.get('AI_HEALTHCHECK_ENABLED', True):
+    init_health_checker(app)
+
+# 请求耗时、SQL 与缓存指标，GET /metrics 以 Prometheus 格式导出
+if app.config.get('METRICS_ENABLED', True):
+    init_metrics(app)
+
+# SQL 语句画像与慢查询日志（debug/slow_query.log），报告见 GET /metrics/queries
+if app.config.get('QUERY_LOG_ENABLED', True):
+    init_query_log(app)
 
 # 注册蓝图 (Blueprints)
 # 我们不设置 url_prefix，以保持与原版 URL 结构的一致性
@@ -54,6 +103,8 @@ app.register_blueprint(user_bp)
 app.register_blueprint(load_data_bp)
 app.register_blueprint(question_bank_bp)
 app.register_blueprint(ai_bp)
+# 移动端 JSON 接口，统一挂在 /api/v1 下
+app.register_blueprint(api_bp)
 
 if __name__ == '__main__':
     # 启动应用
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+答题历史归档。
+
+history 表每次作答增加一行，统计、错题本与进度查询都要读它。超过保留期（HISTORY_RETENTION_DAYS）的行
+被移到独立的归档库（HISTORY_ARCHIVE_FILE，以 ATTACH 方式访问），主库的 history_daily 按
+（用户、题库、题目、日期）保留作答次数与答对次数。统计、错题与进度查询读取 answer_log 视图
+（history 与 history_daily 的并集），归档前后结果一致；答题历史页按时间倒序分页，主库的行读完后
+透明地续读归档库。主库因此只保留近期明细，能常驻页缓存。
+
+建议每天低峰期运行一次（每批一个短事务，期间应用照常读写）：
+
+    python archive.py                   # 归档超过保留期的答题记录
+    python archive.py --days 90         # 指定保留天数
+    python archive.py --vacuum          # 归档后整理主库文件，归还空闲页
+    python archive.py --status          # 只查看各表行数与文件大小
+"""
+import argparse
+import os
+import sys
+
+import database
+from database import fetch_questions, get_db
+
+ARCHIVE_SCHEMA = 'archive'
+
+_settings = {
+    'file': 'history_archive.db',
+    'retention_days': 180,
+    'batch_size': 5000,
+}
+
+
+def configure_archive(config) -> None:
+    """从应用配置读取归档库路径、保留天数与每批行数（在 app.py 中调用一次）。"""
+    _settings['file'] = config.get('HISTORY_ARCHIVE_FILE', _settings['file'])
+    _settings['retention_days'] = int(config.get('HISTORY_RETENTION_DAYS', _settings['retention_days']))
+    _settings['batch_size'] = int(config.get('HISTORY_ARCHIVE_BATCH', _settings['batch_size']))
+
+
+def attach_archive(conn, create: bool = False) -> bool:
+    """
+    把归档库 ATTACH 为 archive。归档库尚不存在且 create 为 False 时不创建，返回 False。
+    需在连接开始事务之前调用。
+    """
+    path = _settings['file']
+    if not create and not os.path.exists(path):
+        return False
+    conn.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (path,))
+    if create:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.history_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                question_id TEXT NOT NULL,
+                question_bank_id INTEGER,
+                user_answer TEXT NOT NULL,
+                correct INTEGER NOT NULL,
+                timestamp DATETIME,
+                client_key TEXT,
+                archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_history_archive_user
+            ON history_archive(user_id, question_bank_id, timestamp)
+        ''')
+    return True
+
+
+def archive_history(retention_days: int = None, batch_size: int = None) -> int:
+    """
+    把早于保留期的 history 行移到归档库并累加进 history_daily，返回移动的行数。
+    每批在一个 BEGIN IMMEDIATE 事务中完成复制、汇总与删除，中途失败不会丢失或重复计数。
+    """
+    retention_days = _settings['retention_days'] if retention_days is None else retention_days
+    batch_size = batch_size or _settings['batch_size']
+    cutoff = f'-{int(retention_days)} days'
+
+    conn = get_db()
+    conn.isolation_level = None
+    attach_archive(conn, create=True)
+    c = conn.cursor()
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)')
+    moved = 0
+    try:
+        while True:
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                # 按 id 顺序取：旧记录集中在表头，每批扫描到够数即停
+                c.execute('''
+                    INSERT INTO temp.archive_batch (id)
+                    SELECT id FROM history WHERE timestamp < datetime('now', ?) ORDER BY id LIMIT ?
+                ''', (cutoff, batch_size))
+                c.execute(f'''
+                    INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.history_archive
+                        (id, user_id, question_id, question_bank_id, user_answer, correct, timestamp, client_key)
+                    SELECT id, user_id, question_id, question_bank_id, user_answer, correct, timestamp, client_key
+                    FROM history WHERE id IN (SELECT id FROM temp.archive_batch)
+                ''')
+                c.execute('''
+                    INSERT INTO history_daily (user_id, question_bank_id, question_id, day, attempts, correct_count)
+                    SELECT user_id, COALESCE(question_bank_id, 0), question_id, date(timestamp), COUNT(*), SUM(correct)
+                    FROM history WHERE id IN (SELECT id FROM temp.archive_batch)
+                    GROUP BY user_id, COALESCE(question_bank_id, 0), question_id, date(timestamp)
+                    ON CONFLICT (user_id, question_bank_id, question_id, day) DO UPDATE SET
+                        attempts = attempts + excluded.attempts,
+                        correct_count = correct_count + excluded.correct_count
+                ''')
+                c.execute('DELETE FROM history WHERE id IN (SELECT id FROM temp.archive_batch)')
+                batch_moved = c.rowcount
+                c.execute('DELETE FROM temp.archive_batch')
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            moved += batch_moved
+            if batch_moved < batch_size:
+                break
+    finally:
+        conn.close()
+    return moved
+
+
+def delete_archived_history(question_bank_id, user_id=None) -> None:
+    """删除题库（或某用户在该题库）的已归档明细，与清空历史、删除题库配合使用。"""
+    conn = get_db()
+    if not attach_archive(conn):
+        conn.close()
+        return
+    if user_id is None:
+        conn.execute(f'DELETE FROM {ARCHIVE_SCHEMA}.history_archive WHERE question_bank_id=?', (question_bank_id,))
+    else:
+        conn.execute(f'DELETE FROM {ARCHIVE_SCHEMA}.history_archive WHERE user_id=? AND question_bank_id=?',
+                     (user_id, question_bank_id))
+    conn.commit()
+    conn.close()
+
+
+def history_page(user_id, question_bank_id, page: int = 1, per_page: int = 100):
+    """
+    答题历史的一页（按时间倒序）：先读主库 history，不足一页时续读归档库。
+
+    Returns:
+        tuple: (记录列表, 是否还有下一页)
+    """
+    offset = (max(page, 1) - 1) * per_page
+    want = per_page + 1
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) AS total FROM history WHERE user_id=? AND question_bank_id=?',
+              (user_id, question_bank_id))
+    recent_total = c.fetchone()['total']
+
+    rows = []
+    if offset < recent_total:
+        c.execute('''
+            SELECT id, question_id, user_answer, correct, timestamp FROM history
+            WHERE user_id=? AND question_bank_id=?
+            ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?
+        ''', (user_id, question_bank_id, want, offset))
+        rows = c.fetchall()
+    if len(rows) < want:
+        c.close()
+        if attach_archive(conn):
+            c = conn.cursor()
+            c.execute(f'''
+                SELECT id, question_id, user_answer, correct, timestamp FROM {ARCHIVE_SCHEMA}.history_archive
+                WHERE user_id=? AND question_bank_id=?
+                ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?
+            ''', (user_id, question_bank_id, want - len(rows), max(offset - recent_total, 0)))
+            rows += c.fetchall()
+    conn.close()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    questions = fetch_questions({r['question_id'] for r in rows}, question_bank_id)
+    records = []
+    for r in rows:
+        q = questions.get(r['question_id'])
+        records.append({
+            'id': r['id'],
+            'question_id': r['question_id'],
+            'stem': q['stem'] if q else '题目已删除',
+            'user_answer': r['user_answer'],
+            'correct': r['correct'],
+            'timestamp': r['timestamp']
+        })
+    return records, has_more
+
+
+def archive_status() -> dict:
+    """各表行数、可归档行数与文件大小。"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM history')
+    status = {'history': c.fetchone()[0]}
+    c.execute("SELECT COUNT(*) FROM history WHERE timestamp < datetime('now', ?)",
+              (f'-{_settings["retention_days"]} days',))
+    status['eligible'] = c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM history_daily')
+    status['history_daily'] = c.fetchone()[0]
+    status['archived'] = None
+    if attach_archive(conn):
+        c.execute(f"SELECT name FROM {ARCHIVE_SCHEMA}.sqlite_master WHERE name='history_archive'")
+        if c.fetchone():
+            c.execute(f'SELECT COUNT(*) FROM {ARCHIVE_SCHEMA}.history_archive')
+            status['archived'] = c.fetchone()[0]
+    conn.close()
+    status['db_size'] = os.path.getsize(database.DB_NAME)
+    status['archive_size'] = os.path.getsize(_settings['file']) if os.path.exists(_settings['file']) else 0
+    return status
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='把超过保留期的答题历史移到归档库')
+    parser.add_argument('--db', default=database.DB_NAME, help='主数据库文件')
+    parser.add_argument('--archive', default=None, help='归档库文件（默认取配置 HISTORY_ARCHIVE_FILE）')
+    parser.add_argument('--days', type=int, default=None, help='保留天数（默认取配置 HISTORY_RETENTION_DAYS）')
+    parser.add_argument('--batch', type=int, default=None, help='每个事务移动的行数')
+    parser.add_argument('--vacuum', action='store_true', help='归档后 VACUUM 主库，缩小文件')
+    parser.add_argument('--status', action='store_true', help='只显示状态')
+    return parser
+
+
+def _print_status(status: dict) -> None:
+    archived = '未创建' if status['archived'] is None else status['archived']
+    print(f"history {status['history']} 行（可归档 {status['eligible']}），history_daily {status['history_daily']} 行，"
+          f"归档库 {archived} 行")
+    print(f"主库 {status['db_size'] / 1048576:.1f} MB，归档库 {status['archive_size'] / 1048576:.1f} MB")
+
+
+def main(argv=None) -> int:
+    from config import Config
+
+    configure_archive(vars(Config))
+    args = build_parser().parse_args(argv)
+    database.DB_NAME = args.db
+    if args.archive:
+        _settings['file'] = args.archive
+    if args.days is not None:
+        _settings['retention_days'] = args.days
+    database.init_db()
+    if not args.status:
+        moved = archive_history(batch_size=args.batch)
+        print(f"已归档 {moved} 条早于 {_settings['retention_days']} 天的答题记录到 {_settings['file']}")
+        if args.vacuum:
+            conn = get_db()
+            conn.execute('VACUUM')
+            conn.close()
+    _print_status(archive_status())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""
+静态资源构建与长缓存分发。
+
+构建（部署前运行一次）：
+
+    python assets.py
+
+把 static/ 下的 CSS/JS 精简后按内容哈希写到 static/dist/（如 style.3f2a9c1b0d.css），同时生成 .gz 与
+.br（需安装可选依赖 brotli）预压缩版本和 manifest.json。模板通过 asset_url('style.css') 取带指纹的
+/assets/... 地址；响应带 Cache-Control: public, max-age=31536000, immutable，按 Accept-Encoding 直接发送
+预压缩文件。内容变化即换新文件名，浏览器无需再回源验证。
+
+未构建、或源文件在构建后又被修改时（开发环境），asset_url 回退到 Flask 默认的 /static/ 地址，页面照常工作。
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import sys
+from pathlib import Path
+from typing import Dict, Optional
+
+try:
+    import brotli
+except ImportError:  # 可选依赖：未安装时只生成 gzip 版本
+    brotli = None
+
+from flask import abort, request, send_from_directory, url_for
+
+_BASE_DIR = Path(__file__).resolve().parent
+STATIC_DIR = _BASE_DIR / 'static'
+DIST_DIR = STATIC_DIR / 'dist'
+MANIFEST_NAME = 'manifest.json'
+ASSET_EXTENSIONS = ('.css', '.js')
+HASH_LENGTH = 10
+IMMUTABLE_MAX_AGE = 31536000
+
+_CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*[\s\S]*?\*/)|(\s+)')
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,])\s*')
+
+_settings = {
+    'enabled': True,
+}
+# 逻辑名（相对 static/ 的路径）-> dist 下的文件名；只包含源文件自构建后未被修改的条目
+_manifest: Dict[str, str] = {}
+
+
+def minify_css(text: str) -> str:
+    """去掉注释、折叠空白、去掉 {};, 两侧的空白（字符串原样保留）。"""
+    parts = []
+    position = 0
+    for match in _CSS_TOKENS.finditer(text):
+        parts.append(text[position:match.start()])
+        string, comment, space = match.groups()
+        if string:
+            # 字符串内容不参与后续的标点处理
+            parts.append('\0' + string + '\0')
+        elif space:
+            parts.append(' ')
+        position = match.end()
+    parts.append(text[position:])
+    pieces = ''.join(parts).split('\0')
+    # 偶数下标是字符串之外的部分
+    for index in range(0, len(pieces), 2):
+        pieces[index] = _CSS_PUNCTUATION.sub(r'\1', pieces[index]).replace(';}', '}')
+    return ''.join(pieces).strip()
+
+
+def minify_js(text: str) -> str:
+    """
+    保守的 JS 精简：去掉缩进、空行与整行 // 注释，保留换行（不依赖自动分号插入规则的改写）。
+    跨行模板字符串内部的行原样保留。
+    """
+    lines = []
+    in_template = False
+    for line in text.splitlines():
+        if in_template:
+            lines.append(line)
+        else:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('//'):
+                continue
+            lines.append(stripped)
+        # 统计未转义的反引号，奇数个表示跨行模板字符串开始或结束
+        if len(re.findall(r'(?<!\\)`', line)) % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+
+def _minify(name: str, text: str) -> str:
+    return minify_css(text) if name.endswith('.css') else minify_js(text)
+
+
+def _source_digest(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def source_files(static_dir: Path = STATIC_DIR, dist_dir: Path = DIST_DIR):
+    """static/ 下需要构建的 CSS/JS（不含 dist/ 自身）。"""
+    for path in sorted(static_dir.rglob('*')):
+        if path.is_file() and path.suffix in ASSET_EXTENSIONS and dist_dir not in path.parents:
+            yield path
+
+
+def build_assets(static_dir: Path = STATIC_DIR, dist_dir: Path = DIST_DIR, minify: bool = True) -> Dict[str, Dict]:
+    """构建全部资源并写入 manifest.json，返回 manifest 内容。"""
+    dist_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = dist_dir / MANIFEST_NAME
+    previous = {}
+    if manifest_path.exists():
+        previous = json.loads(manifest_path.read_text(encoding='utf-8'))
+
+    manifest = {}
+    for path in source_files(static_dir, dist_dir):
+        name = path.relative_to(static_dir).as_posix()
+        source = path.read_bytes()
+        output = _minify(name, source.decode('utf-8')).encode('utf-8') if minify else source
+        digest = hashlib.sha256(output).hexdigest()[:HASH_LENGTH]
+        target = f'{Path(name).stem}.{digest}{path.suffix}'
+        if '/' in name:
+            target = f'{name.rsplit("/", 1)[0]}/{target}'
+        target_path = dist_dir / target
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        target_path.write_bytes(output)
+        # mtime=0 让同一内容的 .gz 在每次构建中逐字节一致
+        target_path.with_name(target_path.name + '.gz').write_bytes(gzip.compress(output, 9, mtime=0))
+        if brotli is not None:
+            target_path.with_name(target_path.name + '.br').write_bytes(brotli.compress(output, quality=11))
+        manifest[name] = {
+            'file': target,
+            'source_sha256': hashlib.sha256(source).hexdigest(),
+            'size': len(source),
+            'minified_size': len(output),
+        }
+
+    # 保留上一版文件，滚动发布期间旧页面引用的地址仍然可用；更早的文件清理掉
+    keep = {entry['file'] for entry in manifest.values()} | {entry['file'] for entry in previous.values()}
+    for path in dist_dir.rglob('*'):
+        if not path.is_file() or path.name == MANIFEST_NAME:
+            continue
+        relative = path.relative_to(dist_dir).as_posix()
+        base = relative[:-3] if relative.endswith(('.gz', '.br')) else relative
+        if base not in keep:
+            path.unlink()
+
+    temporary = manifest_path.with_suffix('.tmp')
+    temporary.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding='utf-8')
+    os.replace(temporary, manifest_path)
+    return manifest
+
+
+def load_manifest(static_dir: Path = STATIC_DIR, dist_dir: Path = DIST_DIR) -> Dict[str, str]:
+    """读取 manifest，丢弃源文件在构建后被改动过的条目（这些资源回退到 /static/）。"""
+    manifest_path = dist_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    entries = json.loads(manifest_path.read_text(encoding='utf-8'))
+    current = {}
+    for name, entry in entries.items():
+        source = static_dir / name
+        if not source.exists() or not (dist_dir / entry['file']).exists():
+            continue
+        if _source_digest(source) != entry['source_sha256']:
+            print(f'Static asset {name} changed since the last build; serving it unfingerprinted. Run python assets.py.')
+            continue
+        current[name] = entry['file']
+    return current
+
+
+def asset_url(name: str) -> str:
+    """模板辅助函数：已构建时返回带指纹的 /assets/ 地址，否则回退到 /static/。"""
+    target = _manifest.get(name) if _settings['enabled'] else None
+    if target is None:
+        return url_for('static', filename=name)
+    return url_for('assets', filename=target)
+
+
+def _preferred_encoding(filename: str) -> Optional[str]:
+    encodings = request.accept_encodings
+    if encodings['br'] and (DIST_DIR / (filename + '.br')).is_file():
+        return 'br'
+    if encodings['gzip'] and (DIST_DIR / (filename + '.gz')).is_file():
+        return 'gzip'
+    return None
+
+
+def serve_asset(filename: str):
+    # 只发送构建产物本身（含上一版），manifest 与压缩文件不直接对外
+    if not filename.endswith(ASSET_EXTENSIONS) or not (DIST_DIR / filename).is_file():
+        abort(404)
+    # 按原文件扩展名给出类型（send_from_directory 会为文本类型补上 charset），而不是 .gz/.br 的类型
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = _preferred_encoding(filename)
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+    response = send_from_directory(DIST_DIR, filename + suffix, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def init_assets(app) -> None:
+    """加载 manifest、注册 GET /assets/<filename> 与模板函数 asset_url（在 app.py 中调用一次）。"""
+    _settings['enabled'] = bool(app.config.get('ASSETS_ENABLED', _settings['enabled']))
+    _manifest.clear()
+    if _settings['enabled']:
+        _manifest.update(load_manifest())
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.jinja_env.globals['asset_url'] = asset_url
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='构建带内容指纹、预压缩的静态资源')
+    parser.add_argument('--no-minify', action='store_true', help='只加指纹与压缩，不精简')
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    manifest = build_assets(minify=not args.no_minify)
+    for name, entry in manifest.items():
+        target = DIST_DIR / entry['file']
+        gz_size = target.with_name(target.name + '.gz').stat().st_size
+        print(f'{name:<24} -> dist/{entry["file"]:<36} {entry["size"]:>7} B -> {entry["minified_size"]:>7} B，gzip {gz_size:>6} B')
+    if brotli is None:
+        print('未安装 brotli（pip install brotli），只生成了 gzip 版本。')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
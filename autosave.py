@@ -0,0 +1,146 @@
+"""
+考试与定时模式的作答自动保存（写后缓冲）。
+
+页面在作答变化时调用 POST /exam/<id>/answers，save_answers() 只把答案放进进程内缓冲（同一题只保留最新一次），
+后台线程每 AUTOSAVE_FLUSH_INTERVAL 秒把缓冲中的全部答案用一个事务批量写入 exam_questions.saved_answer。
+几百名考生持续作答时，数据库看到的是每隔几秒一次的批量写，而不是每次点击一次写。缓冲超过
+AUTOSAVE_MAX_PENDING 条时提前唤醒写入；进程正常退出时写完剩余内容。
+
+交卷时 take_exam_answers() 合并已落库与仍在缓冲中的答案并清掉该考试的缓冲，判分只依赖服务端已保存的作答：
+标签页崩溃、刷新或倒计时结束时表单未带上的题目都不会丢失。已批改的题目（correct 非空）不再被写入。
+缓冲只在本进程内：多 worker 时别的进程尚未写入的几秒内容在交卷时看不到，页面提交的表单仍带着全部答案，
+以表单为准。
+"""
+import atexit
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from database import get_db
+
+_settings = {
+    'enabled': True,
+    'interval': 3.0,
+    'max_pending': 5000,
+}
+_lock = threading.Lock()
+# 同一时间只有一次批量写入（后台线程与退出时的 flush）
+_write_lock = threading.Lock()
+# (考试 ID, 题目 ID) -> (答案列表的 JSON, 保存时间)
+_pending: Dict[Tuple[int, str], Tuple[str, datetime]] = {}
+_wake = threading.Event()
+_flusher = {'thread': None}
+
+
+def configure_autosave(config) -> None:
+    """从应用配置读取开关、写入间隔与缓冲上限（在 app.py 中调用一次）。"""
+    _settings['enabled'] = bool(config.get('AUTOSAVE_ENABLED', _settings['enabled']))
+    _settings['interval'] = float(config.get('AUTOSAVE_FLUSH_INTERVAL', _settings['interval']))
+    _settings['max_pending'] = int(config.get('AUTOSAVE_MAX_PENDING', _settings['max_pending']))
+
+
+def autosave_enabled() -> bool:
+    return _settings['enabled']
+
+
+def _ensure_flusher() -> None:
+    if _flusher['thread'] is not None:
+        return
+    with _lock:
+        if _flusher['thread'] is None:
+            thread = threading.Thread(target=_flush_loop, name='exam-autosave', daemon=True)
+            _flusher['thread'] = thread
+            thread.start()
+            atexit.register(flush)
+
+
+def save_answers(exam_id: int, answers: Dict[str, List[str]]) -> None:
+    """把一场考试若干题的当前作答放入缓冲，稍后批量写入。"""
+    if not answers:
+        return
+    _ensure_flusher()
+    now = datetime.now()
+    with _lock:
+        for question_id, values in answers.items():
+            _pending[(exam_id, str(question_id))] = (json.dumps(values, ensure_ascii=False), now)
+        full = len(_pending) >= _settings['max_pending']
+    if full:
+        _wake.set()
+
+
+def flush() -> int:
+    """把缓冲中的全部答案写入数据库，返回写入的条数；数据库繁忙时放回缓冲，下次重试。"""
+    with _write_lock:
+        return _write_pending()
+
+
+def _write_pending() -> int:
+    # 条目在提交成功后才移出缓冲：任何时刻一条答案不是已提交就是仍在缓冲中，读取方无需等待写入
+    with _lock:
+        if not _pending:
+            return 0
+        batch = dict(_pending)
+    rows = [(answer, saved_at, exam_id, question_id)
+            for (exam_id, question_id), (answer, saved_at) in batch.items()]
+    conn = get_db()
+    try:
+        conn.executemany('''
+            UPDATE exam_questions SET saved_answer=?, answered_at=?
+            WHERE exam_id=? AND question_id=? AND correct IS NULL
+        ''', rows)
+        conn.commit()
+    except sqlite3.OperationalError:
+        # 数据库繁忙：条目仍在缓冲中，下次重试
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    with _lock:
+        for key, value in batch.items():
+            # 期间又保存过的题目保留较新的值
+            if _pending.get(key) is value:
+                del _pending[key]
+    return len(rows)
+
+
+def _flush_loop() -> None:
+    while True:
+        _wake.wait(_settings['interval'])
+        _wake.clear()
+        try:
+            flush()
+        except Exception as exc:
+            print(f"Exam autosave flush failed: {exc}")
+
+
+def _pending_for(exam_id: int, remove: bool) -> Dict[str, List[str]]:
+    with _lock:
+        keys = [key for key in _pending if key[0] == exam_id]
+        values = {key[1]: _pending.pop(key) if remove else _pending[key] for key in keys}
+    return {question_id: json.loads(answer) for question_id, (answer, _) in values.items()}
+
+
+def saved_answers(cursor, exam_id: int) -> Dict[str, List[str]]:
+    """一场考试已保存的作答（已落库的加上缓冲中较新的），题目 ID -> 答案列表。"""
+    return _saved_answers(cursor, exam_id, remove=False)
+
+
+def _saved_answers(cursor, exam_id: int, remove: bool) -> Dict[str, List[str]]:
+    # 先取缓冲再读库：缓冲中没有的答案此时已经提交，读库一定能看到；缓冲中的值不旧于库中的值
+    pending = _pending_for(exam_id, remove)
+    cursor.execute('''
+        SELECT question_id, saved_answer FROM exam_questions WHERE exam_id=? AND saved_answer IS NOT NULL
+    ''', (exam_id,))
+    answers = {row['question_id']: json.loads(row['saved_answer']) for row in cursor.fetchall()}
+    answers.update(pending)
+    return answers
+
+
+def take_exam_answers(cursor, exam_id: int) -> Dict[str, List[str]]:
+    """
+    交卷时取出已保存的作答并清掉该考试的缓冲（判分结果随后写入，缓冲中的旧值不应再落库）。
+    可在交卷的写事务中调用：不会等待后台批量写入。
+    """
+    return _saved_answers(cursor, exam_id, remove=True)
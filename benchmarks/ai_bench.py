@@ -0,0 +1,216 @@
+"""
+/ai/run 并发压测。
+
+对一个正在运行的应用实例（python app.py、gunicorn 或 uvicorn ai_async:asgi_app 均可）并发发起流式 AI 请求，
+统计首字节时间、总耗时、输出速度与错误率，以及压测期间同时在途的流数量。通常配合本地模拟供应商使用：
+
+    python benchmarks/mock_provider.py --port 18080 --tokens 200 --tokens-per-second 40
+    python benchmarks/ai_bench.py --app http://127.0.0.1:32220 --provider-url http://127.0.0.1:18080 \\
+        --concurrency 20 --requests 200
+
+也可以加 --start-mock 在压测进程内启动合成模式的模拟供应商。压测会注册（或登录）一个专用账号，
+并为其添加指向模拟供应商的 AI 配置；题目编号取自本地 database.db。
+"""
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import mock_provider  # noqa: E402
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def load_question_ids(db_path: str, bank_id: int, limit: int) -> List[str]:
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            'SELECT id FROM questions WHERE question_bank_id=? ORDER BY CAST(id AS INTEGER) LIMIT ?',
+            (bank_id, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+
+def prepare_session(args) -> requests.Session:
+    """注册/登录压测账号，并确保其激活的 AI 配置指向模拟供应商。"""
+    session = requests.Session()
+    base = args.app.rstrip('/')
+    credentials = {'username': args.username, 'password': args.password}
+    session.post(f'{base}/register', data={**credentials, 'confirm_password': args.password})
+    resp = session.post(f'{base}/login', data=credentials)
+    resp.raise_for_status()
+    if 'session' not in session.cookies:
+        raise SystemExit('登录失败，请检查 --username / --password。')
+
+    status = session.get(f'{base}/ai/providers/status').json()
+    if not status.get('providers'):
+        session.post(f'{base}/ai/providers', data={
+            'provider_name': 'bench-mock',
+            'base_url': args.provider_url,
+            'model': args.model,
+            'api_key': 'bench'
+        }).raise_for_status()
+    return session
+
+
+class Tracker:
+    """统计同时在途的流数量。"""
+
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        return self
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.active -= 1
+
+
+def run_one(session: requests.Session, args, question_id: str, tracker: Tracker) -> Dict:
+    url = args.app.rstrip('/') + '/ai/run'
+    payload = {
+        'mode': args.mode,
+        'question_id': question_id,
+        'question_bank_id': args.bank,
+        'user_answer': args.user_answer
+    }
+    started = time.perf_counter()
+    first_byte = None
+    size = 0
+    text_parts = []
+    with tracker:
+        try:
+            with session.post(url, json=payload, stream=True, timeout=args.timeout) as resp:
+                for piece in resp.iter_content(chunk_size=None):
+                    if first_byte is None:
+                        first_byte = time.perf_counter()
+                    size += len(piece)
+                    text_parts.append(piece)
+                status = resp.status_code
+        except requests.RequestException as exc:
+            return {'ok': False, 'error': str(exc), 'total': time.perf_counter() - started}
+    total = time.perf_counter() - started
+    text = b''.join(text_parts).decode('utf-8', errors='replace')
+    ok = status == 200 and '[ERROR]' not in text
+    return {
+        'ok': ok,
+        'error': None if ok else (text[-200:] or f'HTTP {status}'),
+        'ttfb': (first_byte - started) if first_byte else None,
+        'total': total,
+        'chars': len(text),
+        'bytes': size
+    }
+
+
+def summarize(results: List[Dict], elapsed: float, tracker: Tracker) -> Dict:
+    ok = [r for r in results if r['ok']]
+    ttfb = [r['ttfb'] * 1000 for r in ok if r.get('ttfb') is not None]
+    totals = [r['total'] * 1000 for r in ok]
+    chars = sum(r['chars'] for r in ok)
+    errors: Dict[str, int] = {}
+    for result in results:
+        if not result['ok']:
+            key = (result['error'] or '').strip()[:80]
+            errors[key] = errors.get(key, 0) + 1
+
+    def dist(values):
+        return {name: round(percentile(values, q), 1) if values else None
+                for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}
+
+    return {
+        'requests': len(results),
+        'succeeded': len(ok),
+        'failed': len(results) - len(ok),
+        'elapsed_seconds': round(elapsed, 2),
+        'requests_per_second': round(len(results) / elapsed, 2) if elapsed else None,
+        'chars_per_second': round(chars / elapsed, 1) if elapsed else None,
+        'peak_concurrent_streams': tracker.peak,
+        'ttfb_ms': dist(ttfb),
+        'total_ms': dist(totals),
+        'errors': errors
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='/ai/run 并发压测')
+    parser.add_argument('--app', default='http://127.0.0.1:32220', help='应用地址')
+    parser.add_argument('--provider-url', default='http://127.0.0.1:18080', help='模拟供应商地址')
+    parser.add_argument('--model', default='mock-model')
+    parser.add_argument('--start-mock', action='store_true', help='在本进程内启动合成模式的模拟供应商')
+    parser.add_argument('--username', default='ai_bench')
+    parser.add_argument('--password', default='ai_bench_password')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--mode', choices=('hint', 'analysis'), default='hint')
+    parser.add_argument('--user-answer', default='A', help='analysis 模式下提交的作答')
+    parser.add_argument('--bank', type=int, default=0, help='题库编号')
+    parser.add_argument('--db', default='database.db', help='读取题目编号的数据库文件')
+    parser.add_argument('--distinct', type=int, default=50,
+                        help='轮流使用的不同题目数量；1 表示所有请求相同（测试合流效果）')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', help='把汇总结果写入该文件')
+    return parser
+
+
+def main(argv=None) -> None:
+    args = build_parser().parse_args(argv)
+    if args.start_mock:
+        port = int(args.provider_url.rsplit(':', 1)[-1].split('/')[0])
+        mock_args = mock_provider.build_parser().parse_args(['--port', str(port)])
+        server = mock_provider.create_server(mock_args)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    question_ids = load_question_ids(args.db, args.bank, args.distinct)
+    if not question_ids:
+        raise SystemExit(f'{args.db} 中题库 {args.bank} 没有题目。')
+    session = prepare_session(args)
+    tracker = Tracker()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(run_one, session, args, question_ids[index % len(question_ids)], tracker)
+            for index in range(args.requests)
+        ]
+        results = [future.result() for future in futures]
+    summary = summarize(results, time.perf_counter() - started, tracker)
+
+    # 压测账号是管理员时附带服务端视角的指标（供应商首包耗时、取消原因）
+    resp = session.get(args.app.rstrip('/') + '/ai/metrics')
+    if resp.status_code == 200:
+        server = resp.json()
+        summary['server'] = {
+            'cancellations': server.get('cancellations'),
+            'providers': {name: {'outcomes': stats['outcomes'], 'ttft_ms': stats['ttft_ms']['p95']}
+                          for name, stats in (server.get('providers') or {}).items()}
+        }
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
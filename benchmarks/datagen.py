@@ -0,0 +1,252 @@
+"""
+合成压测数据生成器。
+
+按 CSV 题库的字段结构（题号、题干、A~E 选项、答案、难度、题型、类别）生成大规模题库，并生成用户、作答历史、
+收藏与考试记录，用于在接近生产规模的数据上复现性能问题。同一组参数与 --seed 生成的数据完全一致（时间戳相对生成时刻）。
+
+    python benchmarks/datagen.py --db bench.db --questions 100000 --users 10000 --history 10000000
+
+题目写入系统默认题库（编号 0，所有用户可见）；--extra-banks 额外为部分用户生成私有题库。所有用户名为
+user00001 这样的格式，密码统一为 --password（默认 bench-password），供 load_test.py 登录使用。
+--csv 同时导出一份可在“导入题库”页面上传的 CSV。
+"""
+import argparse
+import csv
+import json
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import database  # noqa: E402
+
+QUESTION_TYPES = ('单选题', '多选题', '判断题', '填空题')
+DIFFICULTIES = ('简单', '中等', '困难')
+CATEGORIES = ('马克思主义基本原理', '毛泽东思想', '中国特色社会主义', '近现代史纲要', '思想道德与法治', '形势与政策')
+OPTION_KEYS = ('A', 'B', 'C', 'D', 'E')
+WORDS = ('发展', '人民', '理论', '实践', '历史', '制度', '经济', '社会', '文化', '改革', '开放', '创新', '民主',
+         '法治', '生态', '安全', '科学', '群众', '路线', '道路', '政党', '国家', '治理', '现代化', '共同体', '思想',
+         '原理', '方法', '矛盾', '规律', '生产力', '生产关系', '基础', '上层建筑', '意识', '物质', '真理', '价值')
+BATCH_SIZE = 50000
+
+# 一道题：(id, stem, answer, difficulty, qtype, category, options_json)
+Question = Tuple[str, str, str, str, str, str, str]
+
+
+def parse_type_mix(text: str) -> Dict[str, float]:
+    """解析 "单选题=0.5,多选题=0.2,判断题=0.2,填空题=0.1"，权重无需归一化。"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in QUESTION_TYPES:
+            raise SystemExit(f'未知题型: {name}（可选 {"、".join(QUESTION_TYPES)}）')
+        mix[name] = float(weight)
+    return mix
+
+
+def _sentence(rng: random.Random, low: int, high: int) -> str:
+    return ''.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def make_question(rng: random.Random, index: int, qtype: str) -> Question:
+    qid = f'Q{index:06d}'
+    stem = _sentence(rng, 8, 20)
+    options: Dict[str, str] = {}
+    if qtype == '判断题':
+        answer = rng.choice(('正确', '错误'))
+        stem += '。'
+    elif qtype == '填空题':
+        blanks = [rng.choice(WORDS) for _ in range(rng.randint(1, 3))]
+        stem += '（ ）' * len(blanks) + '。'
+        answer = ''.join(f'({blank})' for blank in blanks)
+    else:
+        keys = OPTION_KEYS[:rng.choice((4, 4, 4, 5))]
+        options = {key: _sentence(rng, 2, 6) for key in keys}
+        if qtype == '单选题':
+            answer = rng.choice(keys)
+        else:
+            answer = ''.join(sorted(rng.sample(keys, rng.randint(2, len(keys)))))
+        stem += '（ ）。'
+    return (qid, stem, answer, rng.choice(DIFFICULTIES), qtype, rng.choice(CATEGORIES),
+            json.dumps(options, ensure_ascii=False))
+
+
+def wrong_answer(rng: random.Random, qtype: str, answer: str, options_json: str) -> str:
+    if qtype == '判断题':
+        return '错误' if answer == '正确' else '正确'
+    if qtype == '填空题':
+        return f'({rng.choice(WORDS)})'
+    keys = [key for key in json.loads(options_json)] or list(OPTION_KEYS[:4])
+    if qtype == '单选题':
+        return rng.choice([key for key in keys if key != answer] or keys)
+    candidate = ''.join(sorted(rng.sample(keys, rng.randint(1, len(keys)))))
+    return candidate if candidate != answer else keys[0]
+
+
+def generate_questions(rng: random.Random, count: int, mix: Dict[str, float], start: int = 1) -> List[Question]:
+    types = list(mix)
+    weights = [mix[name] for name in types]
+    return [make_question(rng, start + index, rng.choices(types, weights)[0]) for index in range(count)]
+
+
+def _batched(rows: Iterator, size: int = BATCH_SIZE) -> Iterator[List]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert_questions(conn: sqlite3.Connection, questions: List[Question], bank_id: int) -> None:
+    conn.executemany(
+        'INSERT INTO questions (id, stem, answer, difficulty, qtype, category, options, question_type, question_bank_id) '
+        'VALUES (?,?,?,?,?,?,?,?,?)',
+        [(*question, question[4], bank_id) for question in questions]
+    )
+
+
+def _history_rows(rng: random.Random, total: int, users: int, questions: List[Question],
+                  correct_rate: float, days: int) -> Iterator[Tuple]:
+    now = datetime.now()
+    for _ in range(total):
+        user_id = rng.randint(1, users)
+        question = rng.choice(questions)
+        correct = rng.random() < correct_rate
+        answer = question[2] if correct else wrong_answer(rng, question[4], question[2], question[6])
+        timestamp = now - timedelta(seconds=rng.randint(0, days * 86400))
+        yield (user_id, question[0], 0, answer, int(correct), timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _exam_rows(rng: random.Random, total: int, users: int, questions: List[Question], days: int) -> Iterator[Tuple]:
+    now = datetime.now()
+    for _ in range(total):
+        mode = rng.choice(('exam', 'timed'))
+        ids = [question[0] for question in rng.sample(questions, min(len(questions), rng.choice((10, 20, 50))))]
+        start = now - timedelta(seconds=rng.randint(0, days * 86400))
+        yield (rng.randint(1, users), mode, json.dumps(ids), start.strftime('%Y-%m-%d %H:%M:%S.%f'),
+               600 if mode == 'timed' else 0, 1, round(rng.uniform(30, 100), 2), 0)
+
+
+def write_csv(path: str, questions: List[Question]) -> None:
+    with open(path, 'w', encoding='utf-8-sig', newline='') as csv_file:
+        writer = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
+        writer.writerow(['题号', '题干', *OPTION_KEYS, '答案', '难度', '题型', '类别'])
+        for qid, stem, answer, difficulty, qtype, category, options_json in questions:
+            options = json.loads(options_json)
+            writer.writerow([qid, stem, *(options.get(key, '') for key in OPTION_KEYS),
+                             answer, difficulty, qtype, category])
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='生成压测用的合成题库、用户与作答数据')
+    parser.add_argument('--db', default='bench.db', help='目标数据库文件（不存在时创建）')
+    parser.add_argument('--questions', type=int, default=100000, help='系统题库题目数')
+    parser.add_argument('--type-mix', default='单选题=0.5,多选题=0.2,判断题=0.2,填空题=0.1', help='题型比例')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--password', default='bench-password', help='所有合成用户的密码')
+    parser.add_argument('--history', type=int, default=1000000, help='作答历史条数')
+    parser.add_argument('--correct-rate', type=float, default=0.7)
+    parser.add_argument('--favorites', type=int, default=10, help='每个用户的收藏数')
+    parser.add_argument('--exams', type=int, default=20000, help='已完成的考试/定时练习记录数')
+    parser.add_argument('--extra-banks', type=int, default=0, help='额外生成的私有题库数（属于前几个用户）')
+    parser.add_argument('--extra-bank-size', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=180, help='历史记录时间跨度（天）')
+    parser.add_argument('--seed', type=int, default=20240501)
+    parser.add_argument('--csv', help='同时把系统题库导出为可导入的 CSV')
+    parser.add_argument('--force', action='store_true', help='目标数据库已存在时先删除')
+    return parser
+
+
+def main(argv=None) -> None:
+    args = build_parser().parse_args(argv)
+    db_path = Path(args.db)
+    if db_path.exists():
+        if not args.force:
+            raise SystemExit(f'{db_path} 已存在，加 --force 覆盖。')
+        db_path.unlink()
+    rng = random.Random(args.seed)
+    mix = parse_type_mix(args.type_mix)
+    started = time.perf_counter()
+
+    # 先由 init_db 建出与应用完全一致的表结构与索引，再清掉它灌入的默认 CSV
+    database.DB_NAME = str(db_path)
+    database.init_db()
+    conn = sqlite3.connect(str(db_path))
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA journal_mode=MEMORY')
+    conn.execute('DELETE FROM questions WHERE question_bank_id=?', (database.SYSTEM_QUESTION_BANK_ID,))
+    conn.execute('DELETE FROM question_tombstones')
+
+    questions = generate_questions(rng, args.questions, mix)
+    _insert_questions(conn, questions, database.SYSTEM_QUESTION_BANK_ID)
+    print(f'题目 {len(questions)} 道')
+
+    password_hash = generate_password_hash(args.password)
+    conn.executemany(
+        'INSERT INTO users (id, username, password_hash, active_question_bank_id) VALUES (?,?,?,0)',
+        ((user_id, f'user{user_id:05d}', password_hash) for user_id in range(1, args.users + 1))
+    )
+    print(f'用户 {args.users} 个')
+
+    for bank_index in range(args.extra_banks):
+        owner = bank_index % args.users + 1
+        cursor = conn.execute('INSERT INTO question_banks (user_id, name, description) VALUES (?,?,?)',
+                              (owner, f'合成题库 {bank_index + 1}', '由 benchmarks/datagen.py 生成'))
+        _insert_questions(conn, generate_questions(rng, args.extra_bank_size, mix), cursor.lastrowid)
+    if args.extra_banks:
+        print(f'私有题库 {args.extra_banks} 个，每个 {args.extra_bank_size} 道')
+
+    written = 0
+    for batch in _batched(_history_rows(rng, args.history, args.users, questions, args.correct_rate, args.days)):
+        conn.executemany(
+            'INSERT INTO history (user_id, question_id, question_bank_id, user_answer, correct, timestamp) '
+            'VALUES (?,?,?,?,?,?)', batch
+        )
+        written += len(batch)
+        print(f'\r作答历史 {written}/{args.history}', end='', flush=True)
+    print()
+
+    favorites = ((user_id, question[0], 0, rng.choice(('', '重点', '易错')))
+                 for user_id in range(1, args.users + 1)
+                 for question in rng.sample(questions, min(args.favorites, len(questions))))
+    for batch in _batched(favorites):
+        conn.executemany(
+            'INSERT OR IGNORE INTO favorites (user_id, question_id, question_bank_id, tag) VALUES (?,?,?,?)', batch
+        )
+    for batch in _batched(_exam_rows(rng, args.exams, args.users, questions, args.days)):
+        conn.executemany(
+            'INSERT INTO exam_sessions (user_id, mode, question_ids, start_time, duration, completed, score, '
+            'question_bank_id) VALUES (?,?,?,?,?,?,?,?)', batch
+        )
+    # 试卷展开到 exam_questions（与应用一致，question_ids 列置空）；对错按得分比例确定性地分布
+    conn.execute('''
+        INSERT INTO exam_questions (exam_id, position, question_id, user_answer, correct, answered_at)
+        SELECT e.id, j.key, j.value, '', (e.id * 7919 + j.key * 104729) % 100 < e.score, e.start_time
+        FROM exam_sessions e, json_each(e.question_ids) j
+    ''')
+    conn.execute("UPDATE exam_sessions SET question_ids='[]'")
+    print(f'收藏 {args.favorites}/人，考试记录 {args.exams} 条')
+
+    # 与应用写入题目时一致：递增题库版本并给新题目打上版本号
+    for (bank_id,) in conn.execute('SELECT DISTINCT question_bank_id FROM questions').fetchall():
+        database.bump_bank_version(conn.cursor(), bank_id)
+    conn.commit()
+    conn.close()
+    if args.csv:
+        write_csv(args.csv, questions)
+        print(f'已导出 {args.csv}')
+    print(f'完成：{db_path}（{db_path.stat().st_size / 1048576:.1f} MB，耗时 {time.perf_counter() - started:.1f} 秒）')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+端到端压测场景。
+
+对一个正在运行的应用实例，以 --clients 个并发虚拟用户执行脚本化场景，按步骤统计 p50/p95/p99 与吞吐。
+用户来自 datagen.py 生成的数据库（user00001 ...，密码相同），答案从同一数据库读取以便按正确率作答。
+
+    python benchmarks/datagen.py --db bench.db --questions 100000 --users 10000 --history 10000000
+    # 把 bench.db 复制为应用目录下的 database.db 后启动应用
+    python benchmarks/load_test.py --db bench.db --scenario practice,browse --clients 50 --iterations 20
+
+场景：
+- login：所有客户端同时登录（登录风暴，含密码哈希校验）。
+- practice：随机抽题 -> 提交答案，循环 --iterations 次。
+- exam：开始考试 -> 加载试卷 -> 所有客户端在同一时刻交卷（交卷铃声）。
+- browse：分页浏览、关键词搜索、统计页与历史页。
+- ai：通过本地模拟供应商（mock_provider.py）请求 /ai/run 流式解析。
+
+--json 保存结果，--compare 与之前保存的结果对比各步骤 p95，用于性能改动前后的回归比较。
+"""
+import argparse
+import json
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import ai_bench  # noqa: E402
+import mock_provider  # noqa: E402
+from ai_bench import percentile  # noqa: E402
+from database import parse_fill_answers  # noqa: E402
+from datagen import WORDS, wrong_answer  # noqa: E402
+
+_QUESTION_LINK = re.compile(r'action="/question/([^"]+)"')
+_EXAM_FIELD = re.compile(r'name="answer_([^"]+)"')
+
+
+class Recorder:
+    """按步骤名汇总耗时（毫秒）与错误，线程安全。"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, step: str, elapsed_ms: float, ok: bool) -> None:
+        with self._lock:
+            self.samples.setdefault(step, []).append(elapsed_ms)
+            if not ok:
+                self.errors[step] = self.errors.get(step, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict:
+        steps = {}
+        for step, values in sorted(self.samples.items()):
+            steps[step] = {
+                'count': len(values),
+                'errors': self.errors.get(step, 0),
+                'mean_ms': round(sum(values) / len(values), 1),
+                'p50_ms': round(percentile(values, 0.5), 1),
+                'p95_ms': round(percentile(values, 0.95), 1),
+                'p99_ms': round(percentile(values, 0.99), 1),
+                'per_second': round(len(values) / elapsed, 2) if elapsed else None
+            }
+        total = sum(item['count'] for item in steps.values())
+        return {
+            'elapsed_seconds': round(elapsed, 2),
+            'requests': total,
+            'errors': sum(item['errors'] for item in steps.values()),
+            'requests_per_second': round(total / elapsed, 2) if elapsed else None,
+            'steps': steps
+        }
+
+
+class Client:
+    """一个虚拟用户：独立的 Session，所有请求都经 call 计时。"""
+
+    def __init__(self, base: str, recorder: Recorder, timeout: float):
+        self.base = base.rstrip('/')
+        self.session = requests.Session()
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def call(self, step: str, method: str, path: str, expect_redirect: bool = False, **kwargs) -> Optional[requests.Response]:
+        started = time.perf_counter()
+        try:
+            resp = self.session.request(method, self.base + path, timeout=self.timeout,
+                                        allow_redirects=not expect_redirect, **kwargs)
+        except requests.RequestException:
+            self.recorder.add(step, (time.perf_counter() - started) * 1000, False)
+            return None
+        ok = resp.status_code in (301, 302, 303) if expect_redirect else resp.status_code < 400
+        self.recorder.add(step, (time.perf_counter() - started) * 1000, ok)
+        return resp
+
+    def login(self, username: str, password: str) -> bool:
+        resp = self.call('login', 'POST', '/login', expect_redirect=True,
+                         data={'username': username, 'password': password})
+        return resp is not None and '/login' not in resp.headers.get('Location', '/login')
+
+
+class Workload:
+    """场景共享的只读数据：题目答案、账号范围与运行参数。"""
+
+    def __init__(self, args):
+        self.args = args
+        conn = sqlite3.connect(args.db)
+        try:
+            rows = conn.execute(
+                'SELECT id, question_type, answer, options FROM questions WHERE question_bank_id=?', (args.bank,)
+            ).fetchall()
+            self.user_count = conn.execute('SELECT COUNT(*) FROM users WHERE username LIKE ?', ('user%',)).fetchone()[0]
+        finally:
+            conn.close()
+        if not rows or not self.user_count:
+            raise SystemExit(f'{args.db} 中没有合成题目或用户，请先运行 datagen.py。')
+        self.questions = {row[0]: row[1:] for row in rows}
+
+    def username(self, index: int) -> str:
+        return f'user{(self.args.user_offset + index) % self.user_count + 1:05d}'
+
+    def answer_values(self, rng: random.Random, qid: str) -> List[str]:
+        """按 --correct-rate 生成一组提交值（与表单字段一致：多选/填空为多个值）。"""
+        question = self.questions.get(qid)
+        if question is None:
+            return ['A']
+        qtype, answer, options_json = question
+        if rng.random() >= self.args.correct_rate:
+            answer = wrong_answer(rng, qtype, answer, options_json or '{}')
+        if qtype == '填空题':
+            return parse_fill_answers(answer) or [answer]
+        if qtype == '多选题':
+            return list(answer)
+        return [answer]
+
+
+def scenario_login(client: Client, work: Workload, index: int, rng: random.Random, bell: threading.Barrier) -> None:
+    bell.wait()
+    for _ in range(work.args.iterations):
+        client.session.cookies.clear()
+        client.login(work.username(index), work.args.password)
+
+
+def scenario_practice(client: Client, work: Workload, index: int, rng: random.Random, bell: threading.Barrier) -> None:
+    if not client.login(work.username(index), work.args.password):
+        return
+    for _ in range(work.args.iterations):
+        resp = client.call('practice.random', 'GET', '/random')
+        match = _QUESTION_LINK.search(resp.text) if resp is not None else None
+        if not match:
+            continue
+        qid = match.group(1)
+        client.call('practice.submit', 'POST', f'/question/{qid}', data={'answer': work.answer_values(rng, qid)})
+
+
+def scenario_exam(client: Client, work: Workload, index: int, rng: random.Random, bell: threading.Barrier) -> None:
+    logged_in = client.login(work.username(index), work.args.password)
+    qids: List[str] = []
+    if logged_in:
+        client.call('exam.start', 'POST', '/start_exam', expect_redirect=True,
+                    data={'question_count': work.args.exam_size})
+        resp = client.call('exam.load', 'GET', '/exam')
+        if resp is not None:
+            qids = list(dict.fromkeys(_EXAM_FIELD.findall(resp.text)))
+    # 所有客户端（包括失败的）都要到达栅栏，否则其余客户端会一直等待
+    bell.wait()
+    if qids:
+        form = {f'answer_{qid}': work.answer_values(rng, qid) for qid in qids}
+        client.call('exam.submit', 'POST', '/submit_exam', data=form)
+
+
+def scenario_browse(client: Client, work: Workload, index: int, rng: random.Random, bell: threading.Barrier) -> None:
+    if not client.login(work.username(index), work.args.password):
+        return
+    for _ in range(work.args.iterations):
+        client.call('browse.page', 'GET', '/browse', params={'page': rng.randint(1, 50)})
+        client.call('browse.search', 'GET', '/browse', params={'search': rng.choice(WORDS)})
+        client.call('browse.search_form', 'POST', '/search', data={'query': rng.choice(WORDS)})
+        client.call('browse.statistics', 'GET', '/statistics')
+        client.call('browse.history', 'GET', '/history')
+
+
+def scenario_ai(client: Client, work: Workload, index: int, rng: random.Random, bell: threading.Barrier) -> None:
+    if not client.login(work.username(index), work.args.password):
+        return
+    status = client.session.get(client.base + '/ai/providers/status', timeout=client.timeout).json()
+    if not status.get('providers'):
+        client.call('ai.configure', 'POST', '/ai/providers', data={
+            'provider_name': 'bench-mock',
+            'base_url': work.args.provider_url,
+            'model': 'mock-model',
+            'api_key': 'bench'
+        })
+    run_args = argparse.Namespace(app=client.base, mode='analysis', bank=work.args.bank, user_answer='A',
+                                  timeout=client.timeout)
+    tracker = ai_bench.Tracker()
+    qids = list(work.questions)
+    for _ in range(work.args.iterations):
+        result = ai_bench.run_one(client.session, run_args, rng.choice(qids), tracker)
+        if result.get('ttfb') is not None:
+            client.recorder.add('ai.first_byte', result['ttfb'] * 1000, result['ok'])
+        client.recorder.add('ai.stream', result['total'] * 1000, result['ok'])
+
+
+SCENARIOS: Dict[str, Callable] = {
+    'login': scenario_login,
+    'practice': scenario_practice,
+    'exam': scenario_exam,
+    'browse': scenario_browse,
+    'ai': scenario_ai,
+}
+
+
+def run_scenario(name: str, work: Workload) -> Dict:
+    args = work.args
+    recorder = Recorder()
+    bell = threading.Barrier(args.clients)
+    scenario = SCENARIOS[name]
+
+    def worker(index: int) -> None:
+        client = Client(args.app, recorder, args.timeout)
+        scenario(client, work, index, random.Random(args.seed * 100003 + index), bell)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        for future in [executor.submit(worker, index) for index in range(args.clients)]:
+            future.result()
+    return recorder.summary(time.perf_counter() - started)
+
+
+def print_summary(name: str, summary: Dict, baseline: Optional[Dict]) -> None:
+    print(f'\n== {name}: {summary["requests"]} 个请求，{summary["errors"]} 个错误，'
+          f'{summary["elapsed_seconds"]} 秒，{summary["requests_per_second"]} req/s')
+    print(f'{"步骤":<22}{"次数":>8}{"错误":>6}{"p50":>10}{"p95":>10}{"p99":>10}{"req/s":>9}  对比基线 p95')
+    for step, item in summary['steps'].items():
+        delta = ''
+        before = ((baseline or {}).get('steps') or {}).get(step)
+        if before and before.get('p95_ms'):
+            delta = f'{(item["p95_ms"] - before["p95_ms"]) / before["p95_ms"]:+.1%}'
+        print(f'{step:<22}{item["count"]:>8}{item["errors"]:>6}{item["p50_ms"]:>10}{item["p95_ms"]:>10}'
+              f'{item["p99_ms"]:>10}{item["per_second"]:>9}  {delta}')
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='端到端压测场景')
+    parser.add_argument('--app', default='http://127.0.0.1:32220', help='应用地址')
+    parser.add_argument('--db', default='bench.db', help='datagen.py 生成的数据库（读取账号与答案）')
+    parser.add_argument('--scenario', default='login,practice,exam,browse',
+                        help=f'逗号分隔，可选 {",".join(SCENARIOS)}')
+    parser.add_argument('--clients', type=int, default=20, help='并发虚拟用户数')
+    parser.add_argument('--iterations', type=int, default=10, help='每个虚拟用户的循环次数')
+    parser.add_argument('--exam-size', type=int, default=20, help='每份试卷的题目数')
+    parser.add_argument('--password', default='bench-password')
+    parser.add_argument('--user-offset', type=int, default=0, help='从第几个合成用户开始分配账号')
+    parser.add_argument('--correct-rate', type=float, default=0.7)
+    parser.add_argument('--bank', type=int, default=0)
+    parser.add_argument('--provider-url', default='http://127.0.0.1:18080', help='ai 场景使用的模拟供应商地址')
+    parser.add_argument('--start-mock', action='store_true', help='ai 场景在本进程内启动合成模式的模拟供应商')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='把结果写入该文件')
+    parser.add_argument('--compare', help='与之前 --json 保存的结果对比')
+    return parser
+
+
+def main(argv=None) -> None:
+    args = build_parser().parse_args(argv)
+    names = [name.strip() for name in args.scenario.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f'未知场景: {", ".join(unknown)}')
+    if 'ai' in names and args.start_mock:
+        port = int(args.provider_url.rsplit(':', 1)[-1].split('/')[0])
+        server = mock_provider.create_server(mock_provider.build_parser().parse_args(['--port', str(port)]))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    work = Workload(args)
+    baseline = json.loads(Path(args.compare).read_text(encoding='utf-8')) if args.compare else {}
+    results = {
+        'config': {key: getattr(args, key) for key in ('clients', 'iterations', 'exam_size', 'correct_rate', 'seed')},
+        'scenarios': {}
+    }
+    for name in names:
+        summary = run_scenario(name, work)
+        results['scenarios'][name] = summary
+        print_summary(name, summary, (baseline.get('scenarios') or {}).get(name))
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f'\n结果已写入 {args.json}')
+
+
+if __name__ == '__main__':
+    main()
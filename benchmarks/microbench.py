@@ -0,0 +1,313 @@
+"""
+热点函数微基准与回归门禁。
+
+在临时数据库上按多个题库规模（默认 1000 / 10000 / 50000 道题）测量 database.py 与判分相关的热点函数，
+与仓库中的 benchmarks/baseline.json 对比，任一项比基线慢超过阈值（默认 40%，基线文件中可按项目调整）
+即以非零状态退出，防止在热点路径上重新引入 O(n) 的实现。
+
+    python benchmarks/microbench.py                    # 与基线对比
+    python benchmarks/microbench.py --update-baseline  # 接受当前结果为新基线（性能改进后提交）
+
+每项取多轮测量中单次调用耗时的最小值，超出阈值的项目会重测（--retries）后再判定。查询类函数在测量期间共用
+一个连接（get_db() 返回同一连接），只计语句本身的耗时；打开连接与首条语句解析表结构的开销单独记为 get_db 一项，
+不再混进每个函数的结果里放大抖动。不同机器的绝对耗时不同，基线同时记录一段固定纯 Python 负载的耗时
+（calibration），在测量前、每个规模之后与测量结束时各测一次取中位数，对比时按两台机器的 calibration 比值缩放基线。
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import database  # noqa: E402
+from blueprints.quiz import serialize_user_answer, validate_answer_by_type  # noqa: E402
+from datagen import generate_questions, parse_type_mix, write_csv  # noqa: E402
+
+BASELINE_PATH = Path(__file__).resolve().parent / 'baseline.json'
+DEFAULT_SIZES = (1000, 10000, 50000)
+DEFAULT_MIX = '单选题=0.5,多选题=0.2,判断题=0.2,填空题=0.1'
+BENCH_USER_ID = 1
+BENCH_BANKS_PER_USER = 5
+# 亚微秒级的纯 Python 函数受 CPU 频率与调度抖动影响大，基线中给它们更宽的阈值
+GRADING_THRESHOLD_PERCENT = 60.0
+# 单轮测量的目标时长（秒），不足时自动增加循环次数
+TARGET_ROUND_SECONDS = 0.1
+
+
+def measure(func: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None) -> float:
+    """返回单次调用的最小耗时（微秒）；提供 setup 时每次调用前执行且不计时。"""
+    if setup is not None:
+        best = float('inf')
+        for _ in range(repeat):
+            setup()
+            started = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - started)
+        return best * 1e6
+
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= TARGET_ROUND_SECONDS or loops >= 1 << 20:
+            break
+        loops *= 2 if elapsed <= 0 else max(2, min(10, int(TARGET_ROUND_SECONDS / elapsed) + 1))
+    best = elapsed / loops
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, (time.perf_counter() - started) / loops)
+    return best * 1e6
+
+
+class _ReusedConnection(database.InstrumentedConnection):
+    """测量期间所有 get_db() 共用的连接，函数内的 close() 不真正关闭。"""
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def reused_connection(path: str):
+    conn = sqlite3.connect(path, factory=_ReusedConnection)
+    conn.row_factory = sqlite3.Row
+    get_db = database.get_db
+    database.get_db = lambda: conn
+    try:
+        yield conn
+    finally:
+        database.get_db = get_db
+        conn.rollback()
+        sqlite3.Connection.close(conn)
+
+
+def calibrate() -> float:
+    """固定的纯 Python 负载，用于在不同机器之间换算基线。"""
+    data = [json.dumps({'id': index, 'value': str(index * 7919 % 10007)}) for index in range(2000)]
+
+    def workload():
+        return sorted(json.loads(item)['value'] for item in data)
+
+    return measure(workload, 7)
+
+
+def build_database(path: str, size: int, rng: random.Random) -> List[Tuple]:
+    """建出与应用一致的表结构，写入 size 道题、一个答过一半题目的用户及其若干私有题库。"""
+    database.DB_NAME = path
+    with contextlib.redirect_stdout(io.StringIO()):
+        database.init_db()
+    conn = sqlite3.connect(path)
+    conn.execute('DELETE FROM questions')
+    questions = generate_questions(rng, size, parse_type_mix(DEFAULT_MIX))
+    conn.executemany(
+        'INSERT INTO questions (id, stem, answer, difficulty, qtype, category, options, question_type, question_bank_id) '
+        'VALUES (?,?,?,?,?,?,?,?,?)',
+        [(*question, question[4], database.SYSTEM_QUESTION_BANK_ID) for question in questions]
+    )
+    conn.execute("INSERT INTO users (id, username, password_hash) VALUES (?, 'bench', 'x')", (BENCH_USER_ID,))
+    conn.executemany(
+        'INSERT INTO history (user_id, question_id, question_bank_id, user_answer, correct) VALUES (?,?,0,?,1)',
+        [(BENCH_USER_ID, question[0], question[2]) for question in questions[:size // 2]]
+    )
+    for index in range(BENCH_BANKS_PER_USER):
+        bank_id = conn.execute('INSERT INTO question_banks (user_id, name) VALUES (?,?)',
+                               (BENCH_USER_ID, f'bank {index}')).lastrowid
+        conn.executemany(
+            'INSERT INTO questions (id, stem, answer, difficulty, qtype, category, options, question_type, '
+            'question_bank_id) VALUES (?,?,?,?,?,?,?,?,?)',
+            [(*question, question[4], bank_id) for question in questions[:size // 10]]
+        )
+    conn.commit()
+    conn.close()
+    return questions
+
+
+def sized_benchmarks(size: int, workdir: Path, repeat: int) -> Dict[str, float]:
+    rng = random.Random(size)
+    questions = build_database(str(workdir / f'bench_{size}.db'), size, rng)
+    qids = [question[0] for question in questions]
+    csv_path = workdir / f'bench_{size}.csv'
+    write_csv(str(csv_path), questions)
+    picks = iter(rng.choice(qids) for _ in range(1 << 24))
+    load_bank_id = 9999
+
+    def reset_load_bank():
+        conn = sqlite3.connect(database.DB_NAME)
+        conn.execute('DELETE FROM questions WHERE question_bank_id=?', (load_bank_id,))
+        conn.commit()
+        conn.close()
+
+    def load_csv():
+        conn = database.get_db()
+        with contextlib.redirect_stdout(io.StringIO()):
+            database.load_questions_to_db(conn, load_bank_id, str(csv_path))
+        conn.close()
+
+    def open_connection():
+        # 首条语句才会读取并解析表结构，表与索引越多越慢
+        conn = database.get_db()
+        conn.execute('SELECT 1 FROM questions WHERE id=?', ('',)).fetchone()
+        conn.close()
+
+    results = {'get_db': measure(open_connection, repeat)}
+    with reused_connection(database.DB_NAME):
+        results.update({
+            'fetch_question': measure(lambda: database.fetch_question(next(picks)), repeat),
+            'random_question_id': measure(lambda: database.random_question_id(BENCH_USER_ID), repeat),
+            'fetch_random_question_ids': measure(lambda: database.fetch_random_question_ids(20), repeat),
+            'get_user_question_banks': measure(lambda: database.get_user_question_banks(BENCH_USER_ID), repeat),
+        })
+    results['load_questions_to_db'] = measure(load_csv, min(repeat, 3), setup=reset_load_bank)
+    return {f'{name}@{size}': value for name, value in results.items()}
+
+
+def grading_benchmarks(repeat: int) -> Dict[str, float]:
+    rng = random.Random(7)
+    questions = generate_questions(rng, 2000, parse_type_mix(DEFAULT_MIX))
+    cases = [(question[4], question[2]) for question in questions]
+    fill_answers = [answer for qtype, answer in cases if qtype == '填空题']
+    posted = [(qtype, database.parse_fill_answers(answer) if qtype == '填空题' else list(answer))
+              for qtype, answer in cases]
+
+    def parse_all():
+        for answer in fill_answers:
+            database.parse_fill_answers(answer)
+
+    def validate_all():
+        for qtype, answer in cases:
+            validate_answer_by_type(qtype, answer, answer)
+
+    def serialize_all():
+        for qtype, values in posted:
+            serialize_user_answer(qtype, values)
+
+    # 批量函数按单题摊销，便于与数据库函数放在同一张表里比较
+    return {
+        'parse_fill_answers': measure(parse_all, repeat) / len(fill_answers),
+        'validate_answer_by_type': measure(validate_all, repeat) / len(cases),
+        'serialize_user_answer': measure(serialize_all, repeat) / len(posted),
+    }
+
+
+def compare(results: Dict[str, float], calibration: float, baseline: Dict, threshold: float,
+            quiet: bool = False) -> List[str]:
+    """打印对比表（quiet 时不打印），返回超出阈值的项目名。"""
+    scale = calibration / baseline['calibration_us'] if baseline.get('calibration_us') else 1.0
+    regressions = []
+    print_line = (lambda text: None) if quiet else print
+    print_line(f'机器换算系数 {scale:.2f}（calibration {calibration:.1f} µs / 基线 {baseline.get("calibration_us")} µs）')
+    print_line(f'{"项目":<36}{"基线 µs":>12}{"当前 µs":>12}{"变化":>9}  状态')
+    for name, value in results.items():
+        before = (baseline.get('results') or {}).get(name)
+        if before is None:
+            print_line(f'{name:<36}{"-":>12}{value:>12.1f}{"":>9}  新增')
+            continue
+        expected = before * scale
+        change = (value - expected) / expected
+        limit = (baseline.get('thresholds') or {}).get(name, threshold)
+        status = 'ok'
+        if change * 100 > limit:
+            status = f'回退（阈值 {limit:.0f}%）'
+            regressions.append(name)
+        print_line(f'{name:<36}{expected:>12.1f}{value:>12.1f}{change:>+9.1%}  {status}')
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='热点函数微基准与回归门禁')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES), help='题库规模，逗号分隔')
+    parser.add_argument('--repeat', type=int, default=7, help='每项测量轮数（取最小值）')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='允许的最大回退百分比（默认取基线文件中的 threshold_percent）')
+    parser.add_argument('--baseline', default=str(BASELINE_PATH))
+    parser.add_argument('--update-baseline', action='store_true', help='把本次结果写为新基线')
+    parser.add_argument('--retries', type=int, default=2, help='超出阈值的项目最多重测几次')
+    parser.add_argument('--json', help='把本次结果写入该文件')
+    return parser
+
+
+def run_suite(sizes: List[int], repeat: int, grading: bool = True,
+              calibrations: Optional[List[float]] = None) -> Dict[str, float]:
+    """测量各项；提供 calibrations 时每个规模测完后追加一次 calibration。"""
+    results: Dict[str, float] = {}
+    if grading:
+        results.update(grading_benchmarks(repeat))
+    with tempfile.TemporaryDirectory(prefix='exam-microbench-') as workdir:
+        for size in sizes:
+            print(f'测量题库规模 {size} ...', flush=True)
+            results.update(sized_benchmarks(size, Path(workdir), repeat))
+            if calibrations is not None:
+                calibrations.append(calibrate())
+    return {name: round(value, 3) for name, value in results.items()}
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    # calibration 分散在整个测量过程中多次测量取中位数，单次抖动不会带偏换算系数
+    calibrations = [calibrate()]
+    results = run_suite(sizes, args.repeat, calibrations=calibrations)
+    calibrations.append(calibrate())
+    calibration = statistics.median(calibrations)
+
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text(encoding='utf-8')) if baseline_path.exists() else {}
+    threshold = args.threshold if args.threshold is not None else baseline.get('threshold_percent', 40.0)
+
+    if not args.update_baseline and baseline:
+        # 超出阈值的项目重测（只重跑涉及的规模），逐项取最小值，排除偶发抖动造成的误报
+        for attempt in range(args.retries):
+            regressions = compare(results, calibration, baseline, threshold, quiet=True)
+            if not regressions:
+                break
+            print(f'{len(regressions)} 项超过阈值，重测第 {attempt + 1} 次 ...', flush=True)
+            retry_sizes = sorted({int(name.split('@')[1]) for name in regressions if '@' in name})
+            retry = run_suite(retry_sizes, args.repeat, grading=any('@' not in name for name in regressions),
+                              calibrations=calibrations)
+            results = {name: min(value, retry.get(name, value)) for name, value in results.items()}
+            calibration = statistics.median(calibrations)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({'calibration_us': round(calibration, 3), 'results': results},
+                                              ensure_ascii=False, indent=2), encoding='utf-8')
+    if args.update_baseline:
+        baseline.update({
+            'calibration_us': round(calibration, 3),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'threshold_percent': threshold,
+            'results': results
+        })
+        thresholds = baseline.setdefault('thresholds', {})
+        for name in ('parse_fill_answers', 'validate_answer_by_type', 'serialize_user_answer'):
+            thresholds.setdefault(name, GRADING_THRESHOLD_PERCENT)
+        baseline_path.write_text(json.dumps(baseline, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
+        print(f'已更新基线 {baseline_path}')
+        return 0
+    if not baseline:
+        print(f'没有基线文件 {baseline_path}，先运行 --update-baseline。')
+        return 1
+
+    regressions = compare(results, calibration, baseline, threshold)
+    if regressions:
+        print(f'\n{len(regressions)} 项超过回退阈值: {", ".join(regressions)}')
+        return 1
+    print('\n全部在阈值以内。')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
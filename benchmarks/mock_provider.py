@@ -0,0 +1,249 @@
+"""
+本地 OpenAI 兼容模拟供应商，用于在无网络、不付费的情况下压测 AI 链路。
+
+提供 POST /v1/chat/completions（流式与非流式）。两种出字方式：
+
+- 回放：--replay debug/ai_stream.log 读取已记录的调用轨迹（response.chunk 的分片与 elapsed_ms，
+  或 response.complete 的全文与 timing），按原始节奏输出；--speed 可整体加速/减速。请求消息与某条轨迹
+  完全一致时回放该轨迹，否则按轮询挑选。
+- 合成：按 --ttft-ms、--tokens、--tokens-per-second 生成固定节奏的分片。
+
+错误注入：--error-rate（HTTP 500）、--rate-limit-rate（HTTP 429）、--drop-rate（输出一半后断开连接）、
+--stall-ms（额外的首字延迟）。
+
+用法：
+    python benchmarks/mock_provider.py --port 18080 --replay debug/ai_stream.log
+然后在“AI 功能管理”中添加 Base URL 为 http://127.0.0.1:18080 的配置（模型与密钥任意）。
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# 一条轨迹：[(相对请求开始的毫秒数, 分片文本), ...]
+Trace = List[Tuple[float, str]]
+
+
+def _messages_key(messages) -> str:
+    material = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def _spread(text: str, ttft_ms: float, total_ms: float, pieces: int) -> Trace:
+    """没有逐片时间时，把全文均匀切分并铺满首字到结束之间的时间。"""
+    pieces = max(1, min(pieces, len(text)))
+    size = -(-len(text) // pieces)
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    span = max(0.0, total_ms - ttft_ms)
+    step = span / max(1, len(chunks) - 1) if len(chunks) > 1 else 0
+    return [(ttft_ms + step * index, chunk) for index, chunk in enumerate(chunks)]
+
+
+def load_traces(path: str) -> Tuple[List[Trace], Dict[str, Trace]]:
+    """
+    解析 ai_stream.log，返回 (全部轨迹, 按请求消息索引的轨迹)。
+
+    只收录成功完成（response.complete）且有输出的调用。
+    """
+    requests_by_trace: Dict[str, str] = {}
+    chunks_by_trace: Dict[str, Trace] = {}
+    traces: List[Trace] = []
+    by_messages: Dict[str, Trace] = {}
+    with open(path, encoding='utf-8') as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            trace_id = record.get('trace_id')
+            if not trace_id:
+                continue
+            event = record.get('event')
+            if event == 'request.start' and record.get('messages'):
+                requests_by_trace[trace_id] = _messages_key(record['messages'])
+            elif event == 'response.chunk' and record.get('chunk'):
+                chunks_by_trace.setdefault(trace_id, []).append((record.get('elapsed_ms'), record['chunk']))
+            elif event == 'response.complete':
+                text = record.get('aggregated_text') or ''
+                if not text:
+                    continue
+                timing = record.get('timing') or {}
+                recorded = chunks_by_trace.pop(trace_id, [])
+                if recorded and all(elapsed is not None for elapsed, _ in recorded):
+                    trace = recorded
+                else:
+                    ttft_ms = timing.get('ttft_ms') or 500.0
+                    total_ms = timing.get('total_ms') or ttft_ms + 25.0 * len(text)
+                    trace = _spread(text, ttft_ms, total_ms, timing.get('chunks') or len(recorded) or len(text) // 2)
+                traces.append(trace)
+                key = requests_by_trace.pop(trace_id, None)
+                if key:
+                    by_messages[key] = trace
+    return traces, by_messages
+
+
+def synthetic_trace(ttft_ms: float, tokens: int, tokens_per_second: float, text: str) -> Trace:
+    interval = 1000.0 / tokens_per_second if tokens_per_second > 0 else 0
+    return [(ttft_ms + interval * index, text) for index in range(tokens)]
+
+
+class MockProvider:
+    """根据配置为每个请求挑选轨迹并决定是否注入错误，线程安全。"""
+
+    def __init__(self, args, traces: List[Trace], by_messages: Dict[str, Trace]):
+        self.args = args
+        self.traces = traces
+        self.by_messages = by_messages
+        self._cycle = itertools.cycle(traces) if traces else None
+        self._lock = threading.Lock()
+        self._random = random.Random(args.seed)
+        self.served = 0
+
+    def pick(self, messages) -> Trace:
+        with self._lock:
+            self.served += 1
+            if self._cycle is None:
+                return synthetic_trace(self.args.ttft_ms, self.args.tokens, self.args.tokens_per_second,
+                                       self.args.token_text)
+            return self.by_messages.get(_messages_key(messages)) or next(self._cycle)
+
+    def roll(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+
+def make_handler(provider: MockProvider):
+    args = provider.args
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *log_args):
+            if args.verbose:
+                super().log_message(*log_args)
+
+        def _send_json(self, status: int, payload: Dict) -> None:
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data: bytes) -> None:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self._send_json(400, {'error': {'message': 'invalid json'}})
+                return
+
+            if provider.roll(args.rate_limit_rate):
+                self._send_json(429, {'error': {'message': 'mock rate limit'}})
+                return
+            if provider.roll(args.error_rate):
+                self._send_json(500, {'error': {'message': 'mock upstream failure'}})
+                return
+
+            trace = provider.pick(body.get('messages') or [])
+            started = time.monotonic()
+            if not body.get('stream'):
+                self._sleep_until(started, (trace[-1][0] if trace else 0) + args.stall_ms)
+                text = ''.join(chunk for _, chunk in trace)
+                self._send_json(200, {
+                    'object': 'chat.completion',
+                    'model': body.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text},
+                                 'finish_reason': 'stop'}]
+                })
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            drop_at = len(trace) // 2 if provider.roll(args.drop_rate) else None
+            try:
+                for index, (elapsed_ms, text) in enumerate(trace):
+                    if drop_at is not None and index >= drop_at:
+                        self.close_connection = True
+                        return
+                    self._sleep_until(started, elapsed_ms + args.stall_ms)
+                    event = {'choices': [{'index': 0, 'delta': {'content': text}}]}
+                    self._write_chunk(('data: ' + json.dumps(event, ensure_ascii=False) + '\n\n').encode('utf-8'))
+                self._write_chunk(b'data: [DONE]\n\n')
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端（/ai/run）已取消，正是要测的行为
+                self.close_connection = True
+
+        @staticmethod
+        def _sleep_until(started: float, elapsed_ms: Optional[float]) -> None:
+            if not elapsed_ms:
+                return
+            delay = started + elapsed_ms / 1000.0 / args.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    return Handler
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='本地 OpenAI 兼容模拟供应商')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--replay', help='回放的 ai_stream.log 路径；不指定时使用合成输出')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放速度倍数（2 表示两倍速）')
+    parser.add_argument('--ttft-ms', type=float, default=400.0, help='合成模式的首字延迟')
+    parser.add_argument('--tokens', type=int, default=200, help='合成模式每次输出的分片数')
+    parser.add_argument('--tokens-per-second', type=float, default=40.0, help='合成模式的输出速度')
+    parser.add_argument('--token-text', default='测', help='合成模式每个分片的文本')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 HTTP 500 的概率')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回 HTTP 429 的概率')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='输出一半后断开连接的概率')
+    parser.add_argument('--stall-ms', type=float, default=0.0, help='在首字前额外等待的毫秒数')
+    parser.add_argument('--seed', type=int, default=None, help='错误注入的随机种子')
+    parser.add_argument('--verbose', action='store_true', help='打印每个请求的访问日志')
+    return parser
+
+
+def create_server(args) -> ThreadingHTTPServer:
+    traces, by_messages = load_traces(args.replay) if args.replay else ([], {})
+    if args.replay and not traces:
+        print(f'{args.replay} 中没有可回放的完整调用，改用合成输出。', file=sys.stderr)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockProvider(args, traces, by_messages)))
+    server.daemon_threads = True
+    server.trace_count = len(traces)
+    return server
+
+
+def main(argv=None) -> None:
+    args = build_parser().parse_args(argv)
+    server = create_server(args)
+    source = f'回放 {server.trace_count} 条轨迹' if server.trace_count else '合成输出'
+    print(f'模拟供应商已启动: http://{args.host}:{args.port}（{source}）')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,49 @@
-from flask import Blueprint, Response, flash, jsonify, redirect, render_template, request, stream_with_context, url_for
+import click
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 
+from ai_budget import CLIENT_DISCONNECT, cancellation_counts, record_cancellation
+from ai_circuit import breaker_states
+from ai_hedge import provider_stream
+from ai_healthcheck import check_provider, request_check
+from ai_inflight import coalesced_stream
+from ai_metrics import metrics_snapshot, provider_metrics
+from ai_prefetch import has_budget, try_prefetch
+from ai_pregen import PREGEN_MODES, cancel_job, create_job, describe_job, generation_fingerprint, run_job, start_job
 from ai_service import (
     AIServiceError,
-    build_analysis_messages,
-    build_hint_messages,
-    decrypt_api_key,
+    build_mode_messages,
+    clear_key_cache,
+    decrypt_provider_key,
     encrypt_api_key,
-    stream_chat_completion,
-    validate_provider_connection,
+    invalidate_provider_key,
+    reencrypt_api_key,
 )
-from blueprints.auth import get_user_id, login_required
+from blueprints.auth import admin_required, get_user_id, login_required
 from database import (
     SYSTEM_QUESTION_BANK_ID,
     fetch_question,
     get_active_ai_provider,
+    get_ai_generated,
+    get_ai_pregen_job,
     get_ai_provider,
     get_ai_providers,
+    get_failover_ai_providers,
     get_db,
+    has_available_ai_provider,
+    user_can_access_bank,
 )
+from metrics import record_cache
 
 bp = Blueprint('ai', __name__, url_prefix='/ai')
 
@@ -26,24 +52,21 @@ def _normalize_url(url: str) -> str:
     return (url or '').strip().rstrip('/')
 
 
-def _validate_and_update(conn, provider_row, decrypted_key):
-    payload = {
-        'base_url': provider_row['base_url'],
-        'model': provider_row['model'],
-        'api_key': decrypted_key
-    }
-    is_valid, message = validate_provider_connection(payload)
-    c = conn.cursor()
-    c.execute('''
-        UPDATE ai_providers
-        SET is_valid=?,
-            last_verified_at=CURRENT_TIMESTAMP,
-            last_error=?,
-            updated_at=CURRENT_TIMESTAMP
-        WHERE id=? AND user_id=?
-    ''', (1 if is_valid else 0, None if is_valid else message[:500], provider_row['id'], provider_row['user_id']))
-    conn.commit()
-    return is_valid, message
+def _schedule_validation(provider_id, user_id):
+    """
+    将配置交给后台健康检查并提示“验证中”；未启用后台检查时退回同步验证并提示结果。
+    """
+    if request_check(provider_id):
+        flash('已提交后台验证，结果将在几秒内更新。', 'info')
+        return
+    provider = get_ai_provider(provider_id, user_id)
+    if not provider:
+        return
+    if check_provider(provider):
+        flash('配置验证成功，服务可用。', 'success')
+    else:
+        refreshed = get_ai_provider(provider_id, user_id) or {}
+        flash(f'配置验证失败: {refreshed.get("last_error") or "未知错误"}', 'error')
 
 
 @bp.route('/manage')
@@ -52,7 +75,8 @@ def manage():
     user_id = get_user_id()
     providers = get_ai_providers(user_id)
     active = get_active_ai_provider(user_id)
-    return render_template('ai-manage.html', providers=providers, has_active=bool(active))
+    metrics = {provider['id']: provider_metrics(provider) for provider in providers}
+    return render_template('ai-manage.html', providers=providers, has_active=bool(active), metrics=metrics)
 
 
 @bp.route('/providers', methods=['POST'])
@@ -84,29 +108,17 @@ def create_provider():
         return redirect(url_for('ai.manage'))
 
     c.execute('''
-        INSERT INTO ai_providers (user_id, provider_name, base_url, model, api_key_encrypted, is_active)
-        VALUES (?,?,?,?,?,?)
+        INSERT INTO ai_providers (user_id, provider_name, base_url, model, api_key_encrypted, is_active, check_pending)
+        VALUES (?,?,?,?,?,?,1)
     ''', (user_id, provider_name, base_url, model, encrypted_key, 0 if has_existing else 1))
     provider_id = c.lastrowid
     conn.commit()
-
-    provider_row = {
-        'id': provider_id,
-        'user_id': user_id,
-        'base_url': base_url,
-        'model': model
-    }
-    is_valid, message = _validate_and_update(conn, provider_row, api_key)
     conn.close()
 
     flash('AI 服务配置已保存。', 'success')
     if not has_existing:
         flash('已自动激活首个配置。', 'success')
-
-    if is_valid:
-        flash('配置验证成功，服务可用。', 'success')
-    else:
-        flash(f'配置验证失败: {message}', 'error')
+    _schedule_validation(provider_id, user_id)
 
     return redirect(url_for('ai.manage'))
 
@@ -136,44 +148,26 @@ def update_provider(provider_id):
     c = conn.cursor()
 
     encrypted_key = provider['api_key_encrypted']
-    decrypted_key = None
     if new_api_key:
         try:
             encrypted_key = encrypt_api_key(new_api_key)
-            decrypted_key = new_api_key
         except Exception as exc:
             conn.close()
             flash(f'更新密钥失败: {exc}', 'error')
             return redirect(url_for('ai.manage'))
-    else:
-        try:
-            decrypted_key = decrypt_api_key(provider['api_key_encrypted'])
-        except AIServiceError as exc:
-            conn.close()
-            flash(str(exc), 'error')
-            return redirect(url_for('ai.manage'))
 
     c.execute('''
         UPDATE ai_providers
-        SET provider_name=?, base_url=?, model=?, api_key_encrypted=?, updated_at=CURRENT_TIMESTAMP
+        SET provider_name=?, base_url=?, model=?, api_key_encrypted=?, check_pending=1,
+            check_started_at=NULL, updated_at=CURRENT_TIMESTAMP
         WHERE id=? AND user_id=?
     ''', (provider_name, base_url, model, encrypted_key, provider_id, user_id))
     conn.commit()
-
-    provider_row = {
-        'id': provider_id,
-        'user_id': user_id,
-        'base_url': base_url,
-        'model': model
-    }
-    is_valid, message = _validate_and_update(conn, provider_row, decrypted_key)
     conn.close()
+    invalidate_provider_key(provider_id)
 
     flash('AI 服务配置已更新。', 'success')
-    if is_valid:
-        flash('验证成功。', 'success')
-    else:
-        flash(f'验证失败: {message}', 'error')
+    _schedule_validation(provider_id, user_id)
     return redirect(url_for('ai.manage'))
 
 
@@ -189,8 +183,8 @@ def activate_provider(provider_id):
     conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE ai_providers SET is_active=0 WHERE user_id=?', (user_id,))
-    c.execute('UPDATE ai_providers SET is_active=1, updated_at=CURRENT_TIMESTAMP WHERE id=? AND user_id=?',
-              (provider_id, user_id))
+    # 不刷新 updated_at：激活不改变配置内容
+    c.execute('UPDATE ai_providers SET is_active=1 WHERE id=? AND user_id=?', (provider_id, user_id))
     conn.commit()
     conn.close()
 
@@ -211,11 +205,12 @@ def delete_provider(provider_id):
     c = conn.cursor()
     c.execute('DELETE FROM ai_providers WHERE id=? AND user_id=?', (provider_id, user_id))
     conn.commit()
+    invalidate_provider_key(provider_id)
 
     if provider['is_active']:
         c.execute('''
             UPDATE ai_providers
-            SET is_active=1, updated_at=CURRENT_TIMESTAMP
+            SET is_active=1
             WHERE id=(
                 SELECT id FROM ai_providers WHERE user_id=? ORDER BY updated_at DESC LIMIT 1
             )
@@ -236,78 +231,299 @@ def validate_provider(provider_id):
         flash('未找到该配置。', 'error')
         return redirect(url_for('ai.manage'))
 
-    try:
-        decrypted_key = decrypt_api_key(provider['api_key_encrypted'])
-    except AIServiceError as exc:
-        flash(str(exc), 'error')
-        return redirect(url_for('ai.manage'))
-
     conn = get_db()
-    provider_row = {
-        'id': provider_id,
-        'user_id': user_id,
-        'base_url': provider['base_url'],
-        'model': provider['model']
-    }
-    is_valid, message = _validate_and_update(conn, provider_row, decrypted_key)
+    c = conn.cursor()
+    c.execute('UPDATE ai_providers SET check_pending=1 WHERE id=? AND user_id=?', (provider_id, user_id))
+    conn.commit()
     conn.close()
 
-    if is_valid:
-        flash('验证成功。', 'success')
-    else:
-        flash(f'验证失败: {message}', 'error')
+    _schedule_validation(provider_id, user_id)
     return redirect(url_for('ai.manage'))
 
 
-@bp.route('/run', methods=['POST'])
+@bp.route('/providers/status')
 @login_required
-def run_ai():
+def providers_status():
+    """管理页轮询用：返回各配置的验证状态。"""
+    providers = get_ai_providers(get_user_id())
+    return jsonify({
+        'providers': [{
+            'id': provider['id'],
+            'is_valid': provider['is_valid'],
+            'check_pending': provider['check_pending'],
+            'last_error': provider['last_error'],
+            'last_latency_ms': provider['last_latency_ms'],
+            'last_verified_at': provider['last_verified_at']
+        } for provider in providers]
+    })
+
+
+@bp.route('/metrics')
+@admin_required
+def metrics():
+    """运维用：本进程内各供应商的延迟/吞吐直方图与熔断状态。"""
+    return jsonify({
+        'providers': metrics_snapshot(),
+        'cancellations': cancellation_counts(),
+        'breakers': breaker_states()
+    })
+
+
+@bp.cli.command('rotate-keys')
+@click.option('--old-secret', envvar='OLD_SECRET_KEY', required=True,
+              help='轮换前的 SECRET_KEY（也可通过 OLD_SECRET_KEY 环境变量提供）。')
+def rotate_keys(old_secret):
+    """用当前 SECRET_KEY 重新加密所有 AI 密钥：flask ai rotate-keys --old-secret <旧密钥>"""
+    new_secret = current_app.config.get('SECRET_KEY')
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT id, api_key_encrypted FROM ai_providers')
+    rows = c.fetchall()
+    updates = []
+    failed = []
+    for row in rows:
+        try:
+            updates.append((reencrypt_api_key(row['api_key_encrypted'], old_secret, new_secret), row['id']))
+        except AIServiceError:
+            failed.append(row['id'])
+    # 不刷新 updated_at：密钥明文未变，只是换了加密密钥
+    c.executemany('UPDATE ai_providers SET api_key_encrypted=? WHERE id=?', updates)
+    conn.commit()
+    conn.close()
+    clear_key_cache()
+    click.echo(f'已重新加密 {len(updates)} 个 AI 密钥。')
+    if failed:
+        click.echo(f'以下配置无法用旧密钥解密，已跳过: {failed}', err=True)
+
+
+def _pregen_job_json(job):
+    job = describe_job(job)
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'running': job['running'],
+        'modes': job['modes'].split(','),
+        'total': job['total'],
+        'completed': job['completed'],
+        'generated': job['generated'],
+        'failed': job['failed'],
+        'last_error': job['last_error'],
+        'updated_at': job['updated_at']
+    }
+
+
+@bp.route('/pregen/<int:bank_id>', methods=['POST'])
+@login_required
+def start_pregen(bank_id):
+    """为整个题库发起 AI 解析/提示预生成任务（后台执行）。"""
     user_id = get_user_id()
+    back = redirect(url_for('question_bank.preview_bank', bank_id=bank_id))
+    if not user_can_access_bank(user_id, bank_id):
+        flash('无权访问该题库', 'error')
+        return redirect(url_for('question_bank.list_banks'))
+
+    modes = [mode for mode in request.form.getlist('modes') if mode in PREGEN_MODES]
+    if not modes:
+        flash('请至少选择一种预生成内容。', 'error')
+        return back
+
+    providers, error = resolve_run_providers(user_id)
+    if error:
+        flash(error[0], 'error')
+        return back
+
+    job_id = create_job(user_id, bank_id, modes)
+    try:
+        start_job(job_id, providers)
+    except AIServiceError as exc:
+        flash(str(exc), 'error')
+        return back
+    flash('已开始预生成，完成前可离开本页面，进度会自动保存。', 'success')
+    return back
+
+
+@bp.route('/pregen/jobs/<int:job_id>')
+@login_required
+def pregen_job_status(job_id):
+    job = get_ai_pregen_job(job_id, get_user_id())
+    if not job:
+        return jsonify({'error': '任务不存在。'}), 404
+    return jsonify(_pregen_job_json(job))
+
+
+@bp.route('/pregen/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_pregen_job(job_id):
+    job = get_ai_pregen_job(job_id, get_user_id())
+    if not job:
+        flash('任务不存在。', 'error')
+        return redirect(url_for('question_bank.list_banks'))
+    if cancel_job(job_id):
+        flash('已请求停止预生成，已生成的内容会保留。', 'info')
+    else:
+        flash('该任务当前未在运行。', 'info')
+    return redirect(url_for('question_bank.preview_bank', bank_id=job['question_bank_id']))
+
+
+@bp.cli.command('pregen')
+@click.argument('bank_id', type=int)
+@click.option('--user-id', type=int, required=True, help='使用该用户激活的 AI 配置生成。')
+@click.option('--modes', default='hint,analysis', show_default=True, help='逗号分隔：hint、analysis。')
+def pregen_command(bank_id, user_id, modes):
+    """在前台预生成整个题库的 AI 内容：flask ai pregen <题库ID> --user-id <用户ID>"""
+    selected = [mode.strip() for mode in modes.split(',') if mode.strip() in PREGEN_MODES]
+    if not selected:
+        raise click.BadParameter('至少需要 hint 或 analysis 之一。', param_hint='--modes')
+    if not user_can_access_bank(user_id, bank_id):
+        raise click.ClickException('该用户无权访问此题库。')
+    providers, error = resolve_run_providers(user_id)
+    if error:
+        raise click.ClickException(error[0])
+
+    job_id = create_job(user_id, bank_id, selected)
+
+    def report(counters):
+        click.echo(f"\r{counters['completed']}/{counters['total']} 题，"
+                   f"新生成 {counters['generated']}，失败 {counters['failed']}", nl=False)
+
+    result = run_job(job_id, providers, progress=report)
+    click.echo()
+    click.echo(f"任务 {job_id} 结束（{result['status']}）。")
+    if result['last_error']:
+        click.echo(f"最近错误: {result['last_error']}", err=True)
+
+
+def _provider_payload(row, secret=None):
+    return {
+        'id': row['id'],
+        'base_url': row['base_url'],
+        'model': row['model'],
+        'api_key': decrypt_provider_key(row, secret=secret)
+    }
+
+
+def resolve_run_providers(user_id, secret=None):
+    """
+    返回已解密密钥的供应商列表：首个为当前激活的配置，其后为可故障转移的已验证配置。
+
+    Returns:
+        tuple: (providers, None) 或 (None, (error_message, http_status))
+    """
     provider = get_active_ai_provider(user_id)
     if not provider:
-        return jsonify({'error': '请先在“我的 > AI功能管理”中配置并激活 AI 服务。'}), 400
+        return None, ('请先在“我的 > AI功能管理”中配置并激活 AI 服务。', 400)
+    try:
+        providers = [_provider_payload(provider, secret)]
+    except AIServiceError as exc:
+        return None, (str(exc), 400)
+
+    if current_app.config.get('AI_FAILOVER_ENABLED', True):
+        for row in get_failover_ai_providers(user_id, exclude_id=provider['id']):
+            try:
+                providers.append(_provider_payload(row, secret))
+            except AIServiceError:
+                continue
+    return providers, None
+
+
+def prepare_ai_run(user_id, payload):
+    """
+    校验 /ai/run 请求并组装上游调用参数，同步与异步两条流式路径共用。
+
+    Returns:
+        tuple: (prepared, None) 或 (None, (error_message, http_status))
+    """
+    providers, error = resolve_run_providers(user_id)
+    if error:
+        return None, error
 
-    payload = request.get_json(silent=True) or {}
     mode = payload.get('mode')
     question_id = payload.get('question_id')
     question_bank_id = payload.get('question_bank_id', SYSTEM_QUESTION_BANK_ID)
     user_answer = payload.get('user_answer', '')
 
     if not question_id:
-        return jsonify({'error': '缺少题目编号，无法生成解析。'}), 400
+        return None, ('缺少题目编号，无法生成解析。', 400)
 
     question = fetch_question(str(question_id), question_bank_id)
     if not question:
-        return jsonify({'error': '题目不存在或已被删除。'}), 404
+        return None, ('题目不存在或已被删除。', 404)
 
     try:
-        api_key = decrypt_api_key(provider['api_key_encrypted'])
+        messages, temperature = build_mode_messages(question, mode, user_answer)
     except AIServiceError as exc:
-        return jsonify({'error': str(exc)}), 400
+        return None, (str(exc), 400)
+
+    pregenerated = None
+    if current_app.config.get('AI_PREGEN_SERVE', True):
+        pregenerated = get_ai_generated(question['question_bank_id'], question['id'],
+                                        generation_fingerprint(messages, temperature))
+        record_cache('ai_pregen', pregenerated is not None)
+
+    return {
+        'provider': providers[0],
+        'fallbacks': providers[1:],
+        'messages': messages,
+        'temperature': temperature,
+        'pregenerated': pregenerated
+    }, None
+
+
+def prefetch_analysis(user_id, question, user_answer):
+    """
+    答错后在后台提前生成 AI 解析（AI_PREFETCH_ENABLED），学生随后点击“AI解析”时直接跟随这次生成。
+    任何失败都静默忽略，不影响判题请求。
+    """
+    config = current_app.config
+    if not (config.get('AI_PREFETCH_ENABLED') and config.get('AI_COALESCE_ENABLED', True)):
+        return False
+    if not has_budget(user_id) or not has_available_ai_provider(user_id):
+        return False
+    prepared, error = prepare_ai_run(user_id, {
+        'mode': 'analysis',
+        'question_id': question['id'],
+        'question_bank_id': question.get('question_bank_id', SYSTEM_QUESTION_BANK_ID),
+        'user_answer': user_answer
+    })
+    if error or prepared['pregenerated']:
+        return False
+    return try_prefetch(user_id, prepared)
 
-    provider_payload = {
-        'base_url': provider['base_url'],
-        'model': provider['model'],
-        'api_key': api_key
-    }
 
-    try:
-        if mode == 'analysis':
-            messages = build_analysis_messages(question, user_answer)
-            temperature = 0.2
-        elif mode == 'hint':
-            messages = build_hint_messages(question)
-            temperature = 0.5
-        else:
-            return jsonify({'error': '未知的 AI 模式。'}), 400
-    except AIServiceError as exc:
-        return jsonify({'error': str(exc)}), 400
+@bp.route('/run', methods=['POST'])
+@login_required
+def run_ai():
+    user_id = get_user_id()
+    payload = request.get_json(silent=True) or {}
+    prepared, error = prepare_ai_run(user_id, payload)
+    if error:
+        message, status = error
+        return jsonify({'error': message}), status
+    if prepared['pregenerated']:
+        return Response(prepared['pregenerated'], mimetype='text/plain; charset=utf-8')
+
+    provider_payload = prepared['provider']
+    fallbacks = prepared['fallbacks']
+    messages = prepared['messages']
+    temperature = prepared['temperature']
+
+    if current_app.config.get('AI_COALESCE_ENABLED', True):
+        source = coalesced_stream(provider_payload, messages, temperature=temperature, fallbacks=fallbacks)
+    else:
+        source = provider_stream([provider_payload, *fallbacks], messages, temperature=temperature)
 
     def generate():
         try:
-            for chunk in stream_chat_completion(provider_payload, messages, temperature=temperature):
+            for chunk in source:
                 yield chunk
         except AIServiceError as exc:
             yield f"\n\n[ERROR] {exc}"
+        except GeneratorExit:
+            # WSGI 服务器在写入失败（客户端断开）时关闭响应迭代器
+            record_cancellation(CLIENT_DISCONNECT)
+            raise
+        finally:
+            # 立即关闭上游：直连时断开供应商连接，合流时退订（最后一个订阅者离开会终止上游）
+            source.close()
 
     return Response(stream_with_context(generate()), mimetype='text/plain; charset=utf-8')
@@ -0,0 +1,808 @@
+"""
+面向 Android 等客户端的 JSON 接口（/api/v1）。
+
+认证：POST /api/v1/auth/token 用用户名和密码换取令牌，之后每个请求带 Authorization: Bearer <token>。
+数据库只保存令牌的 SHA-256 摘要；DELETE /api/v1/auth/token 注销当前令牌。
+
+响应统一为紧凑 JSON（无多余空白、中文不转义），出错时返回 {"error": 错误码, "message": 说明} 与对应状态码。
+题目列表用游标分页（next_cursor 原样传回即可取下一页），题目与试卷带 ETag，客户端携带 If-None-Match
+时内容未变化直接返回 304。未指定 bank_id 时使用用户当前启用的题库。
+
+离线同步：GET /api/v1/banks/<id>/snapshot 下载整个题库（列式 JSON、gzip 压缩，带题库内容版本），
+之后用 GET /api/v1/banks/<id>/changes?since=<版本> 只取该版本之后新增/修改的题目与已删除的题号。
+"""
+import base64
+import binascii
+import gzip
+import json
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Blueprint, current_app, g, request
+from werkzeug.security import check_password_hash
+
+from database import (
+    create_api_token,
+    create_exam_session,
+    exam_question_ids,
+    fetch_question,
+    fetch_questions,
+    fetch_random_question_ids,
+    get_active_question_bank_id,
+    get_api_token_user,
+    get_bank_version,
+    get_db,
+    get_user_question_banks,
+    question_from_row,
+    random_question_id,
+    revoke_api_token,
+    user_can_access_bank,
+)
+from page_cache import cached_fragment, make_etag, not_modified, with_etag
+from .ai import prefetch_analysis
+from .quiz import (
+    advance_sequential,
+    current_sequential_question_id,
+    grade_exam,
+    practice_progress,
+    serialize_user_answer,
+    validate_answer_by_type,
+)
+from .user import collect_statistics
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_BATCH_IDS = 200
+MAX_EXAM_QUESTIONS = 200
+MAX_ANSWER_BATCH = 500
+MAX_CLIENT_KEY_LENGTH = 100
+
+SYNC_FORMAT = 1
+SYNC_COLUMNS = ('id', 'type', 'stem', 'options', 'answer', 'difficulty', 'category')
+# 取值很少的列存为字符串表下标
+SYNC_INTERNED_COLUMNS = ('type', 'difficulty', 'category')
+
+
+def _json(payload, status=200):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return current_app.response_class(body, status=status, mimetype='application/json')
+
+
+def _error(status, code, message):
+    return _json({'error': code, 'message': message}, status)
+
+
+def _bearer_token():
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return None
+    return token.strip() or None
+
+
+def token_required(f):
+    """要求有效的 Bearer 令牌，用户 ID 放在 g.api_user_id。"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user_id = get_api_token_user(_bearer_token())
+        if user_id is None:
+            response = _error(401, 'unauthorized', '令牌无效或已过期，请重新登录')
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        g.api_user_id = user_id
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def _json_body():
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
+
+
+def _resolve_bank_id(value):
+    """请求中的 bank_id（缺省为当前题库）；无权访问或格式错误时返回 None。"""
+    user_id = g.api_user_id
+    if value is None or value == '':
+        return get_active_question_bank_id(user_id)
+    try:
+        bank_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return bank_id if user_can_access_bank(user_id, bank_id) else None
+
+
+def _question_payload(q, include_answer=False):
+    """客户端渲染一道题所需的最少字段；空字段省略。"""
+    question_type = q.get('question_type') or q['type']
+    payload = {'id': q['id'], 'type': question_type, 'stem': q['stem']}
+    if q['options']:
+        payload['options'] = q['options']
+    if q['difficulty']:
+        payload['difficulty'] = q['difficulty']
+    if q['category']:
+        payload['category'] = q['category']
+    if question_type == '填空题':
+        payload['blanks'] = q['fill_blank_count']
+    if include_answer:
+        payload['answer'] = q['answer']
+    return payload
+
+
+def _encode_cursor(row):
+    # 排序键与 SQL 中的 CAST(id AS INTEGER) 一致（非数字题号为 0，再按题号本身排序）
+    raw = json.dumps([row['sort_key'], row['id']], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_key, question_id = json.loads(raw)
+        return int(sort_key), str(question_id)
+    except (binascii.Error, ValueError, TypeError):
+        return None
+
+
+def _flag(name):
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _answer_list(value):
+    """接受字符串或字符串列表（多选题每个选项一项，填空题每空一项）。"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return value
+    return None
+
+
+def _progress(answered, total):
+    return {'answered': answered, 'total': total}
+
+
+def _client_timestamp(value):
+    """
+    客户端作答时间：ISO 8601 字符串（无时区按 UTC）或 Unix 秒数，转为与 CURRENT_TIMESTAMP 相同的
+    UTC 格式；晚于服务器当前时间的按当前时间记。未提供时返回 None（由数据库取当前时间）。
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        moment = datetime.fromtimestamp(value, timezone.utc)
+    elif isinstance(value, str):
+        # Python 3.11 之前的 fromisoformat 不接受结尾的 Z
+        if value.endswith(('Z', 'z')):
+            value = value[:-1] + '+00:00'
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+    else:
+        raise ValueError(value)
+    return min(moment.astimezone(timezone.utc), datetime.now(timezone.utc)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _parse_answer_item(item):
+    """校验一条作答记录，返回 (记录, 错误说明)。key 为可选的客户端幂等键。"""
+    if not isinstance(item, dict):
+        return None, '每条记录必须是 JSON 对象'
+    answers = _answer_list(item.get('answer'))
+    if answers is None:
+        return None, 'answer 必须是字符串或字符串数组'
+    key = item.get('key')
+    if key is not None and (not isinstance(key, str) or not 0 < len(key) <= MAX_CLIENT_KEY_LENGTH):
+        return None, f'key 必须是 1 到 {MAX_CLIENT_KEY_LENGTH} 个字符的字符串'
+    try:
+        answered_at = _client_timestamp(item.get('answered_at'))
+    except (ValueError, OverflowError, OSError):
+        return None, 'answered_at 必须是 ISO 8601 时间或 Unix 秒数'
+    return {
+        'key': key,
+        'question_id': str(item.get('question_id', '')),
+        'answers': answers,
+        'answered_at': answered_at
+    }, None
+
+
+def _existing_answers(c, user_id, keys):
+    """已用这些幂等键记录过的作答：key -> history 行。"""
+    keys = list(keys)
+    existing = {}
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f'''
+            SELECT client_key, question_id, user_answer, correct FROM history
+            WHERE user_id=? AND client_key IN ({placeholders})
+        ''', (user_id, *chunk))
+        for row in c.fetchall():
+            existing[row['client_key']] = row
+    return existing
+
+
+def _insert_answers(c, rows):
+    """rows: (user_id, question_id, question_bank_id, user_answer, correct, answered_at, client_key)。"""
+    c.executemany('''
+        INSERT OR IGNORE INTO history (user_id, question_id, question_bank_id, user_answer, correct, timestamp, client_key)
+        VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?)
+    ''', rows)
+
+
+# --- Auth ---
+
+@bp.route('/auth/token', methods=['POST'])
+def issue_token():
+    data = _json_body() or request.form
+    username = data.get('username')
+    password = data.get('password')
+    if not username or not password:
+        return _error(400, 'invalid_request', '用户名和密码不能为空')
+    if not isinstance(username, str) or not isinstance(password, str):
+        return _error(400, 'invalid_request', '用户名和密码必须是字符串')
+    name = data.get('name')
+    if name is not None and not isinstance(name, str):
+        return _error(400, 'invalid_request', 'name 必须是字符串')
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT id, username, password_hash FROM users WHERE username=?', (username,))
+    user = c.fetchone()
+    conn.close()
+    if not user or not check_password_hash(user['password_hash'], password):
+        return _error(401, 'invalid_credentials', '用户名或密码错误')
+
+    ttl_days = current_app.config.get('API_TOKEN_TTL_DAYS', 90)
+    token = create_api_token(user['id'], (name or '')[:100] or None, ttl_days)
+    return _json({
+        'token': token,
+        'token_type': 'Bearer',
+        'expires_in': ttl_days * 86400 if ttl_days > 0 else None,
+        'user': {'id': user['id'], 'username': user['username']}
+    }, 201)
+
+
+@bp.route('/auth/token', methods=['DELETE'])
+@token_required
+def delete_token():
+    revoke_api_token(_bearer_token())
+    return _json({'revoked': True})
+
+
+# --- Banks & Questions ---
+
+@bp.route('/banks')
+@token_required
+def list_banks():
+    user_id = g.api_user_id
+    active_bank_id = get_active_question_bank_id(user_id)
+    banks = [{
+        'id': bank['id'],
+        'name': bank['name'],
+        'question_count': bank['question_count'],
+        'version': get_bank_version(bank['id']),
+        'active': bank['id'] == active_bank_id
+    } for bank in get_user_question_banks(user_id)]
+    return _json({'banks': banks})
+
+
+@bp.route('/questions')
+@token_required
+def list_questions():
+    """
+    ?ids=1,2,3 批量取指定题目；否则按题号顺序分页（limit、cursor）。
+    include_answer=1 时附带答案（背题、离线缓存使用）。
+    """
+    question_bank_id = _resolve_bank_id(request.args.get('bank_id'))
+    if question_bank_id is None:
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    include_answer = _flag('include_answer')
+    version = get_bank_version(question_bank_id)
+
+    ids_param = request.args.get('ids')
+    if ids_param is not None:
+        ids = list(dict.fromkeys(part.strip() for part in ids_param.split(',') if part.strip()))
+        if not ids or len(ids) > MAX_BATCH_IDS:
+            return _error(400, 'invalid_request', f'ids 需包含 1 到 {MAX_BATCH_IDS} 个题号')
+        # 题目内容只随题库版本变化，与用户无关
+        etag = make_etag('api-questions', question_bank_id, version, ids, include_answer)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        questions = fetch_questions(ids, question_bank_id)
+        return with_etag(_json({
+            'bank_id': question_bank_id,
+            'version': version,
+            'items': [_question_payload(questions[qid], include_answer) for qid in ids if qid in questions],
+            'missing': [qid for qid in ids if qid not in questions]
+        }), etag)
+
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return _error(400, 'invalid_request', 'limit 必须是整数')
+    cursor_param = request.args.get('cursor')
+    after = None
+    if cursor_param:
+        after = _decode_cursor(cursor_param)
+        if after is None:
+            return _error(400, 'invalid_cursor', '分页游标无效')
+
+    etag = make_etag('api-questions', question_bank_id, version, cursor_param, limit, include_answer)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    # 键集分页：从上一页最后一题之后继续，翻页深度不影响查询代价
+    conn = get_db()
+    c = conn.cursor()
+    if after is None:
+        c.execute('''
+            SELECT *, CAST(id AS INTEGER) AS sort_key FROM questions WHERE question_bank_id=?
+            ORDER BY sort_key, id LIMIT ?
+        ''', (question_bank_id, limit + 1))
+    else:
+        c.execute('''
+            SELECT *, CAST(id AS INTEGER) AS sort_key FROM questions
+            WHERE question_bank_id=? AND (CAST(id AS INTEGER), id) > (?, ?)
+            ORDER BY sort_key, id LIMIT ?
+        ''', (question_bank_id, after[0], after[1], limit + 1))
+    rows = c.fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [_question_payload(question_from_row(row), include_answer) for row in rows]
+    return with_etag(_json({
+        'bank_id': question_bank_id,
+        'version': version,
+        'items': items,
+        'next_cursor': _encode_cursor(rows[-1]) if has_more else None
+    }), etag)
+
+
+# --- Practice ---
+
+@bp.route('/practice/next')
+@token_required
+def next_question():
+    """mode=random（默认）取一道随机未答题；mode=sequential 取顺序模式的当前题。"""
+    user_id = g.api_user_id
+    question_bank_id = _resolve_bank_id(request.args.get('bank_id'))
+    if question_bank_id is None:
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    mode = request.args.get('mode', 'random')
+    if mode not in ('random', 'sequential'):
+        return _error(400, 'invalid_request', 'mode 只能是 random 或 sequential')
+
+    restarted = False
+    conn = get_db()
+    c = conn.cursor()
+    if mode == 'sequential':
+        qid, restarted = current_sequential_question_id(c, user_id, question_bank_id)
+        conn.commit()
+    else:
+        qid = random_question_id(user_id, question_bank_id)
+    answered, total = practice_progress(c, user_id, question_bank_id)
+    conn.close()
+
+    q = fetch_question(qid, question_bank_id) if qid else None
+    payload = {
+        'bank_id': question_bank_id,
+        'question': _question_payload(q) if q else None,
+        'progress': _progress(answered, total)
+    }
+    if restarted:
+        payload['restarted'] = True
+    return _json(payload)
+
+
+@bp.route('/practice/answers', methods=['POST'])
+@token_required
+def submit_answer():
+    """
+    提交一道练习题：{"question_id": "12", "answer": ["A", "C"], "mode": "sequential", "key": "..."}。
+    返回批改结果、正确答案与进度；顺序模式同时返回下一题题号。带 key 的重试返回首次的结果（duplicate 为 true）。
+    """
+    user_id = g.api_user_id
+    data = _json_body()
+    if data is None:
+        return _error(400, 'invalid_request', '请求体必须是 JSON 对象')
+    question_bank_id = _resolve_bank_id(data.get('bank_id'))
+    if question_bank_id is None:
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    item, message = _parse_answer_item(data)
+    if item is None:
+        return _error(400, 'invalid_request', message)
+    mode = data.get('mode', 'random')
+    if mode not in ('random', 'sequential'):
+        return _error(400, 'invalid_request', 'mode 只能是 random 或 sequential')
+
+    qid = item['question_id']
+    q = fetch_question(qid, question_bank_id)
+    if q is None:
+        return _error(404, 'question_not_found', '题目不存在')
+
+    conn = get_db()
+    c = conn.cursor()
+    if item['key'] is not None:
+        previous = _existing_answers(c, user_id, [item['key']]).get(item['key'])
+        if previous is not None:
+            answered, total = practice_progress(c, user_id, question_bank_id)
+            conn.close()
+            return _json({
+                'question_id': previous['question_id'],
+                'correct': bool(previous['correct']),
+                'user_answer': previous['user_answer'],
+                'answer': q['answer'],
+                'duplicate': True,
+                'progress': _progress(answered, total)
+            })
+
+    question_type = q.get('question_type', q['type'])
+    user_answer_str = serialize_user_answer(question_type, item['answers'])
+    correct = validate_answer_by_type(question_type, user_answer_str, q['answer'])
+
+    _insert_answers(c, [(user_id, qid, question_bank_id, user_answer_str, correct, item['answered_at'], item['key'])])
+    next_qid = restarted = None
+    if mode == 'sequential':
+        next_qid, restarted = advance_sequential(c, user_id, question_bank_id, qid)
+    else:
+        c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (qid, user_id))
+    conn.commit()
+    answered, total = practice_progress(c, user_id, question_bank_id)
+    conn.close()
+
+    if not correct:
+        # prefetch_analysis 先检查 AI_PREFETCH_ENABLED（默认关闭），未开启时不查询供应商配置
+        prefetch_analysis(user_id, q, user_answer_str)
+
+    payload = {
+        'question_id': qid,
+        'correct': bool(correct),
+        'user_answer': user_answer_str,
+        'answer': q['answer'],
+        'progress': _progress(answered, total)
+    }
+    if mode == 'sequential':
+        payload['next_question_id'] = next_qid
+        if restarted:
+            payload['restarted'] = True
+    return _json(payload)
+
+
+@bp.route('/practice/answers/batch', methods=['POST'])
+@token_required
+def submit_answer_batch():
+    """
+    批量提交练习答案（客户端离线排队后一次上传）：
+    {"answers": [{"key": "...", "question_id": "12", "answer": ["A"], "answered_at": "2026-05-01T08:30:00Z"}, ...],
+     "mode": "sequential"}
+
+    每条记录必须带幂等键 key，已记录过的键（包括同一批内重复的）返回 duplicate 与首次的批改结果，
+    因此网络失败后整批重发是安全的。全部记录一次批改、一条 executemany 写入、一次提交；
+    返回逐条结果（status 为 ok / duplicate / error）与更新后的进度。批量提交不触发 AI 解析预取。
+    """
+    user_id = g.api_user_id
+    data = _json_body()
+    raw_items = data.get('answers') if data else None
+    if not isinstance(raw_items, list) or not 0 < len(raw_items) <= MAX_ANSWER_BATCH:
+        return _error(400, 'invalid_request', f'answers 必须是包含 1 到 {MAX_ANSWER_BATCH} 条记录的数组')
+    question_bank_id = _resolve_bank_id(data.get('bank_id'))
+    if question_bank_id is None:
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    mode = data.get('mode', 'random')
+    if mode not in ('random', 'sequential'):
+        return _error(400, 'invalid_request', 'mode 只能是 random 或 sequential')
+
+    parsed = []
+    for raw in raw_items:
+        item, message = _parse_answer_item(raw)
+        if item is not None and item['key'] is None:
+            item, message = None, '批量提交的每条记录都必须带 key'
+        parsed.append((item, message, raw.get('key') if isinstance(raw, dict) else None))
+
+    valid = [item for item, _, _ in parsed if item is not None]
+    questions = fetch_questions({item['question_id'] for item in valid}, question_bank_id)
+
+    conn = get_db()
+    c = conn.cursor()
+    # 之前请求已记录的键直接报告首次结果
+    seen = {key: {'question_id': row['question_id'], 'correct': bool(row['correct'])}
+            for key, row in _existing_answers(c, user_id, {item['key'] for item in valid}).items()}
+
+    results = []
+    rows = []
+    counts = {'ok': 0, 'duplicate': 0, 'error': 0}
+    last_qid = None
+    for item, message, raw_key in parsed:
+        if item is None:
+            results.append({'key': raw_key, 'status': 'error', 'message': message})
+        elif item['key'] in seen:
+            previous = seen[item['key']]
+            q = questions.get(previous['question_id'])
+            results.append({'key': item['key'], 'status': 'duplicate', 'question_id': previous['question_id'],
+                            'correct': previous['correct'], 'answer': q['answer'] if q else None})
+        elif item['question_id'] not in questions:
+            results.append({'key': item['key'], 'status': 'error', 'question_id': item['question_id'],
+                            'message': '题目不存在'})
+        else:
+            q = questions[item['question_id']]
+            question_type = q.get('question_type', q['type'])
+            user_answer_str = serialize_user_answer(question_type, item['answers'])
+            correct = validate_answer_by_type(question_type, user_answer_str, q['answer'])
+            rows.append((user_id, q['id'], question_bank_id, user_answer_str, correct, item['answered_at'], item['key']))
+            seen[item['key']] = {'question_id': q['id'], 'correct': bool(correct)}
+            last_qid = q['id']
+            results.append({'key': item['key'], 'status': 'ok', 'question_id': q['id'],
+                            'correct': bool(correct), 'answer': q['answer']})
+        counts[results[-1]['status']] += 1
+
+    next_qid = restarted = None
+    if rows:
+        # 并发重试的同一键由唯一索引去重
+        _insert_answers(c, rows)
+        if mode == 'sequential':
+            next_qid, restarted = advance_sequential(c, user_id, question_bank_id, last_qid)
+        else:
+            c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (last_qid, user_id))
+        conn.commit()
+    answered, total = practice_progress(c, user_id, question_bank_id)
+    conn.close()
+
+    payload = {'results': results, 'summary': counts, 'progress': _progress(answered, total)}
+    if mode == 'sequential' and rows:
+        payload['next_question_id'] = next_qid
+        if restarted:
+            payload['restarted'] = True
+    return _json(payload)
+
+
+# --- Exams ---
+
+def _load_exam(c, exam_id, user_id):
+    c.execute("SELECT * FROM exam_sessions WHERE id=? AND user_id=? AND mode='exam'", (exam_id, user_id))
+    return c.fetchone()
+
+
+def _exam_payload(exam, question_bank_id, question_ids):
+    questions = fetch_questions(question_ids, question_bank_id)
+    return {
+        'exam_id': exam['id'],
+        'bank_id': question_bank_id,
+        'completed': bool(exam['completed']),
+        'started_at': exam['start_time'],
+        'questions': [_question_payload(questions[qid]) for qid in question_ids if qid in questions]
+    }
+
+
+@bp.route('/exams', methods=['POST'])
+@token_required
+def start_exam():
+    """开始模拟考试：{"question_count": 10}，返回试卷（不含答案）。"""
+    user_id = g.api_user_id
+    data = _json_body() or {}
+    question_bank_id = _resolve_bank_id(data.get('bank_id'))
+    if question_bank_id is None:
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    try:
+        question_count = int(data.get('question_count', 10))
+    except (TypeError, ValueError):
+        return _error(400, 'invalid_request', 'question_count 必须是整数')
+    if not 1 <= question_count <= MAX_EXAM_QUESTIONS:
+        return _error(400, 'invalid_request', f'question_count 需在 1 到 {MAX_EXAM_QUESTIONS} 之间')
+
+    question_ids = fetch_random_question_ids(question_count, question_bank_id)
+    if not question_ids:
+        return _error(409, 'empty_bank', '题库中没有题目')
+    conn = get_db()
+    c = conn.cursor()
+    exam_id = create_exam_session(c, user_id, question_bank_id, 'exam', question_ids, datetime.now())
+    conn.commit()
+    exam = _load_exam(c, exam_id, user_id)
+    conn.close()
+    return _json(_exam_payload(exam, question_bank_id, question_ids), 201)
+
+
+@bp.route('/exams/<int:exam_id>')
+@token_required
+def get_exam(exam_id):
+    user_id = g.api_user_id
+    conn = get_db()
+    c = conn.cursor()
+    exam = _load_exam(c, exam_id, user_id)
+    question_ids = exam_question_ids(c, exam_id) if exam else []
+    conn.close()
+    if exam is None:
+        return _error(404, 'exam_not_found', '无法找到考试')
+
+    question_bank_id = exam['question_bank_id']
+    etag = make_etag('api-exam', user_id, exam_id, exam['completed'], question_bank_id,
+                     get_bank_version(question_bank_id))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    return with_etag(_json(_exam_payload(exam, question_bank_id, question_ids)), etag)
+
+
+@bp.route('/exams/<int:exam_id>/submit', methods=['POST'])
+@token_required
+def submit_exam(exam_id):
+    """交卷：{"answers": {"12": ["A"], "15": "B"}}，未作答的题按错误计。"""
+    user_id = g.api_user_id
+    data = _json_body()
+    answers = data.get('answers') if data else None
+    if not isinstance(answers, dict):
+        return _error(400, 'invalid_request', 'answers 必须是 {题号: 答案} 对象')
+    normalized = {}
+    for qid, value in answers.items():
+        answer = _answer_list(value)
+        if answer is None:
+            return _error(400, 'invalid_request', f'题目 {qid} 的答案必须是字符串或字符串数组')
+        normalized[str(qid)] = answer
+
+    conn = get_db()
+    c = conn.cursor()
+    # 立即获取写锁，同一试卷的并发提交只有一次能批改
+    c.execute('BEGIN IMMEDIATE')
+    exam = _load_exam(c, exam_id, user_id)
+    if exam is None:
+        conn.rollback()
+        conn.close()
+        return _error(404, 'exam_not_found', '无法找到考试')
+    if exam['completed']:
+        conn.rollback()
+        conn.close()
+        return _error(409, 'exam_completed', '该考试已交卷')
+    result = grade_exam(c, user_id, exam, lambda qid: normalized.get(str(qid), []))
+    conn.commit()
+    conn.close()
+    return _json({'exam_id': exam_id, **result})
+
+
+# --- Offline Sync ---
+
+def _columnar(rows):
+    """
+    把题目行编码为列式结构：{"count", "strings", "columns"}，columns 中每列一个数组（按 SYNC_COLUMNS），
+    题型/难度/分类列的值是 strings 中同名字符串表的下标，没有选项的题 options 为 null。
+    """
+    strings = {name: [] for name in SYNC_INTERNED_COLUMNS}
+    indexes = {name: {} for name in SYNC_INTERNED_COLUMNS}
+    columns = {name: [] for name in SYNC_COLUMNS}
+    for row in rows:
+        values = {
+            'id': row['id'],
+            'type': row['question_type'] or row['qtype'],
+            'stem': row['stem'],
+            'options': (json.loads(row['options']) if row['options'] else None) or None,
+            'answer': row['answer'],
+            'difficulty': row['difficulty'] or '',
+            'category': row['category'] or '',
+        }
+        for name in SYNC_INTERNED_COLUMNS:
+            value = values[name]
+            index = indexes[name].get(value)
+            if index is None:
+                index = indexes[name][value] = len(strings[name])
+                strings[name].append(value)
+            values[name] = index
+        for name in SYNC_COLUMNS:
+            columns[name].append(values[name])
+    return {'count': len(rows), 'strings': strings, 'columns': columns}
+
+
+def _read_bank(question_bank_id, since=None):
+    """
+    在同一个读事务里取题库版本与题目（since 不为 None 时只取之后变化的题目和删除记录），
+    保证返回的内容与版本号一致。
+    """
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN')
+    try:
+        c.execute('SELECT version FROM bank_versions WHERE question_bank_id=?', (question_bank_id,))
+        row = c.fetchone()
+        version = row['version'] if row else 0
+        deleted = []
+        if since is None:
+            c.execute('SELECT * FROM questions WHERE question_bank_id=? ORDER BY CAST(id AS INTEGER), id',
+                      (question_bank_id,))
+            rows = c.fetchall()
+        elif since >= version:
+            rows = []
+        else:
+            c.execute('''
+                SELECT * FROM questions WHERE question_bank_id=? AND version>?
+                ORDER BY CAST(id AS INTEGER), id
+            ''', (question_bank_id, since))
+            rows = c.fetchall()
+            c.execute('SELECT question_id FROM question_tombstones WHERE question_bank_id=? AND version>?',
+                      (question_bank_id, since))
+            deleted = [r['question_id'] for r in c.fetchall()]
+    finally:
+        conn.rollback()
+        conn.close()
+    return version, rows, deleted
+
+
+def _build_snapshot(question_bank_id):
+    version, rows, _ = _read_bank(question_bank_id)
+    body = json.dumps({
+        'format': SYNC_FORMAT,
+        'bank_id': question_bank_id,
+        'version': version,
+        **_columnar(rows)
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    # mtime=0：同一版本在各 worker 上压缩出的字节相同
+    return gzip.compress(body, 9, mtime=0)
+
+
+@bp.route('/banks/<int:bank_id>/snapshot')
+@token_required
+def bank_snapshot(bank_id):
+    """整个题库的列式快照，预先以 gzip 压缩并按题库版本缓存，内容不变时返回 304。"""
+    if not user_can_access_bank(g.api_user_id, bank_id):
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    version = get_bank_version(bank_id)
+    etag = make_etag('api-snapshot', bank_id, version)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    compressed = cached_fragment(('api-snapshot', bank_id, version), lambda: _build_snapshot(bank_id))
+    if request.accept_encodings['gzip']:
+        response = current_app.response_class(compressed, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = current_app.response_class(gzip.decompress(compressed), mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    return with_etag(response, etag)
+
+
+@bp.route('/banks/<int:bank_id>/changes')
+@token_required
+def bank_changes(bank_id):
+    """
+    since 版本之后的变化：changed 与快照同为列式结构，deleted 为已删除的题号。
+    客户端应用后把本地版本更新为返回的 version。
+    """
+    if not user_can_access_bank(g.api_user_id, bank_id):
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return _error(400, 'invalid_request', 'since 必须是非负整数')
+    version = get_bank_version(bank_id)
+    if since > version:
+        # 服务端数据被回滚或重建过，本地副本已无法增量更新
+        return _error(409, 'resync_required', '本地版本比服务端新，请重新下载题库快照')
+    etag = make_etag('api-changes', bank_id, since, version)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    version, rows, deleted = _read_bank(bank_id, since)
+    return with_etag(_json({
+        'format': SYNC_FORMAT,
+        'bank_id': bank_id,
+        'since': since,
+        'version': version,
+        'changed': _columnar(rows),
+        'deleted': deleted
+    }), etag)
+
+
+# --- Statistics ---
+
+@bp.route('/statistics')
+@token_required
+def statistics():
+    user_id = g.api_user_id
+    question_bank_id = _resolve_bank_id(request.args.get('bank_id'))
+    if question_bank_id is None:
+        return _error(404, 'bank_not_found', '题库不存在或无权访问')
+    conn = get_db()
+    c = conn.cursor()
+    stats = collect_statistics(c, user_id, question_bank_id)
+    answered, total = practice_progress(c, user_id, question_bank_id)
+    conn.close()
+    return _json({'bank_id': question_bank_id, 'progress': _progress(answered, total), **stats})
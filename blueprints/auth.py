@@ -1,5 +1,5 @@
 from functools import wraps
-from flask import Blueprint, request, render_template, session, redirect, url_for, flash
+from flask import Blueprint, request, render_template, session, redirect, url_for, flash, abort, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from database import get_db
 
@@ -41,6 +41,30 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def is_admin():
+    """Check whether the current user is listed in ADMIN_USERNAMES."""
+    user_id = session.get('user_id')
+    admins = current_app.config.get('ADMIN_USERNAMES') or ()
+    if not user_id or not admins:
+        return False
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT username FROM users WHERE id=?', (user_id,))
+    row = c.fetchone()
+    conn.close()
+    return bool(row) and row['username'] in admins
+
+def admin_required(f):
+    """Decorator to restrict a route to administrators (responds 403 otherwise)."""
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if not is_admin():
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
 ##############################
 # Authentication Routes
 ##############################
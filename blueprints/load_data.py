@@ -14,6 +14,7 @@ from database import (
     set_active_question_bank_id,
     user_can_access_bank,
     get_question_bank_summary,
+    bump_bank_version,
     SYSTEM_QUESTION_BANK_ID,
     SYSTEM_QUESTION_BANK_NAME,
 )
@@ -423,6 +424,7 @@ def preview():
                 )
                 success_count += 1
 
+            bump_bank_version(c, bank_id)
             conn.commit()
 
             # 清理session数据
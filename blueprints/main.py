@@ -52,6 +52,10 @@ def download_apk(filename):
         abort(404)
 
 # Error handlers usually attach to app, but via blueprint we use app_errorhandler
+@bp.app_errorhandler(403)
+def forbidden(e):
+    return render_template('error.html', error_code=403, error_message="无权访问该页面"), 403
+
 @bp.app_errorhandler(404)
 def page_not_found(e):
     return render_template('error.html', error_code=404, error_message="页面不存在"), 404
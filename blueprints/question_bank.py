@@ -8,8 +8,14 @@ from database import (
     get_question_bank_preview,
     delete_question_bank,
     user_can_access_bank,
+    get_latest_ai_pregen_job,
+    has_available_ai_provider,
+    get_bank_version,
     SYSTEM_QUESTION_BANK_ID,
 )
+from ai_pregen import describe_job
+from archive import delete_archived_history
+from page_cache import make_etag, not_modified, with_etag
 from .auth import login_required, get_user_id
 
 bp = Blueprint('question_bank', __name__, url_prefix='/question-banks')
@@ -66,6 +72,7 @@ def delete_bank(bank_id):
     summary = get_question_bank_summary(bank_id, user_id)
     name = summary['name'] if summary else '题库'
     if delete_question_bank(user_id, bank_id):
+        delete_archived_history(bank_id)
         flash(f'已删除「{name}」', 'success')
     else:
         flash('题库不存在或无权删除', 'error')
@@ -86,9 +93,20 @@ def preview_bank(bank_id):
         flash('题库不存在', 'error')
         return redirect(url_for('question_bank.list_banks'))
 
-    questions = get_question_bank_preview(bank_id, limit=20)
     is_active = bank_id == get_active_question_bank_id(user_id)
-    return render_template('question_bank_preview.html',
-                           summary=summary,
-                           questions=questions,
-                           is_active=is_active)
+    has_ai = has_available_ai_provider(user_id)
+    pregen_job = get_latest_ai_pregen_job(user_id, bank_id)
+    pregen_job = describe_job(pregen_job) if pregen_job else None
+    # 题目预览只随题库内容变化，其余输入（摘要、启用状态、预生成进度）都已在手边
+    etag = make_etag('bank_preview', user_id, bank_id, get_bank_version(bank_id), summary, is_active, has_ai, pregen_job)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    questions = get_question_bank_preview(bank_id, limit=20)
+    return with_etag(render_template('question_bank_preview.html',
+                                     summary=summary,
+                                     questions=questions,
+                                     is_active=is_active,
+                                     has_ai=has_ai,
+                                     pregen_job=pregen_job), etag)
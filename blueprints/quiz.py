@@ -2,18 +2,27 @@ import json
 import random
 import secrets
 from datetime import datetime, timedelta
-from flask import Blueprint, request, render_template, session, redirect, url_for, flash, jsonify
+from flask import Blueprint, current_app, request, render_template, session, redirect, url_for, flash, jsonify
 from database import (
     get_db,
     fetch_question,
+    fetch_questions,
+    question_from_row,
     random_question_id,
     is_favorite,
     fetch_random_question_ids,
+    create_exam_session,
+    exam_question_ids,
     get_active_question_bank_id,
-    get_active_ai_provider,
+    has_available_ai_provider,
+    get_bank_version,
+    get_favorites_state,
     SYSTEM_QUESTION_BANK_ID,
     parse_fill_answers,
 )
+from autosave import autosave_enabled, save_answers, saved_answers, take_exam_answers
+from page_cache import cached_fragment, make_etag, not_modified, with_etag
+from .ai import prefetch_analysis
 from .auth import login_required, get_user_id
 
 bp = Blueprint('quiz', __name__)
@@ -85,6 +94,191 @@ def build_ai_context(question, user_answer, has_result, has_provider):
         'questionType': question.get('question_type') or question.get('type')
     }
 
+
+def practice_progress(c, user_id, question_bank_id):
+    """返回 (已答题数, 题库总题数)。"""
+    c.execute('SELECT COUNT(DISTINCT question_id) AS answered FROM answer_log WHERE user_id=? AND question_bank_id=?',
+              (user_id, question_bank_id))
+    answered = c.fetchone()['answered']
+    c.execute('SELECT COUNT(*) AS total FROM questions WHERE question_bank_id=?', (question_bank_id,))
+    return answered, c.fetchone()['total']
+
+
+def _first_unanswered_id(c, user_id, question_bank_id, after_qid=None):
+    if after_qid is None:
+        c.execute('''
+            SELECT id FROM questions
+            WHERE question_bank_id = ?
+              AND id NOT IN (SELECT question_id FROM answer_log WHERE user_id = ? AND question_bank_id = ?)
+            ORDER BY CAST(id AS INTEGER) ASC LIMIT 1
+        ''', (question_bank_id, user_id, question_bank_id))
+    else:
+        c.execute('''
+            SELECT id FROM questions
+            WHERE CAST(id AS INTEGER) > ?
+              AND question_bank_id = ?
+              AND id NOT IN (SELECT question_id FROM answer_log WHERE user_id = ? AND question_bank_id = ?)
+            ORDER BY CAST(id AS INTEGER) ASC LIMIT 1
+        ''', (int(after_qid), question_bank_id, user_id, question_bank_id))
+    row = c.fetchone()
+    return row['id'] if row else None
+
+
+def _restart_sequence_id(c, question_bank_id):
+    c.execute('SELECT id FROM questions WHERE question_bank_id=? ORDER BY CAST(id AS INTEGER) ASC LIMIT 1',
+              (question_bank_id,))
+    row = c.fetchone()
+    return row['id'] if row else None
+
+
+def current_sequential_question_id(c, user_id, question_bank_id):
+    """
+    顺序模式的当前题目：上次停留的题目，否则第一道未答题，全部答过则回到第一题。
+    同时写回 users.current_seq_qid（由调用方提交）。
+
+    Returns:
+        tuple: (题目 ID 或 None（题库为空）, 是否从头重新开始)
+    """
+    c.execute('SELECT current_seq_qid FROM users WHERE id=?', (user_id,))
+    user_data = c.fetchone()
+    if user_data and user_data['current_seq_qid']:
+        c.execute('SELECT 1 FROM questions WHERE id=? AND question_bank_id=?',
+                  (user_data['current_seq_qid'], question_bank_id))
+        if c.fetchone():
+            return user_data['current_seq_qid'], False
+
+    restarted = False
+    qid = _first_unanswered_id(c, user_id, question_bank_id)
+    if qid is None:
+        qid = _restart_sequence_id(c, question_bank_id)
+        if qid is None:
+            return None, False
+        restarted = True
+    c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (qid, user_id))
+    return qid, restarted
+
+
+def advance_sequential(c, user_id, question_bank_id, qid):
+    """
+    答完 qid 后顺序模式的下一题：其后第一道未答题，其次整个题库第一道未答题，全部答过则回到第一题。
+    同时写回 users.current_seq_qid（由调用方提交）。
+
+    Returns:
+        tuple: (下一题 ID 或 None（题库为空）, 是否从头重新开始)
+    """
+    restarted = False
+    next_qid = _first_unanswered_id(c, user_id, question_bank_id, after_qid=qid)
+    if next_qid is None:
+        next_qid = _first_unanswered_id(c, user_id, question_bank_id)
+    if next_qid is None:
+        next_qid = _restart_sequence_id(c, question_bank_id)
+        restarted = next_qid is not None
+    c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (next_qid, user_id))
+    return next_qid, restarted
+
+
+# 自动保存单题答案的取值个数与每个取值的长度上限
+MAX_AUTOSAVE_VALUES = 50
+MAX_AUTOSAVE_VALUE_LENGTH = 1000
+
+
+def exam_deadline(exam):
+    """定时模式的截止时间（含 EXAM_SUBMIT_GRACE 秒宽限）；模拟考试不限时，返回 None。"""
+    if not exam['duration']:
+        return None
+    start_time = datetime.strptime(exam['start_time'], '%Y-%m-%d %H:%M:%S.%f')
+    grace = int(current_app.config.get('EXAM_SUBMIT_GRACE', 30))
+    return start_time + timedelta(seconds=exam['duration'] + grace)
+
+
+def claim_exam(c, exam_id):
+    """
+    把考试标记为已交卷，返回 True；已被其他请求（如倒计时自动交卷与手动点击同时到达）交卷时返回 False。
+    在判分之前调用，同一事务随后写入成绩，两个并发交卷只有一个会判分。
+    """
+    c.execute('UPDATE exam_sessions SET completed=1 WHERE id=? AND completed=0', (exam_id,))
+    return c.rowcount == 1
+
+
+def submitted_answers(c, exam):
+    """
+    交卷时每道题的作答：表单带了该题就以表单为准，否则取自动保存的答案。
+    超过截止时间（含宽限）才到达的交卷只采用已保存的答案。
+
+    Returns:
+        callable: 题目 ID -> 答案列表，可直接传给 grade_exam
+    """
+    saved = take_exam_answers(c, exam['id'])
+    deadline = exam_deadline(exam)
+    late = deadline is not None and datetime.now() > deadline
+
+    def answer_for(qid):
+        key = f'answer_{qid}'
+        if not late and key in request.form:
+            return request.form.getlist(key)
+        return saved.get(str(qid), [])
+    return answer_for
+
+
+def grade_exam(c, user_id, exam, answer_for):
+    """
+    批改一场考试，把答案与对错写入 exam_questions 和答题历史，并把考试标记为完成（由调用方提交）。
+
+    Args:
+        c: 数据库游标
+        user_id (int): 用户 ID
+        exam: exam_sessions 行
+        answer_for (callable): 题目 ID -> 用户提交的答案列表
+
+    Returns:
+        dict: correct_count、total、score 与逐题结果 results
+    """
+    question_ids = exam_question_ids(c, exam['id'])
+    question_bank_id = exam['question_bank_id']
+    questions = fetch_questions(question_ids, question_bank_id)
+    correct_count = 0
+    total = len(question_ids)
+    question_results = []
+    history_rows = []
+    paper_rows = []
+    answered_at = datetime.now()
+
+    for position, qid in enumerate(question_ids):
+        q = questions.get(str(qid))
+        if not q: continue
+        question_type = q.get('question_type', q['type'])
+        user_answer_str = serialize_user_answer(question_type, answer_for(qid))
+
+        # 使用新的验证函数
+        correct = validate_answer_by_type(question_type, user_answer_str, q['answer'])
+        if correct: correct_count += 1
+        history_rows.append((user_id, qid, question_bank_id, user_answer_str, correct))
+        paper_rows.append((user_answer_str, correct, answered_at, exam['id'], position))
+
+        question_results.append({
+            "id": qid,
+            "stem": q['stem'],
+            "user_answer": user_answer_str,
+            "correct_answer": q['answer'],
+            "is_correct": correct == 1
+        })
+
+    c.executemany('INSERT INTO history (user_id, question_id, question_bank_id, user_answer, correct) VALUES (?,?,?,?,?)',
+                  history_rows)
+    # 自动保存过的题目保留最后一次保存的时间
+    c.executemany('''
+        UPDATE exam_questions SET user_answer=?, correct=?, answered_at=COALESCE(answered_at, ?)
+        WHERE exam_id=? AND position=?
+    ''', paper_rows)
+    score = (correct_count / total * 100) if total > 0 else 0
+    c.execute('UPDATE exam_sessions SET completed=1, score=? WHERE id=?', (score, exam['id']))
+    return {
+        "correct_count": correct_count,
+        "total": total,
+        "score": score,
+        "results": question_results
+    }
+
 # --- Random & Single Question ---
 
 @bp.route('/random', methods=['GET'])
@@ -92,14 +286,14 @@ def build_ai_context(question, user_answer, has_result, has_provider):
 def random_question():
     user_id = get_user_id()
     question_bank_id = get_active_question_bank_id(user_id)
-    has_ai_provider = bool(get_active_ai_provider(user_id))
+    has_ai_provider = has_available_ai_provider(user_id)
     qid = random_question_id(user_id, question_bank_id)
     
     conn = get_db()
     c = conn.cursor()
     c.execute('SELECT COUNT(*) as total FROM questions WHERE question_bank_id=?', (question_bank_id,))
     total = c.fetchone()['total']
-    c.execute('SELECT COUNT(DISTINCT question_id) as answered FROM history WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
+    c.execute('SELECT COUNT(DISTINCT question_id) as answered FROM answer_log WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
     answered = c.fetchone()['answered']
     conn.close()
     
@@ -141,7 +335,7 @@ def show_question(qid):
     user_id = get_user_id()
     question_bank_id = get_active_question_bank_id(user_id)
     q = fetch_question(qid, question_bank_id)
-    has_ai_provider = bool(get_active_ai_provider(user_id))
+    has_ai_provider = has_available_ai_provider(user_id)
     user_answer_str = ""
     result_correct = None
     
@@ -172,10 +366,12 @@ def show_question(qid):
             (user_id, qid, question_bank_id, user_answer_str, correct)
         )
         conn.commit()
+        if not correct and has_ai_provider:
+            prefetch_analysis(user_id, q, user_answer_str)
 
         c.execute('SELECT COUNT(*) AS total FROM questions WHERE question_bank_id=?', (question_bank_id,))
         total = c.fetchone()['total']
-        c.execute('SELECT COUNT(DISTINCT question_id) AS answered FROM history WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
+        c.execute('SELECT COUNT(DISTINCT question_id) AS answered FROM answer_log WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
         answered = c.fetchone()['answered']
         conn.close()
 
@@ -199,7 +395,7 @@ def show_question(qid):
 
     c.execute('SELECT COUNT(*) AS total FROM questions WHERE question_bank_id=?', (question_bank_id,))
     total = c.fetchone()['total']
-    c.execute('SELECT COUNT(DISTINCT question_id) AS answered FROM history WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
+    c.execute('SELECT COUNT(DISTINCT question_id) AS answered FROM answer_log WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
     answered = c.fetchone()['answered']
     conn.close()
     
@@ -253,6 +449,15 @@ def browse_questions():
     category_filters = request.args.getlist('category')
     per_page = 20
 
+    # 列表只随题库内容、本人收藏和查询参数变化
+    bank_version = get_bank_version(question_bank_id)
+    etag = make_etag('browse', user_id, question_bank_id, bank_version,
+                     get_favorites_state(user_id, question_bank_id), page, question_type, search_query,
+                     difficulty_filters, category_filters)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
     conn = get_db()
     c = conn.cursor()
 
@@ -311,34 +516,44 @@ def browse_questions():
                   (user_id, row['id'], question_bank_id))
         question_data['is_favorite'] = bool(c.fetchone())
         questions.append(question_data)
-    
-    c.execute('''
-        SELECT DISTINCT qtype FROM questions
-        WHERE question_bank_id=? AND qtype IS NOT NULL AND qtype != ""
-        ORDER BY qtype
-    ''', (question_bank_id,))
-    available_types = [r['qtype'] for r in c.fetchall()]
+    conn.close()
 
-    c.execute('''
-        SELECT DISTINCT difficulty FROM questions
-        WHERE question_bank_id=? AND difficulty IS NOT NULL AND difficulty != ""
-        ORDER BY difficulty
-    ''', (question_bank_id,))
-    available_difficulties = [r['difficulty'] for r in c.fetchall()]
+    def load_facets():
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('''
+            SELECT DISTINCT qtype FROM questions
+            WHERE question_bank_id=? AND qtype IS NOT NULL AND qtype != ""
+            ORDER BY qtype
+        ''', (question_bank_id,))
+        types = [r['qtype'] for r in c.fetchall()]
 
-    c.execute('''
-        SELECT DISTINCT category FROM questions
-        WHERE question_bank_id=? AND category IS NOT NULL AND category != ""
-        ORDER BY category
-    ''', (question_bank_id,))
-    available_categories = [r['category'] for r in c.fetchall()]
-    conn.close()
+        c.execute('''
+            SELECT DISTINCT difficulty FROM questions
+            WHERE question_bank_id=? AND difficulty IS NOT NULL AND difficulty != ""
+            ORDER BY difficulty
+        ''', (question_bank_id,))
+        difficulties = [r['difficulty'] for r in c.fetchall()]
+
+        c.execute('''
+            SELECT DISTINCT category FROM questions
+            WHERE question_bank_id=? AND category IS NOT NULL AND category != ""
+            ORDER BY category
+        ''', (question_bank_id,))
+        categories = [r['category'] for r in c.fetchall()]
+        conn.close()
+        return types, difficulties, categories
+
+    # 筛选项（题型/难度/类别）与用户无关，按题库版本缓存
+    available_types, available_difficulties, available_categories = cached_fragment(
+        ('bank_facets', question_bank_id, bank_version), load_facets
+    )
 
     total_pages = (total + per_page - 1) // per_page
     has_prev = page > 1
     has_next = page < total_pages
     
-    return render_template('browse.html',
+    html = render_template('browse.html',
                            questions=questions,
                            total=total,
                            page=page,
@@ -353,6 +568,7 @@ def browse_questions():
                            available_types=available_types,
                            available_difficulties=available_difficulties,
                            available_categories=available_categories)
+    return with_etag(html, etag)
 
 @bp.route('/filter', methods=['GET', 'POST'])
 @login_required
@@ -408,29 +624,45 @@ def study_mode():
     """Display a cram-friendly page that shows answers directly."""
     user_id = get_user_id()
     question_bank_id = get_active_question_bank_id(user_id)
-    order_mode = request.args.get('order', 'sequential')
+    bank_version = get_bank_version(question_bank_id)
+    order_mode = 'random' if request.args.get('order', 'sequential') == 'random' else 'sequential'
     page = max(request.args.get('page', 1, type=int), 1)
     per_page = request.args.get('per_page', 10, type=int)
     allowed_sizes = [10, 20, 30, 50]
     if per_page not in allowed_sizes:
         per_page = 10
+    shuffle_seed = request.args.get('shuffle_seed', '')
+    requested_page = page
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) AS total FROM questions WHERE question_bank_id=?', (question_bank_id,))
-    total = c.fetchone()['total'] or 0
+    # 同一题库版本下，页面只由顺序、种子、页码和每页数量决定；未带种子的乱序请求每次都会生成新种子
+    if order_mode == 'sequential' or shuffle_seed:
+        etag = make_etag('study', user_id, question_bank_id, bank_version, order_mode, shuffle_seed,
+                         requested_page, per_page)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+    def count_questions():
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) AS total FROM questions WHERE question_bank_id=?', (question_bank_id,))
+        count = c.fetchone()['total'] or 0
+        conn.close()
+        return count
+
+    total = cached_fragment(('bank_total', question_bank_id, bank_version), count_questions)
 
     total_pages = max((total + per_page - 1) // per_page, 1) if total else 0
     if total_pages and page > total_pages:
         page = total_pages
 
-    shuffle_seed = request.args.get('shuffle_seed', '')
-    questions = []
+    if total and order_mode == 'random' and not shuffle_seed:
+        shuffle_seed = secrets.token_hex(4)
 
-    if total:
+    def render_cards():
+        conn = get_db()
+        c = conn.cursor()
         if order_mode == 'random':
-            if not shuffle_seed:
-                shuffle_seed = secrets.token_hex(4)
             c.execute('''
                 SELECT id, stem, answer, difficulty, qtype, category, options, question_type
                 FROM questions
@@ -443,7 +675,6 @@ def study_mode():
             end = start + per_page
             rows = rows[start:end]
         else:
-            order_mode = 'sequential'
             offset = (page - 1) * per_page
             c.execute('''
                 SELECT id, stem, answer, difficulty, qtype, category, options, question_type
@@ -453,7 +684,9 @@ def study_mode():
                 LIMIT ? OFFSET ?
             ''', (question_bank_id, per_page, offset))
             rows = c.fetchall()
+        conn.close()
 
+        questions = []
         for row in rows:
             question_type = row['question_type'] or row['qtype']
             options = json.loads(row['options']) if row['options'] else {}
@@ -468,23 +701,31 @@ def study_mode():
                 'options': options,
                 'fill_answers': parse_fill_answers(row['answer']) if question_type == '填空题' else []
             })
-    conn.close()
+        return render_template('study_cards.html', questions=questions)
+
+    # 题目卡片与用户无关，按题库版本缓存渲染好的 HTML，翻页回看时既不查询也不渲染
+    cards_html = ''
+    if total:
+        cards_html = cached_fragment(
+            ('study_cards', question_bank_id, bank_version, order_mode, shuffle_seed, page, per_page),
+            render_cards
+        )
 
     display_start = ((page - 1) * per_page + 1) if total else 0
     display_end = min(page * per_page, total) if total else 0
 
     pagination_params = {
-        'order': order_mode if order_mode in {'sequential', 'random'} else 'sequential',
+        'order': order_mode,
         'per_page': per_page,
     }
-    if pagination_params['order'] == 'random' and shuffle_seed:
+    if order_mode == 'random' and shuffle_seed:
         pagination_params['shuffle_seed'] = shuffle_seed
 
-    mode_label = '乱序背题' if pagination_params['order'] == 'random' else '顺序背题'
+    mode_label = '乱序背题' if order_mode == 'random' else '顺序背题'
 
     template_data = {
-        'questions': questions,
-        'order_mode': pagination_params['order'],
+        'cards_html': cards_html,
+        'order_mode': order_mode,
         'per_page': per_page,
         'per_page_options': allowed_sizes,
         'page': page if total else 1,
@@ -496,7 +737,9 @@ def study_mode():
         'pagination_params': pagination_params,
         'mode_label': mode_label,
     }
-    return render_template('study_mode.html', **template_data)
+    etag = make_etag('study', user_id, question_bank_id, bank_version, order_mode, shuffle_seed,
+                     requested_page, per_page)
+    return with_etag(render_template('study_mode.html', **template_data), etag)
 
 # --- Sequential Mode ---
 
@@ -507,45 +750,15 @@ def sequential_start():
     question_bank_id = get_active_question_bank_id(user_id)
     conn = get_db()
     c = conn.cursor()
-
-    c.execute('SELECT current_seq_qid FROM users WHERE id=?', (user_id,))
-    user_data = c.fetchone()
-    
-    if user_data and user_data['current_seq_qid']:
-        potential_qid = user_data['current_seq_qid']
-        current_question = fetch_question(potential_qid, question_bank_id)
-        current_qid = potential_qid if current_question else None
-    else:
-        current_qid = None
-    
-    if not current_qid:
-        c.execute('''
-            SELECT id FROM questions
-            WHERE question_bank_id = ?
-              AND id NOT IN (
-                  SELECT question_id FROM history WHERE user_id = ? AND question_bank_id = ?
-              )
-            ORDER BY CAST(id AS INTEGER) ASC LIMIT 1
-        ''', (question_bank_id, user_id, question_bank_id))
-        row = c.fetchone()
-        
-        if row is None:
-            c.execute('SELECT id FROM questions WHERE question_bank_id=? ORDER BY CAST(id AS INTEGER) ASC LIMIT 1',
-                      (question_bank_id,))
-            row = c.fetchone()
-            if row is None:
-                conn.close()
-                flash("题库中没有题目！", "error")
-                return redirect(url_for('main.index'))
-            current_qid = row['id']
-            flash("所有题目已完成，从第一题重新开始。", "info")
-        else:
-            current_qid = row['id']
-        
-        c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (current_qid, user_id))
-        conn.commit()
-    
+    current_qid, restarted = current_sequential_question_id(c, user_id, question_bank_id)
+    conn.commit()
     conn.close()
+
+    if current_qid is None:
+        flash("题库中没有题目！", "error")
+        return redirect(url_for('main.index'))
+    if restarted:
+        flash("所有题目已完成，从第一题重新开始。", "info")
     return redirect(url_for('quiz.show_sequential_question', qid=current_qid))
 
 @bp.route('/sequential/<qid>', methods=['GET', 'POST'])
@@ -554,7 +767,7 @@ def show_sequential_question(qid):
     user_id = get_user_id()
     question_bank_id = get_active_question_bank_id(user_id)
     q = fetch_question(qid, question_bank_id)
-    has_ai_provider = bool(get_active_ai_provider(user_id))
+    has_ai_provider = has_available_ai_provider(user_id)
     
     if q is None:
         flash("题目不存在", "error")
@@ -585,51 +798,23 @@ def show_sequential_question(qid):
         
         c.execute('INSERT INTO history (user_id, question_id, question_bank_id, user_answer, correct) VALUES (?,?,?,?,?)',
                   (user_id, qid, question_bank_id, user_answer_str, correct))
-        
-        c.execute('''
-            SELECT id FROM questions
-            WHERE CAST(id AS INTEGER) > ?
-              AND question_bank_id = ?
-              AND id NOT IN (SELECT question_id FROM history WHERE user_id = ? AND question_bank_id = ?)
-            ORDER BY CAST(id AS INTEGER) ASC LIMIT 1
-        ''', (int(qid), question_bank_id, user_id, question_bank_id))
-        
-        row = c.fetchone()
-        if row:
-            next_qid = row['id']
-            c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (next_qid, user_id))
-        else:
-            c.execute('''
-                SELECT id FROM questions
-                WHERE question_bank_id = ?
-                  AND id NOT IN (SELECT question_id FROM history WHERE user_id = ? AND question_bank_id = ?)
-                ORDER BY CAST(id AS INTEGER) ASC LIMIT 1
-            ''', (question_bank_id, user_id, question_bank_id))
-            row = c.fetchone()
-            if row:
-                next_qid = row['id']
-                c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (next_qid, user_id))
-            else:
-                c.execute('SELECT id FROM questions WHERE question_bank_id=? ORDER BY CAST(id AS INTEGER) ASC LIMIT 1',
-                          (question_bank_id,))
-                row = c.fetchone()
-                if row:
-                    next_qid = row['id']
-                    c.execute('UPDATE users SET current_seq_qid = ? WHERE id = ?', (next_qid, user_id))
-                    flash("所有题目已完成，从第一题重新开始。", "info")
-                else:
-                    c.execute('UPDATE users SET current_seq_qid = NULL WHERE id = ?', (user_id,))
-            
+
+        next_qid, restarted = advance_sequential(c, user_id, question_bank_id, qid)
+        if restarted:
+            flash("所有题目已完成，从第一题重新开始。", "info")
+
         result_msg = "回答正确！" if correct else f"回答错误，正确答案：{q['answer']}"
         flash(result_msg, "success" if correct else "error")
     
     c.execute('SELECT COUNT(*) AS total FROM questions WHERE question_bank_id=?', (question_bank_id,))
     total = c.fetchone()['total']
-    c.execute('SELECT COUNT(DISTINCT question_id) AS answered FROM history WHERE user_id = ? AND question_bank_id=?',
+    c.execute('SELECT COUNT(DISTINCT question_id) AS answered FROM answer_log WHERE user_id = ? AND question_bank_id=?',
               (user_id, question_bank_id))
     answered = c.fetchone()['answered']
     conn.commit()
     conn.close()
+    if result_correct is False and has_ai_provider:
+        prefetch_analysis(user_id, q, user_answer_str)
     
     is_fav = is_favorite(user_id, qid, question_bank_id)
     
@@ -670,13 +855,7 @@ def start_timed_mode():
     conn = get_db()
     c = conn.cursor()
     try:
-        c.execute('''
-            INSERT INTO exam_sessions 
-            (user_id, mode, question_ids, start_time, duration, question_bank_id) 
-            VALUES (?,?,?,?,?,?)
-        ''', (user_id, 'timed', json.dumps(question_ids), start_time, duration, question_bank_id))
-        
-        exam_id = c.lastrowid
+        exam_id = create_exam_session(c, user_id, question_bank_id, 'timed', question_ids, start_time, duration)
         conn.commit()
         session['current_exam_id'] = exam_id
         return redirect(url_for('quiz.timed_mode'))
@@ -700,16 +879,14 @@ def timed_mode():
     c = conn.cursor()
     c.execute('SELECT * FROM exam_sessions WHERE id=? AND user_id=?', (exam_id, user_id))
     exam = c.fetchone()
+    question_ids = exam_question_ids(c, exam_id) if exam else []
     conn.close()
     
     if not exam:
         flash("无法找到考试会话", "error")
         return redirect(url_for('main.index'))
     
-    question_bank_id = exam['question_bank_id'] if exam else get_active_question_bank_id(user_id)
-    question_bank_id = exam['question_bank_id'] if exam else get_active_question_bank_id(user_id)
-    question_bank_id = exam['question_bank_id'] if exam else get_active_question_bank_id(user_id)
-    question_ids = json.loads(exam['question_ids'])
+    question_bank_id = exam['question_bank_id']
     start_time = datetime.strptime(exam['start_time'], '%Y-%m-%d %H:%M:%S.%f')
     end_time = start_time + timedelta(seconds=exam['duration'])
     
@@ -717,8 +894,12 @@ def timed_mode():
     if remaining <= 0:
         return redirect(url_for('quiz.submit_timed_mode'))
     
-    questions_list = [fetch_question(qid, question_bank_id) for qid in question_ids]
-    return render_template('timed_mode.html', questions=questions_list, remaining=remaining)
+    questions = fetch_questions(question_ids, question_bank_id)
+    questions_list = [questions[qid] for qid in question_ids if qid in questions]
+    # 倒计时结束时各页面在宽限期的前一半内随机错开交卷，答案已自动保存，晚到的几秒不影响判分
+    submit_spread = int(current_app.config.get('EXAM_SUBMIT_GRACE', 30)) // 2
+    return render_template('timed_mode.html', questions=questions_list, remaining=remaining, exam_id=exam_id,
+                           autosave=autosave_enabled(), submit_spread=submit_spread)
 
 @bp.route('/submit_timed_mode', methods=['POST', 'GET'])
 @login_required
@@ -739,31 +920,19 @@ def submit_timed_mode():
         conn.close()
         flash("无法找到考试会话", "error")
         return redirect(url_for('main.index'))
+    if not claim_exam(c, exam_id):
+        conn.rollback()
+        conn.close()
+        session.pop('current_exam_id', None)
+        flash("本次定时模式已经交卷", "error")
+        return redirect(url_for('user.statistics'))
     
-    question_ids = json.loads(exam['question_ids'])
-    question_bank_id = exam['question_bank_id'] if exam else get_active_question_bank_id(user_id)
-    correct_count = 0
-    total = len(question_ids)
-    
-    for qid in question_ids:
-        user_answer = request.form.getlist(f'answer_{qid}')
-        q = fetch_question(qid, question_bank_id)
-        if not q: continue
-        question_type = q.get('question_type', q['type'])
-        user_answer_str = serialize_user_answer(question_type, user_answer)
-
-        # 使用新的验证函数
-        correct = validate_answer_by_type(question_type, user_answer_str, q['answer'])
-        if correct: correct_count += 1
-        c.execute('INSERT INTO history (user_id, question_id, question_bank_id, user_answer, correct) VALUES (?,?,?,?,?)',
-                  (user_id, qid, question_bank_id, user_answer_str, correct))
-    
-    score = (correct_count / total * 100) if total > 0 else 0
-    c.execute('UPDATE exam_sessions SET completed=1, score=? WHERE id=?', (score, exam_id))
+    result = grade_exam(c, user_id, exam, submitted_answers(c, exam))
     conn.commit()
     conn.close()
     
     session.pop('current_exam_id', None)
+    correct_count, total, score = result['correct_count'], result['total'], result['score']
     flash(f"定时模式结束！正确率：{correct_count}/{total} = {score:.2f}%", 
           "success" if score >= 60 else "error")
     return redirect(url_for('user.statistics'))
@@ -781,13 +950,7 @@ def start_exam():
     conn = get_db()
     c = conn.cursor()
     try:
-        c.execute('''
-            INSERT INTO exam_sessions 
-            (user_id, mode, question_ids, start_time, duration, question_bank_id) 
-            VALUES (?,?,?,?,?,?)
-        ''', (user_id, 'exam', json.dumps(question_ids), start_time, duration, question_bank_id))
-        
-        exam_id = c.lastrowid
+        exam_id = create_exam_session(c, user_id, question_bank_id, 'exam', question_ids, start_time, duration)
         conn.commit()
         session['current_exam_id'] = exam_id
         return redirect(url_for('quiz.exam'))
@@ -812,6 +975,7 @@ def exam():
     c = conn.cursor()
     c.execute('SELECT * FROM exam_sessions WHERE id=? AND user_id=?', (exam_id, user_id))
     exam_data = c.fetchone() # 建议改名以免和函数名混淆，不过 Python 允许这样
+    question_ids = exam_question_ids(c, exam_id) if exam_data else []
     conn.close()
     
     # 检查2：数据库里有没有这个考试
@@ -821,11 +985,18 @@ def exam():
     
     # === 关键点：以下代码必须和上面的 if 保持同级缩进，不能缩进进去 ===
     question_bank_id = exam_data['question_bank_id']
-    question_ids = json.loads(exam_data['question_ids'])
-    questions_list = [fetch_question(qid, question_bank_id) for qid in question_ids]
+    # 试卷题目在开考时已固定，只有题库内容变化才需要重新渲染
+    etag = make_etag('exam', user_id, exam_id, question_bank_id, get_bank_version(question_bank_id), autosave_enabled())
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    questions = fetch_questions(question_ids, question_bank_id)
+    questions_list = [questions[qid] for qid in question_ids if qid in questions]
     
     # 必须有这个 return
-    return render_template('exam.html', questions=questions_list)
+    return with_etag(render_template('exam.html', questions=questions_list, exam_id=exam_id,
+                                     autosave=autosave_enabled()), etag)
 @bp.route('/submit_exam', methods=['POST'])
 @login_required
 def submit_exam():
@@ -843,46 +1014,109 @@ def submit_exam():
     if not exam:
         conn.close()
         return jsonify({"success": False, "msg": "无法找到考试"}), 404
+    if not claim_exam(c, exam_id):
+        conn.rollback()
+        conn.close()
+        session.pop('current_exam_id', None)
+        return jsonify({"success": False, "msg": "本场考试已经交卷"}), 409
     
-    question_ids = json.loads(exam['question_ids'])
-    question_bank_id = exam['question_bank_id'] if exam else get_active_question_bank_id(user_id)
-    correct_count = 0
-    total = len(question_ids)
-    question_results = []
-    
-    for qid in question_ids:
-        user_answer = request.form.getlist(f'answer_{qid}')
-        q = fetch_question(qid, question_bank_id)
-        if not q: continue
-        question_type = q.get('question_type', q['type'])
-        user_answer_str = serialize_user_answer(question_type, user_answer)
-
-        # 使用新的验证函数
-        correct = validate_answer_by_type(question_type, user_answer_str, q['answer'])
-        if correct: correct_count += 1
-        
-        c.execute('INSERT INTO history (user_id, question_id, question_bank_id, user_answer, correct) VALUES (?,?,?,?,?)',
-                  (user_id, qid, question_bank_id, user_answer_str, correct))
-        
-        question_results.append({
-            "id": qid,
-            "stem": q['stem'],
-            "user_answer": user_answer_str,
-            "correct_answer": q['answer'],
-            "is_correct": correct == 1
-        })
-    
-    score = (correct_count / total * 100) if total > 0 else 0
-    c.execute('UPDATE exam_sessions SET completed=1, score=? WHERE id=?', (score, exam_id))
+    result = grade_exam(c, user_id, exam, submitted_answers(c, exam))
     conn.commit()
     conn.close()
     
     session.pop('current_exam_id', None)
     
-    return jsonify({
-        "success": True,
-        "correct_count": correct_count,
-        "total": total,
-        "score": score,
-        "results": question_results
-    })
+    return jsonify({"success": True, "result_url": url_for('quiz.exam_review', exam_id=exam_id), **result})
+
+@bp.route('/exam/<int:exam_id>/answers', methods=['GET', 'POST'])
+@login_required
+def exam_answers(exam_id):
+    """
+    考试/定时模式的作答自动保存。
+    GET 返回已保存的作答（页面刷新或崩溃后恢复）；POST {"answers": {"题号": ["A", "C"]}} 保存若干题的当前作答，
+    写入先进入缓冲，由 autosave 后台线程批量落库。
+    """
+    user_id = get_user_id()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT * FROM exam_sessions WHERE id=? AND user_id=?', (exam_id, user_id))
+    exam = c.fetchone()
+    if not exam:
+        conn.close()
+        return jsonify({"success": False, "msg": "无法找到考试"}), 404
+
+    if request.method == 'GET':
+        answers = saved_answers(c, exam_id)
+        conn.close()
+        return jsonify({"success": True, "answers": answers})
+
+    paper = set(exam_question_ids(c, exam_id))
+    conn.close()
+    if exam['completed']:
+        return jsonify({"success": False, "msg": "本场考试已经交卷"}), 409
+    deadline = exam_deadline(exam)
+    if deadline is not None and datetime.now() > deadline:
+        return jsonify({"success": False, "msg": "考试时间已结束"}), 409
+
+    data = request.get_json(silent=True) or {}
+    answers = data.get('answers')
+    if not isinstance(answers, dict):
+        return jsonify({"success": False, "msg": "answers 必须是对象"}), 400
+    cleaned = {}
+    for qid, values in answers.items():
+        if qid not in paper:
+            return jsonify({"success": False, "msg": f"题目 {qid} 不在本场考试中"}), 400
+        if isinstance(values, str):
+            values = [values]
+        if (not isinstance(values, list) or len(values) > MAX_AUTOSAVE_VALUES
+                or not all(isinstance(v, str) and len(v) <= MAX_AUTOSAVE_VALUE_LENGTH for v in values)):
+            return jsonify({"success": False, "msg": f"题目 {qid} 的答案格式不正确"}), 400
+        cleaned[qid] = values
+    save_answers(exam_id, cleaned)
+    return jsonify({"success": True, "saved": len(cleaned)})
+
+@bp.route('/exam/<int:exam_id>/review')
+@login_required
+def exam_review(exam_id):
+    user_id = get_user_id()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT * FROM exam_sessions WHERE id=? AND user_id=?', (exam_id, user_id))
+    exam_data = c.fetchone()
+    # 未交卷的考试不能回看，否则可提前看到正确答案
+    if not exam_data or not exam_data['completed']:
+        conn.close()
+        flash("无法找到已完成的考试", "error")
+        return redirect(url_for('user.statistics'))
+
+    question_bank_id = exam_data['question_bank_id']
+    # 交卷后答案不再变化，只有题库内容变化才需要重新渲染
+    etag = make_etag('exam_review', user_id, exam_id, question_bank_id, get_bank_version(question_bank_id))
+    cached = not_modified(etag)
+    if cached is not None:
+        conn.close()
+        return cached
+
+    c.execute('''
+        SELECT eq.position, eq.question_id, eq.user_answer, eq.correct, eq.answered_at, q.*
+        FROM exam_questions eq
+        LEFT JOIN questions q ON q.id = eq.question_id AND q.question_bank_id = ?
+        WHERE eq.exam_id = ?
+        ORDER BY eq.position
+    ''', (question_bank_id, exam_id))
+    rows = c.fetchall()
+    conn.close()
+
+    items = []
+    for row in rows:
+        items.append({
+            'position': row['position'] + 1,
+            'question_id': row['question_id'],
+            'question': question_from_row(row) if row['id'] is not None else None,
+            'user_answer': row['user_answer'],
+            'correct': row['correct'],
+            'answered_at': row['answered_at']
+        })
+    correct_count = sum(1 for item in items if item['correct'])
+    return with_etag(render_template('exam_review.html', exam=exam_data, items=items,
+                                     correct_count=correct_count), etag)
@@ -1,7 +1,8 @@
 import random
 from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
-from database import get_db, fetch_question, is_favorite, get_active_question_bank_id, get_active_ai_provider
+from database import get_db, fetch_question, is_favorite, get_active_question_bank_id, has_available_ai_provider
+from archive import delete_archived_history, history_page
 from .auth import login_required, get_user_id, is_logged_in
 
 bp = Blueprint('user', __name__)
@@ -151,9 +152,11 @@ def reset_history():
         conn = get_db()
         c = conn.cursor()
         c.execute('DELETE FROM history WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
+        c.execute('DELETE FROM history_daily WHERE user_id=? AND question_bank_id=?', (user_id, question_bank_id))
         c.execute('UPDATE users SET current_seq_qid = NULL WHERE id = ?', (user_id,))
         conn.commit()
         conn.close()
+        delete_archived_history(question_bank_id, user_id)
         flash("已清空当前题库的答题历史。", "success")
     except Exception as e:
         flash(f"重置历史时出错: {str(e)}", "error")
@@ -165,27 +168,10 @@ def reset_history():
 def show_history():
     user_id = get_user_id()
     question_bank_id = get_active_question_bank_id(user_id)
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT * FROM history WHERE user_id=? AND question_bank_id=? ORDER BY timestamp DESC',
-              (user_id, question_bank_id))
-    rows = c.fetchall()
-    conn.close()
-    
-    history_data = []
-    for r in rows:
-        q = fetch_question(r['question_id'], question_bank_id)
-        stem = q['stem'] if q else '题目已删除'
-        history_data.append({
-            'id': r['id'],
-            'question_id': r['question_id'],
-            'stem': stem,
-            'user_answer': r['user_answer'],
-            'correct': r['correct'],
-            'timestamp': r['timestamp']
-        })
-    
-    return render_template('history.html', history=history_data)
+    page = request.args.get('page', 1, type=int)
+    # 近期记录在主库，超过保留期的在归档库，history_page 按时间倒序连续分页
+    history_data, has_more = history_page(user_id, question_bank_id, page)
+    return render_template('history.html', history=history_data, page=max(page, 1), has_more=has_more)
 
 @bp.route('/wrong')
 @login_required
@@ -194,7 +180,7 @@ def wrong_questions():
     question_bank_id = get_active_question_bank_id(user_id)
     conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT question_id FROM history WHERE user_id=? AND question_bank_id=? AND correct=0',
+    c.execute('SELECT question_id FROM answer_log WHERE user_id=? AND question_bank_id=? AND correct_count < attempts',
               (user_id, question_bank_id))
     rows = c.fetchall()
     conn.close()
@@ -214,10 +200,10 @@ def wrong_questions():
 def only_wrong_mode():
     user_id = get_user_id()
     question_bank_id = get_active_question_bank_id(user_id)
-    has_ai_provider = bool(get_active_ai_provider(user_id))
+    has_ai_provider = has_available_ai_provider(user_id)
     conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT question_id FROM history WHERE user_id=? AND question_bank_id=? AND correct=0',
+    c.execute('SELECT question_id FROM answer_log WHERE user_id=? AND question_bank_id=? AND correct_count < attempts',
               (user_id, question_bank_id))
     rows = c.fetchall()
     conn.close()
@@ -333,15 +319,10 @@ def show_favorites():
     favorites_data = [{'question_id': r['question_id'], 'tag': r['tag'], 'stem': r['stem']} for r in rows]
     return render_template('favorites.html', favorites=favorites_data)
 
-@bp.route('/statistics')
-@login_required
-def statistics():
-    user_id = get_user_id()
-    question_bank_id = get_active_question_bank_id(user_id)
-    conn = get_db()
-    c = conn.cursor()
-    
-    c.execute('SELECT COUNT(*) as total, SUM(correct) as correct_count FROM history WHERE user_id=? AND question_bank_id=?',
+def collect_statistics(c, user_id, question_bank_id):
+    """统计页数据：总体正确率、按难度/分类的正确率、错得最多的 10 题与最近 5 场考试。"""
+    # answer_log 同时包含 history 与已归档答题的按日汇总
+    c.execute('SELECT SUM(attempts) as total, SUM(correct_count) as correct_count FROM answer_log WHERE user_id=? AND question_bank_id=?',
               (user_id, question_bank_id))
     row = c.fetchone()
     total = row['total'] if row['total'] else 0
@@ -349,8 +330,8 @@ def statistics():
     overall_accuracy = (correct_count/total*100) if total>0 else 0
     
     c.execute('''
-        SELECT q.difficulty, COUNT(*) as total, SUM(h.correct) as correct_count
-        FROM history h 
+        SELECT q.difficulty, SUM(h.attempts) as total, SUM(h.correct_count) as correct_count
+        FROM answer_log h 
         JOIN questions q ON h.question_id=q.id AND h.question_bank_id = q.question_bank_id
         WHERE h.user_id=? AND h.question_bank_id=?
         GROUP BY q.difficulty
@@ -365,8 +346,8 @@ def statistics():
         })
     
     c.execute('''
-        SELECT q.category, COUNT(*) as total, SUM(h.correct) as correct_count
-        FROM history h 
+        SELECT q.category, SUM(h.attempts) as total, SUM(h.correct_count) as correct_count
+        FROM answer_log h 
         JOIN questions q ON h.question_id=q.id AND h.question_bank_id = q.question_bank_id
         WHERE h.user_id=? AND h.question_bank_id=?
         GROUP BY q.category
@@ -381,10 +362,10 @@ def statistics():
         })
     
     c.execute('''
-        SELECT h.question_id, COUNT(*) as wrong_times, q.stem
-        FROM history h 
+        SELECT h.question_id, SUM(h.attempts - h.correct_count) as wrong_times, q.stem
+        FROM answer_log h 
         JOIN questions q ON h.question_id=q.id AND h.question_bank_id = q.question_bank_id
-        WHERE h.user_id=? AND h.question_bank_id=? AND h.correct=0
+        WHERE h.user_id=? AND h.question_bank_id=? AND h.correct_count < h.attempts
         GROUP BY h.question_id ORDER BY wrong_times DESC LIMIT 10
     ''', (user_id, question_bank_id))
     worst_questions = []
@@ -396,7 +377,8 @@ def statistics():
         })
     
     c.execute('''
-        SELECT id, mode, start_time, score, (SELECT COUNT(*) FROM JSON_EACH(question_ids)) as question_count
+        SELECT id, mode, start_time, score,
+               (SELECT COUNT(*) FROM exam_questions WHERE exam_id = exam_sessions.id) as question_count
         FROM exam_sessions WHERE user_id=? AND question_bank_id=? AND completed=1
         ORDER BY start_time DESC LIMIT 5
     ''', (user_id, question_bank_id))
@@ -409,11 +391,24 @@ def statistics():
             'score': r['score'],
             'question_count': r['question_count']
         })
-    
+
+    return {
+        'total_answers': total,
+        'correct_answers': correct_count,
+        'overall_accuracy': overall_accuracy,
+        'difficulty_stats': difficulty_stats,
+        'category_stats': category_stats,
+        'worst_questions': worst_questions,
+        'recent_exams': recent_exams
+    }
+
+@bp.route('/statistics')
+@login_required
+def statistics():
+    user_id = get_user_id()
+    question_bank_id = get_active_question_bank_id(user_id)
+    conn = get_db()
+    c = conn.cursor()
+    stats = collect_statistics(c, user_id, question_bank_id)
     conn.close()
-    return render_template('statistics.html', 
-                          overall_accuracy=overall_accuracy,
-                          difficulty_stats=difficulty_stats,
-                          category_stats=category_stats,
-                          worst_questions=worst_questions,
-                          recent_exams=recent_exams)
+    return render_template('statistics.html', **stats)
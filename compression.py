@@ -0,0 +1,99 @@
+"""
+HTML / JSON 响应的 gzip 压缩。
+
+init_compression(app) 注册 after_request 钩子：客户端接受 gzip、类型在 COMPRESSIBLE_TYPES 中且响应体不小于
+COMPRESSION_MIN_SIZE 时整体压缩；流式响应逐块压缩并在每块后 Z_SYNC_FLUSH，已生成的内容立即发出。
+
+以下响应原样发送：
+- 已带 Content-Encoding 的（/assets/ 的预压缩文件）与文件直传（send_file）；
+- 204/304 等无响应体的状态；
+- /ai/run 的 text/plain 流（COMPRESSION_EXEMPT_ENDPOINTS）：逐字输出要求每个分片尽快到达浏览器，
+  且 text/plain 本就不在可压缩类型中，这里显式列出以免日后扩展类型时误伤。
+"""
+import zlib
+
+from flask import request
+
+COMPRESSIBLE_TYPES = frozenset({
+    'text/html',
+    'text/css',
+    'text/xml',
+    'application/json',
+    'application/javascript',
+    'text/javascript',
+    'image/svg+xml',
+})
+COMPRESSION_EXEMPT_ENDPOINTS = frozenset({'ai.run_ai'})
+
+_settings = {
+    'min_size': 1024,
+    'level': 6,
+}
+
+
+def _gzip_compressor(level: int):
+    # wbits=31：带 gzip 头与尾的流
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def _compress_stream(chunks, level: int):
+    compressor = _gzip_compressor(level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush(zlib.Z_FINISH)
+    finally:
+        # 客户端断开时把关闭传递给原响应体（如 stream_with_context 的生成器）
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def _should_compress(response) -> bool:
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return False
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return False
+    if request.endpoint in COMPRESSION_EXEMPT_ENDPOINTS or request.method == 'HEAD':
+        return False
+    return bool(request.accept_encodings['gzip'])
+
+
+def _add_vary(response) -> None:
+    vary = response.headers.get('Vary', '')
+    if 'accept-encoding' not in vary.lower():
+        response.headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+
+
+def _compress_response(response):
+    if response.mimetype in COMPRESSIBLE_TYPES:
+        # 同一地址可能返回压缩或未压缩两种内容，缓存需按 Accept-Encoding 区分
+        _add_vary(response)
+    if not _should_compress(response):
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, _settings['level'])
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < _settings['min_size']:
+            return response
+        compressor = _gzip_compressor(_settings['level'])
+        response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def init_compression(app) -> None:
+    """读取阈值与压缩级别并注册 after_request 钩子（在 app.py 中调用一次）。"""
+    _settings['min_size'] = int(app.config.get('COMPRESSION_MIN_SIZE', _settings['min_size']))
+    _settings['level'] = int(app.config.get('COMPRESSION_LEVEL', _settings['level']))
+    app.after_request(_compress_response)
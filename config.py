@@ -15,4 +15,76 @@ class Config:
     
     # 数据库和文件路径配置 (可选，虽然目前 database.py 使用了硬编码，但在 Config 中定义是好习惯)
     DATABASE_FILE = 'database.db'
-    CSV_FILE = 'questions.csv'
\ No newline at end of file
+    CSV_FILE = 'questions.csv'
+
+    # 管理员用户名（逗号分隔），可访问 AI 调用指标等运维接口
+    ADMIN_USERNAMES = frozenset(
+        name.strip() for name in os.environ.get('ADMIN_USERNAMES', '').split(',') if name.strip()
+    )
+
+    # AI 配置
+    # 相同提示词的并发请求共享一次上游流式调用
+    AI_COALESCE_ENABLED = os.environ.get('AI_COALESCE_ENABLED', '1') == '1'
+    # 首选供应商不可用时，依次尝试用户其它已验证的配置
+    AI_FAILOVER_ENABLED = os.environ.get('AI_FAILOVER_ENABLED', '1') == '1'
+    # 熔断：连续失败次数阈值、退避起始/上限秒数、首包超过该秒数视为慢调用
+    AI_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('AI_BREAKER_FAILURE_THRESHOLD', 3))
+    AI_BREAKER_BASE_BACKOFF = float(os.environ.get('AI_BREAKER_BASE_BACKOFF', 5))
+    AI_BREAKER_MAX_BACKOFF = float(os.environ.get('AI_BREAKER_MAX_BACKOFF', 300))
+    AI_BREAKER_SLOW_SECONDS = float(os.environ.get('AI_BREAKER_SLOW_SECONDS', 12))
+    # 已解密 API 密钥的进程内缓存：存活秒数与最大条目数（设为 0 关闭缓存）
+    AI_KEY_CACHE_TTL = int(os.environ.get('AI_KEY_CACHE_TTL', 300))
+    AI_KEY_CACHE_SIZE = int(os.environ.get('AI_KEY_CACHE_SIZE', 256))
+    # 后台健康检查：是否启用、周期秒数（0 表示只在保存时检查）、并发数、单次超时
+    AI_HEALTHCHECK_ENABLED = os.environ.get('AI_HEALTHCHECK_ENABLED', '1') == '1'
+    AI_HEALTHCHECK_INTERVAL = int(os.environ.get('AI_HEALTHCHECK_INTERVAL', 600))
+    AI_HEALTHCHECK_WORKERS = int(os.environ.get('AI_HEALTHCHECK_WORKERS', 8))
+    AI_HEALTHCHECK_TIMEOUT = int(os.environ.get('AI_HEALTHCHECK_TIMEOUT', 15))
+    # 题库 AI 预生成：并发数、每个供应商每分钟请求上限、/ai/run 是否直接返回已预生成的内容
+    AI_PREGEN_WORKERS = int(os.environ.get('AI_PREGEN_WORKERS', 4))
+    AI_PREGEN_RATE_PER_MINUTE = int(os.environ.get('AI_PREGEN_RATE_PER_MINUTE', 60))
+    AI_PREGEN_SERVE = os.environ.get('AI_PREGEN_SERVE', '1') == '1'
+    # 答错后在后台预取 AI 解析：是否启用、同时进行的预取上限、每用户每日预取次数、结果保留秒数
+    AI_PREFETCH_ENABLED = os.environ.get('AI_PREFETCH_ENABLED', '0') == '1'
+    AI_PREFETCH_MAX_INFLIGHT = int(os.environ.get('AI_PREFETCH_MAX_INFLIGHT', 4))
+    AI_PREFETCH_DAILY_BUDGET = int(os.environ.get('AI_PREFETCH_DAILY_BUDGET', 50))
+    AI_PREFETCH_TTL = int(os.environ.get('AI_PREFETCH_TTL', 600))
+    # 对冲请求：首选供应商在延迟秒数内无输出时，向下一个可用配置再发一路（延迟按首包 p95 在最小值与该值之间自适应）
+    AI_HEDGE_ENABLED = os.environ.get('AI_HEDGE_ENABLED', '0') == '1'
+    AI_HEDGE_DELAY = float(os.environ.get('AI_HEDGE_DELAY', 2.0))
+    AI_HEDGE_MIN_DELAY = float(os.environ.get('AI_HEDGE_MIN_DELAY', 0.3))
+    AI_HEDGE_MIN_SAMPLES = int(os.environ.get('AI_HEDGE_MIN_SAMPLES', 20))
+    # 单次 AI 生成的时间（秒）与输出字符上限，超出即断开上游（0 表示不限制）
+    AI_RUN_TIME_BUDGET = float(os.environ.get('AI_RUN_TIME_BUDGET', 120))
+    AI_RUN_MAX_CHARS = int(os.environ.get('AI_RUN_MAX_CHARS', 8000))
+    # 运行指标：是否记录请求/SQL 耗时并开放 GET /metrics；抓取令牌（Authorization: Bearer），未设置时仅管理员可访问
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+    # SQL 画像：是否启用、慢查询阈值（毫秒）、是否对每种新语句都取执行计划、进程退出时写入报告的文件路径
+    QUERY_LOG_ENABLED = os.environ.get('QUERY_LOG_ENABLED', '1') == '1'
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+    QUERY_EXPLAIN_ALL = os.environ.get('QUERY_EXPLAIN_ALL', '0') == '1'
+    QUERY_REPORT_FILE = os.environ.get('QUERY_REPORT_FILE', '')
+    # 启动时是否自动执行数据库迁移（关闭后结构版本落后会拒绝启动，需先运行 python migrate.py）
+    DB_AUTO_MIGRATE = os.environ.get('DB_AUTO_MIGRATE', '1') == '1'
+    # 页面缓存：是否为题库浏览/背题/预览/试卷页面启用 ETag 与 304，以及进程内渲染片段缓存的条目上限
+    PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 512))
+    # 静态资源：是否使用 python assets.py 构建的带指纹、预压缩版本（未构建时自动回退到 /static/）
+    ASSETS_ENABLED = os.environ.get('ASSETS_ENABLED', '1') == '1'
+    # 响应压缩：是否对 HTML/JSON 启用 gzip、最小压缩字节数、压缩级别（1-9）
+    COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+    COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+    # JSON 接口（/api/v1）令牌有效天数，0 表示永不过期
+    API_TOKEN_TTL_DAYS = int(os.environ.get('API_TOKEN_TTL_DAYS', 90))
+    # 答题历史归档：归档库文件、主库保留明细的天数、每个事务移动的行数（python archive.py 定期执行）
+    HISTORY_ARCHIVE_FILE = os.environ.get('HISTORY_ARCHIVE_FILE', 'history_archive.db')
+    HISTORY_RETENTION_DAYS = int(os.environ.get('HISTORY_RETENTION_DAYS', 180))
+    HISTORY_ARCHIVE_BATCH = int(os.environ.get('HISTORY_ARCHIVE_BATCH', 5000))
+    # 考试作答自动保存：是否启用、缓冲批量写入的间隔（秒）、缓冲条数达到多少时提前写入
+    AUTOSAVE_ENABLED = os.environ.get('AUTOSAVE_ENABLED', '1') == '1'
+    AUTOSAVE_FLUSH_INTERVAL = float(os.environ.get('AUTOSAVE_FLUSH_INTERVAL', 3))
+    AUTOSAVE_MAX_PENDING = int(os.environ.get('AUTOSAVE_MAX_PENDING', 5000))
+    # 定时模式倒计时结束后仍接收交卷的宽限秒数（页面在前一半时间内随机错开自动交卷）
+    EXAM_SUBMIT_GRACE = int(os.environ.get('EXAM_SUBMIT_GRACE', 30))
@@ -1,8 +1,18 @@
 import sqlite3
 import csv
+import hashlib
 import json
 import os
 import re
+import secrets
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # 数据库文件路径
 DB_NAME = 'database.db'
@@ -26,12 +36,11 @@ def _column_exists(cursor, table_name, column_name):
     cursor.execute(f"PRAGMA table_info({table_name})")
     return any(row['name'] == column_name for row in cursor.fetchall())
 
-def _rebuild_favorites_table(conn):
+def _rebuild_favorites_table(c):
     """
     Rebuild the favorites table to introduce the question_bank_id column
     and the updated UNIQUE constraint.
     """
-    c = conn.cursor()
     c.execute('ALTER TABLE favorites RENAME TO favorites_old')
     c.execute('''
         CREATE TABLE favorites (
@@ -51,7 +60,129 @@ def _rebuild_favorites_table(conn):
         SELECT id, user_id, question_id, 0, tag, created_at FROM favorites_old
     ''')
     c.execute('DROP TABLE favorites_old')
-    conn.commit()
+
+# Callables invoked as listener(sql, parameters, seconds) after every statement run through get_db()
+_query_listeners = []
+
+def add_query_listener(listener):
+    """Register a callback that observes every statement executed on get_db() connections."""
+    if listener not in _query_listeners:
+        _query_listeners.append(listener)
+
+def remove_query_listener(listener):
+    if listener in _query_listeners:
+        _query_listeners.remove(listener)
+
+def _notify_query(sql, parameters, seconds):
+    for listener in list(_query_listeners):
+        listener(sql, parameters, seconds)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that reports each statement and its execution time to the query listeners.
+
+    SQLite returns from execute() at the first result row and keeps scanning inside the fetch calls, so for
+    statements that return rows the time spent in fetchone/fetchmany/fetchall and iteration is added too.
+    Such a statement is reported once its rows are exhausted, or when the cursor runs another statement,
+    is closed or is garbage collected; time the caller spends between fetches is not counted.
+    """
+
+    # [sql, parameters, seconds] of the statement whose rows are still being fetched
+    _pending = None
+
+    def _report(self):
+        pending = self._pending
+        if pending is not None:
+            self._pending = None
+            _notify_query(*pending)
+
+    def _timed_execute(self, execute, sql, parameters, *args):
+        self._report()
+        if not _query_listeners:
+            return execute(*args)
+        started = time.perf_counter()
+        try:
+            result = execute(*args)
+        except BaseException:
+            _notify_query(sql, parameters, time.perf_counter() - started)
+            raise
+        elapsed = time.perf_counter() - started
+        if self.description is None:
+            _notify_query(sql, parameters, elapsed)
+        else:
+            self._pending = [sql, parameters, elapsed]
+        return result
+
+    def _timed_fetch(self, fetch, *args):
+        pending = self._pending
+        if pending is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        except BaseException:
+            # 包括迭代结束的 StopIteration
+            pending[2] += time.perf_counter() - started
+            self._report()
+            raise
+        finally:
+            if self._pending is pending:
+                pending[2] += time.perf_counter() - started
+
+    def execute(self, sql, parameters=()):
+        return self._timed_execute(super().execute, sql, parameters, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed_execute(super().executemany, sql, None, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._timed_execute(super().executescript, sql_script, None, sql_script)
+
+    def fetchone(self):
+        row = self._timed_fetch(super().fetchone)
+        if row is None:
+            self._report()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed_fetch(super().fetchmany, size)
+        if len(rows) < size:
+            self._report()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed_fetch(super().fetchall)
+        self._report()
+        return rows
+
+    def __next__(self):
+        return self._timed_fetch(super().__next__)
+
+    def close(self):
+        self._report()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._report()
+        except Exception:
+            pass
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including the conn.execute shortcuts) are InstrumentedCursor."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
 
 def get_db():
     """
@@ -60,10 +191,47 @@ def get_db():
     Returns:
         sqlite3.Connection: The configured database connection
     """
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(DB_NAME, factory=InstrumentedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
+def get_bank_version(question_bank_id):
+    """Return the bank's content version (0 until its questions are first written)."""
+    conn = get_db()
+    row = conn.execute('SELECT version FROM bank_versions WHERE question_bank_id=?', (question_bank_id,)).fetchone()
+    conn.close()
+    return row['version'] if row else 0
+
+def bump_bank_version(cursor, question_bank_id):
+    """
+    Mark a bank's questions as changed. Call it on the same connection, before the commit,
+    of every statement that inserts, updates or deletes rows in questions.
+
+    Rows written since the last bump carry version 0 (the column default for inserts, set by
+    triggers for updates and deletes); they are stamped with the new version here so that
+    clients can ask for everything changed since a version they already have.
+
+    Returns:
+        int: The bank's new version
+    """
+    cursor.execute('''
+        INSERT INTO bank_versions (question_bank_id, version) VALUES (?, 1)
+        ON CONFLICT(question_bank_id) DO UPDATE SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+    ''', (question_bank_id,))
+    cursor.execute('SELECT version FROM bank_versions WHERE question_bank_id=?', (question_bank_id,))
+    version = cursor.fetchone()[0]
+    # A question deleted earlier and inserted again is a change, not a deletion
+    cursor.execute('''
+        DELETE FROM question_tombstones
+        WHERE question_bank_id=? AND question_id IN (
+            SELECT id FROM questions WHERE question_bank_id=? AND version=0
+        )
+    ''', (question_bank_id, question_bank_id))
+    cursor.execute('UPDATE questions SET version=? WHERE question_bank_id=? AND version=0', (version, question_bank_id))
+    cursor.execute('UPDATE question_tombstones SET version=? WHERE question_bank_id=? AND version=0',
+                   (version, question_bank_id))
+    return version
+
 def load_questions_to_db(conn, question_bank_id=SYSTEM_QUESTION_BANK_ID, csv_path=None):
     """
     Load questions from a CSV file into the database.
@@ -115,19 +283,24 @@ def load_questions_to_db(conn, question_bank_id=SYSTEM_QUESTION_BANK_ID, csv_pat
                         question_bank_id,
                     ),
                 )
+            bump_bank_version(c, question_bank_id)
             conn.commit()
             print(f"Successfully loaded questions from {csv_path} into bank {question_bank_id}")
     except Exception as e:
         print(f"Error loading questions: {e}")
 
-def init_db():
-    """
-    Initialize the database by creating necessary tables if they don't exist.
-    Also loads initial question data from CSV if the questions table is empty.
-    """
-    conn = get_db()
-    c = conn.cursor()
+# Columns added to ai_providers after the table was first released
+_AI_PROVIDER_COLUMNS = (
+    ('is_valid', 'INTEGER DEFAULT 0'),
+    ('last_verified_at', 'DATETIME'),
+    ('last_error', 'TEXT'),
+    ('updated_at', 'DATETIME DEFAULT CURRENT_TIMESTAMP'),
+    ('last_latency_ms', 'INTEGER'),
+    ('check_pending', 'INTEGER DEFAULT 0'),
+)
 
+def _migration_initial_schema(c):
+    """Create the core tables and bring databases created before versioning up to the same shape."""
     # Questions table for storing question data (created first for FK references)
     c.execute('''CREATE TABLE IF NOT EXISTS questions (
         id TEXT NOT NULL,
@@ -216,67 +389,349 @@ def init_db():
         is_valid INTEGER DEFAULT 0,
         last_verified_at DATETIME,
         last_error TEXT,
+        last_latency_ms INTEGER,
+        check_pending INTEGER DEFAULT 0,
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
         updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (user_id) REFERENCES users(id)
     )''')
-    c.execute('PRAGMA table_info(ai_providers)')
-    ai_columns = [row['name'] for row in c.fetchall()]
-    if 'is_valid' not in ai_columns:
-        c.execute('ALTER TABLE ai_providers ADD COLUMN is_valid INTEGER DEFAULT 0')
-    if 'last_verified_at' not in ai_columns:
-        c.execute('ALTER TABLE ai_providers ADD COLUMN last_verified_at DATETIME')
-    if 'last_error' not in ai_columns:
-        c.execute('ALTER TABLE ai_providers ADD COLUMN last_error TEXT')
-    if 'updated_at' not in ai_columns:
-        c.execute('ALTER TABLE ai_providers ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP')
-
-    conn.commit()
 
-    # Ensure legacy databases receive new columns / schema updates
+    # Databases created before schema versioning may predate any of these columns
+    for column, definition in _AI_PROVIDER_COLUMNS:
+        if not _column_exists(c, 'ai_providers', column):
+            c.execute(f'ALTER TABLE ai_providers ADD COLUMN {column} {definition}')
     if not _column_exists(c, 'users', 'active_question_bank_id'):
         c.execute('ALTER TABLE users ADD COLUMN active_question_bank_id INTEGER DEFAULT 0')
-
     if not _column_exists(c, 'history', 'question_bank_id'):
         c.execute('ALTER TABLE history ADD COLUMN question_bank_id INTEGER DEFAULT 0')
         c.execute('UPDATE history SET question_bank_id = 0 WHERE question_bank_id IS NULL')
-
     if not _column_exists(c, 'favorites', 'question_bank_id'):
-        _rebuild_favorites_table(conn)
-
-    # 数据库迁移：为现有数据库添加 question_type 字段
-    try:
-        c.execute("SELECT question_type FROM questions LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Adding question_type column to questions table...")
+        _rebuild_favorites_table(c)
+    if not _column_exists(c, 'questions', 'question_type'):
         c.execute("ALTER TABLE questions ADD COLUMN question_type TEXT")
         c.execute("UPDATE questions SET question_type = qtype WHERE question_type IS NULL")
-        conn.commit()
-        print("Successfully added question_type column")
-
-    # 数据库迁移：为现有数据库添加 question_bank_id 字段
-    try:
-        c.execute("SELECT question_bank_id FROM questions LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Adding question_bank_id column to questions table...")
+    if not _column_exists(c, 'questions', 'question_bank_id'):
         c.execute("ALTER TABLE questions ADD COLUMN question_bank_id INTEGER DEFAULT 0")
-        conn.commit()
-        print("Successfully added question_bank_id column")
 
-    # Helpful indexes
+def _migration_indexes(c):
+    """Indexes for the per-user and per-bank lookups."""
     c.execute('CREATE INDEX IF NOT EXISTS idx_questions_bank ON questions(question_bank_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_history_user_bank ON history(user_id, question_bank_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_favorites_user_bank ON favorites(user_id, question_bank_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_ai_providers_user ON ai_providers(user_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_ai_providers_active ON ai_providers(user_id, is_active)')
-    conn.commit()
 
-    # Load questions from CSV if the table is empty
-    c.execute('SELECT COUNT(*) as cnt FROM questions')
-    if c.fetchone()['cnt'] == 0:
+def _migration_ai_pregen(c):
+    """Tables for pregenerated AI explanations/hints and the bulk generation jobs."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ai_generated (
+            question_bank_id INTEGER NOT NULL,
+            question_id TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            content TEXT NOT NULL,
+            model TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (question_bank_id, question_id, fingerprint)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ai_pregen_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            question_bank_id INTEGER NOT NULL,
+            modes TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            total INTEGER DEFAULT 0,
+            completed INTEGER DEFAULT 0,
+            generated INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ai_pregen_jobs_bank ON ai_pregen_jobs(question_bank_id, user_id)')
+
+def _migration_bank_versions(c):
+    """Per-bank content version, bumped whenever a bank's questions change (used for ETags and page caching)."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS bank_versions (
+            question_bank_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migration_api_tokens(c):
+    """Bearer tokens for the JSON API; only a SHA-256 digest of each token is stored."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token_hash TEXT NOT NULL UNIQUE,
+            name TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_used_at DATETIME,
+            expires_at DATETIME,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_api_tokens_user ON api_tokens(user_id)')
+
+def _migration_question_versions(c):
+    """
+    Per-question change tracking for delta sync: questions.version is the bank version that last
+    changed the row and question_tombstones records deletions. Pending changes carry version 0
+    until bump_bank_version stamps them.
+    """
+    if not _column_exists(c, 'questions', 'version'):
+        c.execute('ALTER TABLE questions ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS question_tombstones (
+            question_bank_id INTEGER NOT NULL,
+            question_id TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            deleted_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (question_bank_id, question_id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_questions_bank_version ON questions(question_bank_id, version)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_question_tombstones_version ON question_tombstones(question_bank_id, version)')
+    # Only content columns: the version stamp itself must not mark the row as pending again
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS questions_track_update
+        AFTER UPDATE OF id, stem, answer, difficulty, qtype, category, options, question_type, question_bank_id ON questions
+        BEGIN
+            UPDATE questions SET version = 0 WHERE id = NEW.id AND question_bank_id = NEW.question_bank_id;
+            INSERT OR REPLACE INTO question_tombstones (question_bank_id, question_id, version)
+            SELECT OLD.question_bank_id, OLD.id, 0
+            WHERE OLD.id != NEW.id OR OLD.question_bank_id != NEW.question_bank_id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS questions_track_delete
+        AFTER DELETE ON questions
+        BEGIN
+            INSERT OR REPLACE INTO question_tombstones (question_bank_id, question_id, version)
+            VALUES (OLD.question_bank_id, OLD.id, 0);
+        END
+    ''')
+    # Existing questions belong to their bank's current version
+    c.execute('''
+        INSERT OR IGNORE INTO bank_versions (question_bank_id, version)
+        SELECT DISTINCT question_bank_id, 1 FROM questions
+    ''')
+    c.execute('''
+        UPDATE questions SET version = (
+            SELECT version FROM bank_versions b WHERE b.question_bank_id = questions.question_bank_id
+        )
+    ''')
+
+def _migration_history_client_keys(c):
+    """Client-supplied idempotency keys on history, so retried API submissions are recorded once."""
+    if not _column_exists(c, 'history', 'client_key'):
+        c.execute('ALTER TABLE history ADD COLUMN client_key TEXT')
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_history_client_key
+        ON history(user_id, client_key) WHERE client_key IS NOT NULL
+    ''')
+
+def _migration_history_daily(c):
+    """
+    Daily per-question aggregates of history rows moved to the archive database (see archive.py),
+    and the answer_log view that statistics read so archived answers still count.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS history_daily (
+            user_id INTEGER NOT NULL,
+            question_bank_id INTEGER NOT NULL,
+            question_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            correct_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, question_bank_id, question_id, day)
+        )
+    ''')
+    # One row per answer from history, one row per (question, day) from the aggregates
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS answer_log AS
+        SELECT user_id, question_bank_id, question_id, 1 AS attempts, correct AS correct_count
+        FROM history
+        UNION ALL
+        SELECT user_id, question_bank_id, question_id, attempts, correct_count
+        FROM history_daily
+    ''')
+
+def _migration_exam_questions(c):
+    """
+    One row per question of an exam paper, with the submitted answer, replacing the JSON array in
+    exam_sessions.question_ids (kept only because SQLite < 3.35 cannot drop columns; no longer read).
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS exam_questions (
+            exam_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            question_id TEXT NOT NULL,
+            user_answer TEXT,
+            correct INTEGER,
+            answered_at DATETIME,
+            PRIMARY KEY (exam_id, position),
+            FOREIGN KEY (exam_id) REFERENCES exam_sessions(id)
+        )
+    ''')
+    c.execute('''
+        INSERT OR IGNORE INTO exam_questions (exam_id, position, question_id)
+        SELECT e.id, j.key, j.value FROM exam_sessions e, json_each(e.question_ids) j
+        WHERE json_valid(e.question_ids)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_exam_sessions_user_bank
+        ON exam_sessions(user_id, question_bank_id, completed, start_time)
+    ''')
+
+def _migration_exam_autosave(c):
+    """Answers autosaved while an exam is in progress (JSON list of the submitted form values), see autosave.py."""
+    if not _column_exists(c, 'exam_questions', 'saved_answer'):
+        c.execute('ALTER TABLE exam_questions ADD COLUMN saved_answer TEXT')
+
+def _migration_ai_health_claims(c):
+    """Claim marker so that only one worker process probes a provider at a time (see ai_healthcheck.py)."""
+    if not _column_exists(c, 'ai_providers', 'check_started_at'):
+        c.execute('ALTER TABLE ai_providers ADD COLUMN check_started_at DATETIME')
+
+# Numbered schema migrations; the database's PRAGMA user_version records how many have been applied.
+# Append new migrations to the end and never edit or reorder released ones.
+MIGRATIONS = (
+    (1, 'initial schema', _migration_initial_schema),
+    (2, 'lookup indexes', _migration_indexes),
+    (3, 'ai pregeneration tables', _migration_ai_pregen),
+    (4, 'bank content versions', _migration_bank_versions),
+    (5, 'api tokens', _migration_api_tokens),
+    (6, 'question versions and tombstones', _migration_question_versions),
+    (7, 'history idempotency keys', _migration_history_client_keys),
+    (8, 'archived history aggregates', _migration_history_daily),
+    (9, 'normalized exam questions', _migration_exam_questions),
+    (10, 'exam answer autosave', _migration_exam_autosave),
+    (11, 'ai health check claims', _migration_ai_health_claims),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn=None):
+    """Return the database's PRAGMA user_version (0 for a new or pre-versioning database)."""
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(DB_NAME)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        if own_conn:
+            conn.close()
+
+@contextmanager
+def _migration_lock():
+    """
+    Hold an exclusive lock on <DB_NAME>.migrate.lock so that only one process
+    (e.g. one of several gunicorn workers booting together) migrates and seeds.
+    """
+    with open(f'{DB_NAME}.migrate.lock', 'a+b') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10 seconds; keep waiting for the migrating process
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def migrate_db(target=SCHEMA_VERSION, seed=True):
+    """
+    Apply pending migrations up to target, each in its own transaction together with
+    the user_version bump, then load the default CSV if the questions table is empty.
+
+    Returns:
+        list: (version, description) of the migrations that were applied
+    """
+    applied = []
+    with _migration_lock():
+        conn = get_db()
+        conn.isolation_level = None
+        try:
+            # Another process may have finished migrating while we waited for the lock
+            current = schema_version(conn)
+            if current > SCHEMA_VERSION:
+                raise RuntimeError(
+                    f"Database schema version {current} is newer than this code ({SCHEMA_VERSION})."
+                )
+            for version, description, migration in MIGRATIONS:
+                if version <= current or version > target:
+                    continue
+                print(f"Applying database migration {version}: {description}")
+                c = conn.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    migration(c)
+                    c.execute(f'PRAGMA user_version = {version}')
+                    c.execute('COMMIT')
+                except Exception:
+                    c.execute('ROLLBACK')
+                    raise
+                applied.append((version, description))
+        finally:
+            conn.close()
+
+        if seed:
+            _seed_if_empty()
+    return applied
+
+def _questions_empty():
+    conn = get_db()
+    try:
+        return conn.execute('SELECT 1 FROM questions LIMIT 1').fetchone() is None
+    finally:
+        conn.close()
+
+def _seed_if_empty():
+    # Caller holds the migration lock, so only one process loads the CSV
+    if _questions_empty():
+        conn = get_db()
         load_questions_to_db(conn)
+        conn.close()
 
-    conn.close()
+def init_db(migrate=True):
+    """
+    Make sure the database schema is current. When it already is, this costs a PRAGMA
+    read and a one-row probe of questions, so every worker can call it at startup
+    regardless of database size.
+
+    Args:
+        migrate (bool): Apply pending migrations and seed the default CSV whenever the
+            questions table is empty. When False, an outdated schema raises RuntimeError
+            instead, for deployments that run `python migrate.py` before starting workers.
+    """
+    current = schema_version()
+    if current == SCHEMA_VERSION:
+        # Schema is current: only take the migration lock if there is seeding to do
+        if migrate and _questions_empty():
+            with _migration_lock():
+                _seed_if_empty()
+        return
+    if not migrate:
+        raise RuntimeError(
+            f"Database schema is at version {current}, expected {SCHEMA_VERSION}; run `python migrate.py` first."
+        )
+    migrate_db()
 
 def fetch_question(qid, question_bank_id=SYSTEM_QUESTION_BANK_ID):
     """
@@ -296,25 +751,53 @@ def fetch_question(qid, question_bank_id=SYSTEM_QUESTION_BANK_ID):
     conn.close()
 
     if row:
-        question_data = {
-            'id': row['id'],
-            'stem': row['stem'],
-            'answer': row['answer'],
-            'difficulty': row['difficulty'],
-            'type': row['qtype'],
-            'category': row['category'],
-            'options': json.loads(row['options']) if row['options'] else {},
-            'question_type': row['question_type'] if row['question_type'] else row['qtype'],  # 兼容旧数据
-            'question_bank_id': row['question_bank_id']
-        }
-        if question_data['question_type'] == '填空题':
-            blanks = parse_fill_answers(row['answer'])
-            question_data['fill_blank_count'] = len(blanks) if blanks else 1
-        else:
-            question_data['fill_blank_count'] = 0
-        return question_data
+        return question_from_row(row)
     return None
 
+def question_from_row(row):
+    """Convert a questions row into the dict returned by fetch_question."""
+    question_data = {
+        'id': row['id'],
+        'stem': row['stem'],
+        'answer': row['answer'],
+        'difficulty': row['difficulty'],
+        'type': row['qtype'],
+        'category': row['category'],
+        'options': json.loads(row['options']) if row['options'] else {},
+        'question_type': row['question_type'] if row['question_type'] else row['qtype'],  # 兼容旧数据
+        'question_bank_id': row['question_bank_id']
+    }
+    if question_data['question_type'] == '填空题':
+        blanks = parse_fill_answers(row['answer'])
+        question_data['fill_blank_count'] = len(blanks) if blanks else 1
+    else:
+        question_data['fill_blank_count'] = 0
+    return question_data
+
+def fetch_questions(qids, question_bank_id=SYSTEM_QUESTION_BANK_ID):
+    """
+    Fetch several questions with one query per 500 IDs.
+
+    Returns:
+        dict: question ID -> question data (same shape as fetch_question); missing IDs are absent
+    """
+    qids = [str(qid) for qid in qids]
+    questions = {}
+    if not qids:
+        return questions
+    conn = get_db()
+    c = conn.cursor()
+    # 低于 SQLite 默认的绑定参数上限
+    for start in range(0, len(qids), 500):
+        chunk = qids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f'SELECT * FROM questions WHERE question_bank_id=? AND id IN ({placeholders})',
+                  (question_bank_id, *chunk))
+        for row in c.fetchall():
+            questions[row['id']] = question_from_row(row)
+    conn.close()
+    return questions
+
 def random_question_id(user_id, question_bank_id=SYSTEM_QUESTION_BANK_ID):
     """
     Get a random question ID for a user, excluding questions they've already answered.
@@ -331,7 +814,7 @@ def random_question_id(user_id, question_bank_id=SYSTEM_QUESTION_BANK_ID):
     c.execute('''
         SELECT id FROM questions
         WHERE id NOT IN (
-            SELECT question_id FROM history WHERE user_id=? AND question_bank_id=?
+            SELECT question_id FROM answer_log WHERE user_id=? AND question_bank_id=?
         )
         AND question_bank_id=?
         ORDER BY RANDOM()
@@ -363,6 +846,37 @@ def fetch_random_question_ids(num, question_bank_id=SYSTEM_QUESTION_BANK_ID):
     conn.close()
     return [r['id'] for r in rows]
 
+def create_exam_session(cursor, user_id, question_bank_id, mode, question_ids, start_time, duration=0):
+    """
+    Insert an exam session and its paper (one exam_questions row per question); the caller commits.
+
+    Args:
+        cursor: Database cursor
+        user_id (int): The user ID
+        question_bank_id (int): The question bank ID
+        mode (str): 'exam' or 'timed'
+        question_ids (list): Question IDs in paper order
+        start_time (datetime): Start time
+        duration (int): Time limit in seconds, 0 for none
+
+    Returns:
+        int: The new exam session ID
+    """
+    # question_ids 列已不再读取，只为满足旧表的 NOT NULL 约束
+    cursor.execute('''
+        INSERT INTO exam_sessions (user_id, mode, question_ids, start_time, duration, question_bank_id)
+        VALUES (?,?,?,?,?,?)
+    ''', (user_id, mode, '[]', start_time, duration, question_bank_id))
+    exam_id = cursor.lastrowid
+    cursor.executemany('INSERT INTO exam_questions (exam_id, position, question_id) VALUES (?,?,?)',
+                       [(exam_id, position, qid) for position, qid in enumerate(question_ids)])
+    return exam_id
+
+def exam_question_ids(cursor, exam_id):
+    """Return the question IDs of an exam paper in order."""
+    cursor.execute('SELECT question_id FROM exam_questions WHERE exam_id=? ORDER BY position', (exam_id,))
+    return [row['question_id'] for row in cursor.fetchall()]
+
 def is_favorite(user_id, question_id, question_bank_id=SYSTEM_QUESTION_BANK_ID):
     """
     Check if a question is favorited by a user.
@@ -382,6 +896,17 @@ def is_favorite(user_id, question_id, question_bank_id=SYSTEM_QUESTION_BANK_ID):
     conn.close()
     return is_fav
 
+def get_favorites_state(user_id, question_bank_id=SYSTEM_QUESTION_BANK_ID):
+    """
+    Return (count, max id) of the user's favorites in a bank. Favorites are only inserted
+    (with a new id) or deleted, so any change to the set changes this pair.
+    """
+    conn = get_db()
+    row = conn.execute('SELECT COUNT(*) AS total, MAX(id) AS last_id FROM favorites WHERE user_id=? AND question_bank_id=?',
+                       (user_id, question_bank_id)).fetchone()
+    conn.close()
+    return row['total'], row['last_id']
+
 def create_question_bank(user_id, name, description=""):
     """
     Create a new question bank for a user.
@@ -563,9 +1088,17 @@ def delete_question_bank(user_id, bank_id):
         return False
 
     c.execute('DELETE FROM history WHERE question_bank_id=?', (bank_id,))
+    c.execute('DELETE FROM history_daily WHERE question_bank_id=?', (bank_id,))
     c.execute('DELETE FROM favorites WHERE question_bank_id=?', (bank_id,))
+    c.execute('DELETE FROM exam_questions WHERE exam_id IN (SELECT id FROM exam_sessions WHERE question_bank_id=?)',
+              (bank_id,))
     c.execute('DELETE FROM exam_sessions WHERE question_bank_id=?', (bank_id,))
     c.execute('DELETE FROM questions WHERE question_bank_id=?', (bank_id,))
+    bump_bank_version(c, bank_id)
+    # 题库本身已不存在，无需保留逐题删除记录
+    c.execute('DELETE FROM question_tombstones WHERE question_bank_id=?', (bank_id,))
+    c.execute('DELETE FROM ai_generated WHERE question_bank_id=?', (bank_id,))
+    c.execute('DELETE FROM ai_pregen_jobs WHERE question_bank_id=?', (bank_id,))
     c.execute('DELETE FROM question_banks WHERE id=?', (bank_id,))
     c.execute('UPDATE users SET active_question_bank_id=?, current_seq_qid=NULL WHERE id=? AND active_question_bank_id=?',
               (SYSTEM_QUESTION_BANK_ID, user_id, bank_id))
@@ -580,7 +1113,7 @@ def get_ai_providers(user_id):
     c = conn.cursor()
     c.execute('''
         SELECT id, provider_name, base_url, model, is_active, is_valid,
-               last_verified_at, last_error, created_at, updated_at
+               last_verified_at, last_error, last_latency_ms, check_pending, created_at, updated_at
         FROM ai_providers
         WHERE user_id=?
         ORDER BY created_at DESC
@@ -598,6 +1131,8 @@ def get_ai_providers(user_id):
             'is_valid': bool(row['is_valid']),
             'last_verified_at': row['last_verified_at'],
             'last_error': row['last_error'],
+            'last_latency_ms': row['last_latency_ms'],
+            'check_pending': bool(row['check_pending']),
             'created_at': row['created_at'],
             'updated_at': row['updated_at']
         })
@@ -614,6 +1149,25 @@ def get_active_ai_provider(user_id):
     return dict(row) if row else None
 
 
+def has_available_ai_provider(user_id):
+    """
+    Return True when the user has an active provider and at least one provider that
+    passed (or is still awaiting) the background health check.
+    """
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT 1 FROM ai_providers
+        WHERE user_id=?
+          AND (is_valid=1 OR check_pending=1)
+          AND EXISTS (SELECT 1 FROM ai_providers WHERE user_id=? AND is_active=1)
+        LIMIT 1
+    ''', (user_id, user_id))
+    available = c.fetchone() is not None
+    conn.close()
+    return available
+
+
 def get_ai_provider(provider_id, user_id):
     """Return a specific AI provider if it belongs to the user."""
     conn = get_db()
@@ -622,3 +1176,146 @@ def get_ai_provider(provider_id, user_id):
     row = c.fetchone()
     conn.close()
     return dict(row) if row else None
+
+
+def get_failover_ai_providers(user_id, exclude_id=None):
+    """Return the user's verified AI providers (is_valid=1) usable as failover targets, in creation order."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT * FROM ai_providers
+        WHERE user_id=? AND is_valid=1 AND id != ?
+        ORDER BY id ASC
+    ''', (user_id, exclude_id if exclude_id is not None else -1))
+    rows = c.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def get_ai_generated(question_bank_id, question_id, fingerprint):
+    """Return pre-generated AI content for a question and prompt fingerprint, or None."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT content FROM ai_generated
+        WHERE question_bank_id=? AND question_id=? AND fingerprint=?
+    ''', (question_bank_id, str(question_id), fingerprint))
+    row = c.fetchone()
+    conn.close()
+    return row['content'] if row else None
+
+
+def get_ai_generated_fingerprints(question_bank_id, question_id):
+    """Return the set of prompt fingerprints already generated for a question."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT fingerprint FROM ai_generated WHERE question_bank_id=? AND question_id=?',
+              (question_bank_id, str(question_id)))
+    rows = c.fetchall()
+    conn.close()
+    return {row['fingerprint'] for row in rows}
+
+
+def save_ai_generated(question_bank_id, question_id, fingerprint, mode, content, model=None):
+    """Store (or replace) pre-generated AI content."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        INSERT OR REPLACE INTO ai_generated (question_bank_id, question_id, fingerprint, mode, content, model)
+        VALUES (?,?,?,?,?,?)
+    ''', (question_bank_id, str(question_id), fingerprint, mode, content, model))
+    conn.commit()
+    conn.close()
+
+
+def get_ai_pregen_job(job_id, user_id=None):
+    """Return a pre-generation job, optionally restricted to its owner."""
+    conn = get_db()
+    c = conn.cursor()
+    if user_id is None:
+        c.execute('SELECT * FROM ai_pregen_jobs WHERE id=?', (job_id,))
+    else:
+        c.execute('SELECT * FROM ai_pregen_jobs WHERE id=? AND user_id=?', (job_id, user_id))
+    row = c.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def get_latest_ai_pregen_job(user_id, question_bank_id):
+    """Return the user's most recent pre-generation job for a bank."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT * FROM ai_pregen_jobs
+        WHERE user_id=? AND question_bank_id=?
+        ORDER BY id DESC LIMIT 1
+    ''', (user_id, question_bank_id))
+    row = c.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def _hash_api_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def create_api_token(user_id, name=None, ttl_days=0):
+    """
+    Issue a new API token for a user.
+
+    Args:
+        user_id (int): The user ID
+        name (str): Optional label (e.g. the device name)
+        ttl_days (int): Lifetime in days; 0 means the token never expires
+
+    Returns:
+        str: The plaintext token; it is not stored and cannot be recovered later
+    """
+    token = secrets.token_urlsafe(32)
+    lifetime = f'+{int(ttl_days)} days' if ttl_days and ttl_days > 0 else None
+    conn = get_db()
+    # lifetime 为 NULL 时 datetime() 返回 NULL，即永不过期
+    conn.execute('''
+        INSERT INTO api_tokens (user_id, token_hash, name, expires_at)
+        VALUES (?, ?, ?, datetime('now', 'localtime', ?))
+    ''', (user_id, _hash_api_token(token), name, lifetime))
+    conn.commit()
+    conn.close()
+    return token
+
+
+def get_api_token_user(token):
+    """Return the user ID owning an unexpired API token, or None."""
+    if not token:
+        return None
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT t.id, t.user_id, t.last_used_at FROM api_tokens t
+        JOIN users u ON u.id = t.user_id
+        WHERE t.token_hash=? AND (t.expires_at IS NULL OR t.expires_at > datetime('now', 'localtime'))
+    ''', (_hash_api_token(token),))
+    row = c.fetchone()
+    if row is None:
+        conn.close()
+        return None
+    # 最近使用时间只精确到分钟，避免每个请求都写一次库
+    c.execute('''
+        UPDATE api_tokens SET last_used_at=datetime('now', 'localtime')
+        WHERE id=? AND (last_used_at IS NULL OR last_used_at < datetime('now', 'localtime', '-1 minute'))
+    ''', (row['id'],))
+    if c.rowcount:
+        conn.commit()
+    conn.close()
+    return row['user_id']
+
+
+def revoke_api_token(token):
+    """Delete an API token. Returns True if it existed."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('DELETE FROM api_tokens WHERE token_hash=?', (_hash_api_token(token),))
+    deleted = c.rowcount > 0
+    conn.commit()
+    conn.close()
+    return deleted
@@ -0,0 +1,240 @@
+"""
+应用运行指标与 Prometheus 文本格式导出。
+
+init_metrics(app) 注册请求钩子：按端点（Flask endpoint + 方法）统计耗时直方图、状态码计数，以及每个请求执行的
+SQL 条数与数据库耗时（通过 database.add_query_listener 观察 get_db() 连接上的每条语句，耗时含取结果行的时间）；流式响应在响应体
+发送完毕时才计入耗时。另有在途请求数与各进程内缓存的命中计数（record_cache）。AI 上游调用的首包/总耗时与
+取消原因直接取自 ai_metrics 与 ai_budget。
+
+GET /metrics 以 Prometheus 文本格式输出以上指标：请求头带 Authorization: Bearer <METRICS_TOKEN> 即可抓取，
+未配置令牌时仅管理员可见。指标只保存在本进程内，多 worker 部署时需逐个抓取。
+"""
+import hmac
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from flask import Response, abort, current_app, g, has_request_context, request
+
+from ai_metrics import Histogram, provider_exports
+from blueprints.auth import is_admin
+from database import add_query_listener
+
+REQUEST_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS_SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# 未匹配任何路由的请求（404 等）统一归到该端点，避免按 URL 产生无限多的标签
+UNMATCHED_ENDPOINT = '<unmatched>'
+
+
+class EndpointStats:
+    """单个端点（endpoint, method）的累计指标，由 _lock 保护。"""
+
+    def __init__(self):
+        self.latency = Histogram(REQUEST_BUCKETS_SECONDS)
+        self.db_queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.db_seconds = Histogram(DB_BUCKETS_SECONDS)
+        self.statuses: Dict[int, int] = {}
+
+
+_lock = threading.Lock()
+_endpoints: Dict[Tuple[str, str], EndpointStats] = {}
+_in_flight = 0
+_db_totals = {'queries': 0, 'seconds': 0.0}
+_caches: Dict[str, List[int]] = {}
+
+
+def record_cache(name: str, hit: bool) -> None:
+    """记录一次进程内缓存访问（hit=False 表示未命中）。"""
+    with _lock:
+        counts = _caches.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+def _on_query(sql, parameters, seconds) -> None:
+    with _lock:
+        _db_totals['queries'] += 1
+        _db_totals['seconds'] += seconds
+    if has_request_context():
+        counters = g.get('_metrics_db')
+        if counters is not None:
+            counters[0] += 1
+            counters[1] += seconds
+
+
+def _start_request() -> None:
+    global _in_flight
+    g._metrics_started = time.perf_counter()
+    g._metrics_db = [0, 0.0]
+    g._metrics_done = False
+    with _lock:
+        _in_flight += 1
+
+
+def _finish(endpoint: str, method: str, status: int, started: float, db_counters: List) -> None:
+    global _in_flight
+    elapsed = time.perf_counter() - started
+    with _lock:
+        _in_flight -= 1
+        stats = _endpoints.get((endpoint, method))
+        if stats is None:
+            stats = EndpointStats()
+            _endpoints[(endpoint, method)] = stats
+        stats.latency.observe(elapsed)
+        stats.db_queries.observe(db_counters[0])
+        stats.db_seconds.observe(db_counters[1])
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+
+def _after_request(response):
+    started = g.get('_metrics_started')
+    if started is None or g.get('_metrics_done'):
+        return response
+    g._metrics_done = True
+    endpoint = request.endpoint or UNMATCHED_ENDPOINT
+    method = request.method
+    status = response.status_code
+    db_counters = g._metrics_db
+    if response.is_streamed:
+        # 流式响应（如 /ai/run）在 WSGI 服务器关闭响应迭代器时才算结束
+        response.call_on_close(lambda: _finish(endpoint, method, status, started, db_counters))
+    else:
+        _finish(endpoint, method, status, started, db_counters)
+    return response
+
+
+def _teardown_request(exc) -> None:
+    # 未经 after_request 的请求（PROPAGATE_EXCEPTIONS 下的未处理异常）按 500 计入，保证在途数归零
+    started = g.get('_metrics_started')
+    if started is None or g.get('_metrics_done'):
+        return
+    g._metrics_done = True
+    _finish(request.endpoint or UNMATCHED_ENDPOINT, request.method, 500, started, g._metrics_db)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _format_number(value: float) -> str:
+    return f'{value:g}' if isinstance(value, float) else str(value)
+
+
+def _histogram_lines(name: str, histogram: Histogram, scale: float = 1.0, **labels) -> List[str]:
+    """按 Prometheus 约定输出累计桶、_sum 与 _count；scale 用于把毫秒直方图换算为秒。"""
+    base = _labels(**labels)
+    prefix = base + ',' if base else ''
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{_format_number(bound * scale)}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{base}}} {_format_number(histogram.sum * scale)}')
+    lines.append(f'{name}_count{{{base}}} {histogram.count}')
+    return lines
+
+
+def _header(lines: List[str], name: str, kind: str, help_text: str) -> None:
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def render_prometheus() -> str:
+    """以 Prometheus 文本格式（0.0.4）输出本进程的全部指标。"""
+    # ai_budget 依赖 ai_service，延迟导入以免 ai_service -> metrics 的导入形成循环
+    from ai_budget import cancellation_counts
+
+    with _lock:
+        endpoints = [(key, stats.latency.copy(), stats.db_queries.copy(), stats.db_seconds.copy(),
+                      dict(stats.statuses)) for key, stats in sorted(_endpoints.items())]
+        in_flight = _in_flight
+        db_totals = dict(_db_totals)
+        caches = {name: tuple(counts) for name, counts in sorted(_caches.items())}
+
+    lines: List[str] = []
+    _header(lines, 'exam_http_requests_total', 'counter', '按端点、方法与状态码统计的请求数')
+    for (endpoint, method), _, _, _, statuses in endpoints:
+        for status, count in sorted(statuses.items()):
+            lines.append(f'exam_http_requests_total{{{_labels(endpoint=endpoint, method=method, status=status)}}} {count}')
+
+    _header(lines, 'exam_http_request_duration_seconds', 'histogram', '请求耗时（流式响应计到响应体发送完毕）')
+    for (endpoint, method), latency, _, _, _ in endpoints:
+        lines.extend(_histogram_lines('exam_http_request_duration_seconds', latency, endpoint=endpoint, method=method))
+
+    _header(lines, 'exam_http_requests_in_flight', 'gauge', '正在处理的请求数')
+    lines.append(f'exam_http_requests_in_flight {in_flight}')
+
+    _header(lines, 'exam_db_queries_per_request', 'histogram', '单个请求执行的 SQL 语句数')
+    for (endpoint, method), _, db_queries, _, _ in endpoints:
+        lines.extend(_histogram_lines('exam_db_queries_per_request', db_queries, endpoint=endpoint, method=method))
+
+    _header(lines, 'exam_db_seconds_per_request', 'histogram', '单个请求的数据库耗时（含取结果行）')
+    for (endpoint, method), _, _, db_seconds, _ in endpoints:
+        lines.extend(_histogram_lines('exam_db_seconds_per_request', db_seconds, endpoint=endpoint, method=method))
+
+    _header(lines, 'exam_db_queries_total', 'counter', '全部 SQL 语句数（含后台线程）')
+    lines.append(f'exam_db_queries_total {db_totals["queries"]}')
+    _header(lines, 'exam_db_query_seconds_total', 'counter', '全部 SQL 语句的累计耗时（含取结果行）')
+    lines.append(f'exam_db_query_seconds_total {_format_number(db_totals["seconds"])}')
+
+    _header(lines, 'exam_cache_requests_total', 'counter', '进程内缓存访问次数')
+    for name, (hits, misses) in caches.items():
+        lines.append(f'exam_cache_requests_total{{{_labels(cache=name, result="hit")}}} {hits}')
+        lines.append(f'exam_cache_requests_total{{{_labels(cache=name, result="miss")}}} {misses}')
+    _header(lines, 'exam_cache_hit_ratio', 'gauge', '进程内缓存命中率')
+    for name, (hits, misses) in caches.items():
+        if hits + misses:
+            lines.append(f'exam_cache_hit_ratio{{{_labels(cache=name)}}} {_format_number(hits / (hits + misses))}')
+
+    providers = sorted(provider_exports().items())
+    _header(lines, 'exam_ai_upstream_requests_total', 'counter', 'AI 上游调用次数（按结果）')
+    for (base_url, model), export in providers:
+        for outcome, count in sorted(export['outcomes'].items()):
+            lines.append(f'exam_ai_upstream_requests_total{{{_labels(base_url=base_url, model=model, outcome=outcome)}}} {count}')
+    _header(lines, 'exam_ai_ttft_seconds', 'histogram', 'AI 上游首个分片耗时')
+    for (base_url, model), export in providers:
+        lines.extend(_histogram_lines('exam_ai_ttft_seconds', export['ttft_ms'], 0.001, base_url=base_url, model=model))
+    _header(lines, 'exam_ai_stream_seconds', 'histogram', 'AI 上游成功调用的总耗时')
+    for (base_url, model), export in providers:
+        lines.extend(_histogram_lines('exam_ai_stream_seconds', export['total_ms'], 0.001, base_url=base_url, model=model))
+
+    _header(lines, 'exam_ai_cancellations_total', 'counter', 'AI 生成提前结束次数（按原因）')
+    for reason, count in sorted(cancellation_counts().items()):
+        lines.append(f'exam_ai_cancellations_total{{{_labels(reason=reason)}}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def _authorized() -> bool:
+    token = current_app.config.get('METRICS_TOKEN') or ''
+    header = request.headers.get('Authorization', '')
+    if token and header.startswith('Bearer '):
+        return hmac.compare_digest(header[len('Bearer '):].strip(), token)
+    return is_admin()
+
+
+def metrics_view():
+    if not _authorized():
+        abort(403)
+    return Response(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def reset_request_metrics() -> None:
+    with _lock:
+        _endpoints.clear()
+        _caches.clear()
+        _db_totals.update(queries=0, seconds=0.0)
+
+
+def init_metrics(app) -> None:
+    """注册请求计时钩子、SQL 观察者与 GET /metrics（在 app.py 中调用一次）。"""
+    add_query_listener(_on_query)
+    app.before_request(_start_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+数据库结构迁移命令。
+
+在部署时先于应用进程运行，把数据库升级到当前代码的结构版本（PRAGMA user_version），
+之后各 worker 启动时的 init_db() 只需读取一次版本号。
+
+    python migrate.py                  # 执行全部待执行的迁移（新库会同时导入默认 CSV）
+    python migrate.py --status         # 只查看当前版本与待执行的迁移
+    python migrate.py --db other.db    # 指定数据库文件
+"""
+import argparse
+import sys
+
+import database
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='执行数据库结构迁移')
+    parser.add_argument('--db', default=database.DB_NAME, help='数据库文件')
+    parser.add_argument('--status', action='store_true', help='只显示当前版本与待执行的迁移')
+    parser.add_argument('--target', type=int, default=database.SCHEMA_VERSION, help='迁移到的版本（默认最新）')
+    parser.add_argument('--no-seed', action='store_true', help='新库不导入默认 CSV 题库')
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    database.DB_NAME = args.db
+    current = database.schema_version()
+    pending = [(version, description) for version, description, _ in database.MIGRATIONS
+               if current < version <= args.target]
+    print(f'{args.db}: 结构版本 {current}，代码版本 {database.SCHEMA_VERSION}')
+    if current > database.SCHEMA_VERSION:
+        print('数据库版本比代码新，请先部署新代码。')
+        return 1
+    if args.status:
+        for version, description in pending:
+            print(f'  待执行 {version}: {description}')
+        return 0
+    if not pending:
+        print('已是最新，无需迁移。')
+        return 0
+    applied = database.migrate_db(target=args.target, seed=not args.no_seed)
+    print(f'完成，执行了 {len(applied)} 个迁移，当前版本 {database.schema_version()}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
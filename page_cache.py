@@ -0,0 +1,114 @@
+"""
+页面条件请求（ETag / 304）与渲染片段缓存。
+
+题库浏览、背题、题库预览与考试试卷等页面在（题库内容版本、用户状态、查询参数）相同时输出完全相同的 HTML。
+视图先用 make_etag() 把这些输入算成 ETag，not_modified() 在浏览器携带的 If-None-Match 命中时直接返回 304，
+跳过查询与渲染；未命中时渲染并用 with_etag() 附上 ETag。题库内容版本来自 bank_versions 表
+（database.bump_bank_version 在题目写入时递增），模板与蓝图文件的修改时间也参与计算，部署新代码后旧 ETag 自然失效。
+
+与用户无关的部分（背题模式的题目卡片等）以 cached_fragment() 保存在有界 LRU 中，键里带上题库版本，
+题目变化后旧条目不再命中并随 LRU 淘汰。缓存只在本进程内，多 worker 各自预热。
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Hashable, Optional
+
+from flask import Response, make_response, request, session
+
+from metrics import record_cache
+
+_BASE_DIR = Path(__file__).resolve().parent
+# 影响页面输出的源文件：任一文件改动都会让已发出的 ETag 失效
+_FINGERPRINT_GLOBS = ('templates/*.html', 'blueprints/*.py')
+
+_settings = {
+    'enabled': True,
+    'size': 512,
+}
+_lock = threading.Lock()
+_fragments: "OrderedDict[Hashable, object]" = OrderedDict()
+_source_fingerprint: Optional[str] = None
+
+
+def _fingerprint() -> str:
+    global _source_fingerprint
+    if _source_fingerprint is None:
+        digest = hashlib.sha1()
+        for pattern in _FINGERPRINT_GLOBS:
+            for path in sorted(_BASE_DIR.glob(pattern)):
+                stat = path.stat()
+                digest.update(f'{path.name}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+        _source_fingerprint = digest.hexdigest()
+    return _source_fingerprint
+
+
+def make_etag(*parts) -> str:
+    """由页面名与全部影响输出的输入（题库版本、用户 id、查询参数等）算出 ETag。"""
+    payload = json.dumps(parts, ensure_ascii=False, default=str, separators=(',', ':'))
+    return hashlib.sha1(f'{_fingerprint()}|{payload}'.encode('utf-8')).hexdigest()[:32]
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    """If-None-Match 命中时返回 304 响应，否则返回 None（调用方继续渲染）。"""
+    if not _settings['enabled']:
+        return None
+    # 有待显示的 flash 消息时必须重新渲染，否则消息会一直留在 session 里
+    if session.get('_flashes'):
+        return None
+    hit = request.if_none_match.contains_weak(etag)
+    record_cache('page_etag', hit)
+    if not hit:
+        return None
+    response = Response(status=304)
+    return _mark(response, etag)
+
+
+def _mark(response: Response, etag: str) -> Response:
+    response.set_etag(etag, weak=True)
+    # 页面含用户数据：只允许浏览器缓存，每次使用前都要带 If-None-Match 回源验证
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def with_etag(rendered, etag: str) -> Response:
+    """给渲染结果（字符串或响应）附上 ETag 与 Cache-Control。"""
+    response = make_response(rendered)
+    if not _settings['enabled'] or response.status_code != 200:
+        return response
+    return _mark(response, etag)
+
+
+def cached_fragment(key: Hashable, render: Callable[[], object]):
+    """取与用户无关的渲染片段（或查询结果）；未命中时调用 render() 并放入 LRU。键需包含题库版本。"""
+    if not _settings['enabled'] or _settings['size'] <= 0:
+        return render()
+    with _lock:
+        if key in _fragments:
+            _fragments.move_to_end(key)
+            value = _fragments[key]
+            record_cache('page_fragment', True)
+            return value
+    record_cache('page_fragment', False)
+    value = render()
+    with _lock:
+        _fragments[key] = value
+        _fragments.move_to_end(key)
+        while len(_fragments) > _settings['size']:
+            _fragments.popitem(last=False)
+    return value
+
+
+def reset_page_cache() -> None:
+    global _source_fingerprint
+    with _lock:
+        _fragments.clear()
+    _source_fingerprint = None
+
+
+def configure_page_cache(config) -> None:
+    """从应用配置读取开关与片段缓存容量（在 app.py 中调用一次）。"""
+    _settings['enabled'] = bool(config.get('PAGE_CACHE_ENABLED', _settings['enabled']))
+    _settings['size'] = int(config.get('PAGE_CACHE_SIZE', _settings['size']))
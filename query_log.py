@@ -0,0 +1,191 @@
+"""
+SQL 语句画像与慢查询日志。
+
+通过 database.add_query_listener 观察 get_db() 连接上执行的每条语句：按“语句形状”（字面量替换为 ?、
+IN (?, ?, ...) 折叠、空白归一）累计执行次数、总耗时与最大耗时。耗时包含取结果行（fetch/迭代）的时间：
+SQLite 在第一行就从 execute() 返回，大范围扫描与排序多半发生在取行过程中。单条耗时超过 SLOW_QUERY_MS 的语句连同
+绑定参数的类型形状与 EXPLAIN QUERY PLAN 一起写入 debug/slow_query.log（每个形状只解释一次）。
+
+执行计划中出现 SCAN <表>（未走索引的全表扫描）或 USE TEMP B-TREE（ORDER BY RANDOM() 等无法用索引排序）的
+形状会被标记；QUERY_EXPLAIN_ALL 开启时对每个新形状都做一次解释，便于在一次压测/回归后得到完整的全表扫描报告。
+报告可通过管理员接口 GET /metrics/queries 查看，设置 QUERY_REPORT_FILE 时在进程退出时写入该文件。
+"""
+import atexit
+import json
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from flask import jsonify
+
+import database
+from blueprints.auth import admin_required
+
+_BASE_DIR = Path(__file__).resolve().parent
+_SLOW_LOG_PATH = _BASE_DIR / 'debug' / 'slow_query.log'
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(?!CONSTANT ROW)(\w+)\b(?! USING| VIRTUAL TABLE)')
+_EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE')
+
+_settings = {
+    'slow_ms': 200.0,
+    'explain_all': False,
+}
+_lock = threading.Lock()
+_log_lock = threading.Lock()
+_shapes: Dict[str, 'ShapeStats'] = {}
+
+
+class ShapeStats:
+    """一个语句形状的累计数据，由 _lock 保护。"""
+
+    def __init__(self, shape: str):
+        self.shape = shape
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.slow = 0
+        self.plan: Optional[List[str]] = None
+        self.explaining = False
+
+    def flags(self) -> List[str]:
+        flags = []
+        for line in self.plan or ():
+            match = _SCAN.match(line)
+            if match:
+                flags.append(f'full_scan:{match.group(1)}')
+            elif 'USE TEMP B-TREE' in line:
+                flags.append('temp_btree')
+        return sorted(set(flags))
+
+    def snapshot(self) -> Dict:
+        return {
+            'shape': self.shape,
+            'count': self.count,
+            'total_ms': round(self.total_ms, 2),
+            'avg_ms': round(self.total_ms / self.count, 3) if self.count else None,
+            'max_ms': round(self.max_ms, 2),
+            'slow': self.slow,
+            'plan': self.plan,
+            'flags': self.flags()
+        }
+
+
+def normalize_sql(sql: str) -> str:
+    """把语句化为形状：字面量 -> ?，IN 列表折叠为 IN (?...)，空白归一。"""
+    shape = _STRING_LITERAL.sub('?', sql)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = _WHITESPACE.sub(' ', shape).strip()
+    return _IN_LIST.sub('IN (?...)', shape)
+
+
+def parameter_shape(parameters):
+    """绑定参数的类型形状（不记录取值，避免把答案、密钥写进日志）。"""
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+
+def explain(sql: str, parameters) -> List[str]:
+    """在独立连接上取 EXPLAIN QUERY PLAN（不经过查询观察者，也不会真正执行语句）。"""
+    conn = sqlite3.connect(database.DB_NAME)
+    try:
+        rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', parameters or ()).fetchall()
+    except sqlite3.Error as exc:
+        return [f'<explain failed: {exc}>']
+    finally:
+        conn.close()
+    return [row[3] for row in rows]
+
+
+def _append_slow_log(record: Dict) -> None:
+    with _log_lock:
+        _SLOW_LOG_PATH.parent.mkdir(exist_ok=True)
+        with _SLOW_LOG_PATH.open('a', encoding='utf-8') as log_file:
+            log_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def _on_query(sql, parameters, seconds) -> None:
+    elapsed_ms = seconds * 1000
+    shape = normalize_sql(sql)
+    slow = elapsed_ms >= _settings['slow_ms']
+    with _lock:
+        stats = _shapes.get(shape)
+        if stats is None:
+            stats = ShapeStats(shape)
+            _shapes[shape] = stats
+        stats.count += 1
+        stats.total_ms += elapsed_ms
+        stats.max_ms = max(stats.max_ms, elapsed_ms)
+        if slow:
+            stats.slow += 1
+        # 每个形状只解释一次；executemany/executescript 没有单组参数，跳过
+        needs_plan = (stats.plan is None and not stats.explaining and parameters is not None
+                      and (slow or _settings['explain_all'])
+                      and shape.lstrip('( ').upper().startswith(_EXPLAINABLE))
+        if needs_plan:
+            stats.explaining = True
+
+    plan = None
+    if needs_plan:
+        plan = explain(sql, parameters)
+        with _lock:
+            stats.plan = plan
+            stats.explaining = False
+    if slow:
+        _append_slow_log({
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'elapsed_ms': round(elapsed_ms, 2),
+            'shape': shape,
+            'parameters': parameter_shape(parameters),
+            'plan': plan if plan is not None else stats.plan,
+            'flags': stats.flags()
+        })
+
+
+def query_report(limit: int = 50) -> Dict:
+    """按总耗时排序的语句形状，以及执行计划中出现全表扫描/临时排序的形状。"""
+    with _lock:
+        snapshots = [stats.snapshot() for stats in _shapes.values()]
+    snapshots.sort(key=lambda item: item['total_ms'], reverse=True)
+    return {
+        'slow_query_ms': _settings['slow_ms'],
+        'shapes': len(snapshots),
+        'statements': sum(item['count'] for item in snapshots),
+        'top': snapshots[:limit],
+        'scans': [item for item in snapshots if item['flags']]
+    }
+
+
+def write_report(path: str) -> None:
+    Path(path).write_text(json.dumps(query_report(limit=200), ensure_ascii=False, indent=2), encoding='utf-8')
+
+
+def reset_query_log() -> None:
+    with _lock:
+        _shapes.clear()
+
+
+@admin_required
+def queries_view():
+    return jsonify(query_report())
+
+
+def init_query_log(app) -> None:
+    """读取配置、注册查询观察者与 GET /metrics/queries（在 app.py 中调用一次）。"""
+    _settings['slow_ms'] = float(app.config.get('SLOW_QUERY_MS', _settings['slow_ms']))
+    _settings['explain_all'] = bool(app.config.get('QUERY_EXPLAIN_ALL', _settings['explain_all']))
+    database.add_query_listener(_on_query)
+    app.add_url_rule('/metrics/queries', 'query_report', queries_view)
+    report_file = app.config.get('QUERY_REPORT_FILE')
+    if report_file:
+        atexit.register(write_report, report_file)
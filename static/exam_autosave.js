@@ -0,0 +1,153 @@
+// 考试与定时模式的作答自动保存
+(function() {
+    'use strict';
+
+    const examForm = document.getElementById('examForm');
+    if (!examForm || !examForm.dataset.autosaveUrl) {
+        return;
+    }
+
+    const saveUrl = examForm.dataset.autosaveUrl;
+    const statusElement = document.getElementById('autosaveStatus');
+    const SAVE_DELAY = 1500;    // 作答变化后等待的毫秒数，连续修改合并为一次请求
+    const RETRY_DELAY = 5000;   // 保存失败后的重试间隔
+    const dirty = new Set();    // 尚未发送的题目 ID
+    let saveTimer = null;
+    let sending = Promise.resolve();
+    let stopped = false;
+
+    function questionId(name) {
+        return name && name.startsWith('answer_') ? name.slice('answer_'.length) : null;
+    }
+
+    function showStatus(text) {
+        if (statusElement) {
+            statusElement.textContent = text;
+        }
+    }
+
+    // 按表单当前状态取若干题的作答；没有选中项的题目为空列表（清空作答也要保存）
+    function collect(ids) {
+        const answers = {};
+        ids.forEach(function(id) { answers[id] = []; });
+        new FormData(examForm).forEach(function(value, name) {
+            const id = questionId(name);
+            if (id !== null && Object.prototype.hasOwnProperty.call(answers, id)) {
+                answers[id].push(value);
+            }
+        });
+        return answers;
+    }
+
+    function schedule(delay) {
+        if (stopped) {
+            return;
+        }
+        clearTimeout(saveTimer);
+        saveTimer = setTimeout(flush, delay);
+    }
+
+    // 发送所有未保存的题目，返回在发送完成后 resolve 的 Promise
+    function flush() {
+        clearTimeout(saveTimer);
+        saveTimer = null;
+        if (stopped || dirty.size === 0) {
+            return sending;
+        }
+        const ids = Array.from(dirty);
+        dirty.clear();
+        const body = JSON.stringify({ answers: collect(ids) });
+        // 请求依次发送，后保存的答案不会被先发出的覆盖
+        sending = sending.then(function() {
+            return fetch(saveUrl, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: body,
+                credentials: 'same-origin',
+                keepalive: true
+            });
+        }).then(function(response) {
+            if (response.status === 409) {
+                // 已交卷或已超时，不再保存
+                stopped = true;
+                showStatus('考试已结束，作答不再保存');
+                return;
+            }
+            if (!response.ok) {
+                throw new Error('HTTP ' + response.status);
+            }
+            showStatus('已自动保存 ' + new Date().toLocaleTimeString());
+        }).catch(function(err) {
+            console.error('自动保存失败:', err);
+            ids.forEach(function(id) { dirty.add(id); });
+            showStatus('自动保存失败，稍后重试');
+            schedule(RETRY_DELAY);
+        });
+        return sending;
+    }
+
+    function markChanged(event) {
+        const id = questionId(event.target.name);
+        if (id === null) {
+            return;
+        }
+        dirty.add(id);
+        schedule(SAVE_DELAY);
+    }
+
+    // 恢复已保存的作答（刷新页面或浏览器崩溃后重新打开）；用户已经改动过的题目不覆盖
+    function restore() {
+        fetch(saveUrl, { credentials: 'same-origin' })
+            .then(function(response) { return response.ok ? response.json() : null; })
+            .then(function(data) {
+                if (!data || !data.answers) {
+                    return;
+                }
+                Object.keys(data.answers).forEach(function(id) {
+                    if (dirty.has(id)) {
+                        return;
+                    }
+                    const values = data.answers[id];
+                    const inputs = examForm.querySelectorAll('[name="answer_' + CSS.escape(id) + '"]');
+                    inputs.forEach(function(input, index) {
+                        if (input.type === 'radio' || input.type === 'checkbox') {
+                            input.checked = values.indexOf(input.value) !== -1;
+                        } else {
+                            input.value = values[index] || '';
+                        }
+                    });
+                });
+            })
+            .catch(function(err) {
+                console.error('恢复已保存的作答失败:', err);
+            });
+    }
+
+    examForm.addEventListener('change', markChanged);
+    examForm.addEventListener('input', markChanged);
+
+    // 切到后台或关闭页面时立即发出未保存的内容
+    document.addEventListener('visibilitychange', function() {
+        if (document.visibilityState !== 'hidden' || stopped || dirty.size === 0) {
+            return;
+        }
+        const ids = Array.from(dirty);
+        const body = JSON.stringify({ answers: collect(ids) });
+        if (navigator.sendBeacon && navigator.sendBeacon(saveUrl, new Blob([body], { type: 'application/json' }))) {
+            dirty.clear();
+            clearTimeout(saveTimer);
+        }
+    });
+
+    restore();
+
+    window.examAutosave = {
+        flush: flush,
+        // 交卷后停止保存
+        stop: function() {
+            stopped = true;
+            clearTimeout(saveTimer);
+        }
+    };
+
+})();
@@ -288,6 +288,13 @@
     }
   });
 
+  // 离开页面时主动中断请求，服务端随即停止读取上游
+  window.addEventListener('pagehide', () => {
+    if (state.controller) {
+      state.controller.abort();
+    }
+  });
+
   // 初始化按钮标签
   const labelEl = trigger.querySelector('[data-ai-label]');
   if (labelEl) {
@@ -21,6 +21,24 @@
 
     console.log('初始剩余时间:', remainingTime, '秒');
 
+    // 时间到后停止作答、保存最后的修改，再在 data-submit-spread 秒内随机延迟交卷：
+    // 所有考生不会在同一秒提交，服务端在宽限期内照常接收，晚到的交卷也只按已保存的答案判分
+    function submitAtDeadline() {
+        const spread = parseFloat(examForm.dataset.submitSpread) || 0;
+        const delay = Math.random() * spread * 1000;
+        examForm.inert = true;
+        const autosave = window.examAutosave;
+        const saved = autosave ? autosave.flush() : Promise.resolve();
+        saved.then(function() {
+            setTimeout(function() {
+                if (autosave) {
+                    autosave.stop();
+                }
+                examForm.submit();
+            }, delay);
+        });
+    }
+
     // 倒计时函数
     function updateCountdown() {
         remainingTime -= 0.1; // 每100毫秒减少0.1秒
@@ -32,7 +50,7 @@
             // 时间到，自动提交表单
             if (examForm) {
                 console.log('时间到，自动提交表单');
-                examForm.submit();
+                submitAtDeadline();
             } else {
                 console.error('表单元素未找到');
             }
@@ -64,6 +82,9 @@
     if (examForm) {
         examForm.addEventListener('submit', function() {
             clearInterval(countdownInterval);
+            if (window.examAutosave) {
+                window.examAutosave.stop();
+            }
         });
     }
 